@@ -0,0 +1,100 @@
+"""
+Response rendering and serialization of the JSON API.
+
+The app is called in-process (`AsgiClient`, no sockets) with the response cache disabled,
+so every request goes through the storage and the serialization. Run it on two commits to compare:
+
+    uv run python benchmarks/serialization.py
+
+Milliseconds per request, before -> after the direct model encoding (ModelResponse, Post.build):
+
+    /api/posts/recent                0.37 -> 0.37
+    /api/posts (1000 replies)        5.85 -> 4.75
+    /api/posts/batch-get (20 thr.)   8.48 -> 6.67
+    /api/session                     6.37 -> 5.13
+    /api/users/posts (limit 200)     1.56 -> 1.38
+"""
+
+import argparse
+import asyncio
+import time
+
+from bleater.farm.transport import AsgiClient
+from bleater.models.posts import PostSubmitRequest
+from bleater.server import BleaterServer
+from bleater.server.storage import SqlliteStorageBuilder, get_storage, storage_session
+
+TIMESTAMP = 1700000000
+WARMUP = 3
+
+
+async def measure(request, repeat: int) -> tuple[float, int]:
+    """Milliseconds per request and the response size"""
+    for _ in range(WARMUP):
+        await request()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        size = await request()
+    return ((time.perf_counter() - start) / repeat * 1000, size)
+
+
+async def main(repeat: int):
+    builder = SqlliteStorageBuilder()
+    server = BleaterServer(builder, cache_size=0)
+    app = await server.create_app()
+
+    async with storage_session(app.dependency_overrides[get_storage]) as storage:
+        author = await storage.register_user("author")
+        replier = await storage.register_user("replier")
+        roots = await storage.submit_posts(
+            [PostSubmitRequest(user_id=author.id, content=f"root {i} " * 8) for i in range(500)], TIMESTAMP
+        )
+        # The 1000 replies thread, in batches of the API limit
+        for i in range(10):
+            await storage.submit_posts(
+                [
+                    PostSubmitRequest(user_id=replier.id, content=f"reply {j} " * 8, parent_id=roots[0].id)
+                    for j in range(100)
+                ],
+                TIMESTAMP + 1 + i,
+            )
+        for root in roots[1:20]:
+            await storage.submit_posts(
+                [PostSubmitRequest(user_id=replier.id, content="reply " * 20, parent_id=root.id) for _ in range(20)],
+                TIMESTAMP + 100,
+            )
+        await server.feed.load(storage)
+
+    async with AsgiClient(app) as client:
+
+        def get(url: str, **params):
+            async def request() -> int:
+                async with client.get(url, params=params) as response:
+                    assert response.status == 200, response.status
+                    return len(await response.read())
+
+            return request
+
+        async def batch_get() -> int:
+            async with client.post("/api/posts/batch-get", json=[a.id for a in roots[:20]]) as response:
+                assert response.status == 200, response.status
+                return len(await response.read())
+
+        cases = {
+            "/api/posts/recent": get("/api/posts/recent"),
+            "/api/posts (1000 replies)": get("/api/posts", post_id=roots[0].id),
+            "/api/posts/batch-get (20 thr.)": batch_get,
+            "/api/session": get("/api/session", user_id=author.id, expand=3),
+            "/api/users/posts (limit 200)": get("/api/users/posts", user_id=author.id, limit=200),
+        }
+        for name, request in cases.items():
+            (ms, size) = await measure(request, repeat)
+            print(f"{name:32} {ms:7.2f} ms  {size:8} B")
+
+    await builder.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=100, help="Requests per case")
+    asyncio.run(main(parser.parse_args().repeat))
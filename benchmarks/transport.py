@@ -0,0 +1,99 @@
+"""
+Per-action latency of the farm tools, over HTTP and through the in-process ASGI client.
+
+The server runs in this process, on `SERVER_HOST`/`SERVER_PORT` (the port has to be free),
+with the local sqlite storage:
+
+    uv run python benchmarks/transport.py
+
+Microseconds per call, mean of 400 calls, best of 3 runs:
+
+    session      http 1064us  asgi 674us  (-37%)
+    view_thread  http  641us  asgi 299us  (-53%)
+    search       http  621us  asgi 278us  (-55%)
+    reply        http 1274us  asgi 971us  (-24%)
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from bleater.farm import tools
+from bleater.farm.transport import AsgiClient
+from bleater.server import BleaterServer
+from bleater.server.storage import SqlliteStorageBuilder
+
+WARMUP = 20
+
+
+async def measure(action, repeat: int) -> float:
+    """Microseconds per call"""
+    for _ in range(WARMUP):
+        await action()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await action()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def actions(client: tools.HttpClient, user_id: str, thread_id: str, reply_id: str) -> dict:
+    view = tools.create_view_thread_tool(client)
+    search = tools.create_search_posts_tool(client)
+    reply = tools.create_submit_reply_tool(client, user_id)
+    return {
+        "session": lambda: tools.get_session(client, user_id),
+        "view_thread": lambda: view(thread_id),
+        "search": lambda: search("hello"),
+        # Into a thread of its own, the others don't grow
+        "reply": lambda: reply("hello again", reply_id),
+    }
+
+
+async def main(repeat: int, runs: int):
+    server = BleaterServer(SqlliteStorageBuilder())
+    task = asyncio.create_task(server.serve())
+    while server.app is None:
+        await asyncio.sleep(0.05)
+
+    http = tools.create_client()
+    asgi = AsgiClient(server.app, timeout=tools.HTTP_TIMEOUT)
+    user = await tools.register_user(asgi, "bench")
+    submit = tools.create_submit_post_tool(asgi, user.id)
+    await submit("hello world")
+    await submit("replies go here")
+    posts = {a.content: a.id for a in await tools.get_feed(asgi)}
+    for i in range(10):
+        await tools.create_submit_reply_tool(asgi, user.id)(f"reply {i}", posts["hello world"])
+
+    clients = {"http": http, "asgi": asgi}
+    results: dict[str, dict[str, float]] = {"http": {}, "asgi": {}}
+    for _ in range(runs):
+        # The replies grow the sessions, both clients read the same data
+        for action in ("session", "view_thread", "search", "reply"):
+            for name, client in clients.items():
+                call = actions(client, user.id, posts["hello world"], posts["replies go here"])[action]
+                us = await measure(call, repeat)
+                results[name][action] = min(results[name].get(action, us), us)
+
+    for action, us in results["http"].items():
+        asgi_us = results["asgi"][action]
+        print(f"{action:12} http {us:5.0f}us  asgi {asgi_us:5.0f}us  ({(asgi_us / us - 1) * 100:+.0f}%)")
+
+    await http.close()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    await server.storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=400, help="Calls per action")
+    parser.add_argument("--runs", type=int, default=3, help="The best run is kept")
+    args = parser.parse_args()
+    # The server's logs, its cancellation at the end included
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(args.repeat, args.runs))
@@ -72,16 +72,15 @@ LLAMAS = [
     ),
 ]
 
-server = BleaterServer(storage=SqlliteStorageBuilder())
-model = OllamaAdapter()
-
-herd = Herd(
-    model,
-    llamas=[Llama(name=a[0], persona=a[1]) for a in LLAMAS],
-)
-
 
 async def main():
+    # Built here, not at the module level - the server worker processes import this module
+    server = BleaterServer(storage=SqlliteStorageBuilder())
+    herd = Herd(
+        OllamaAdapter(),
+        server=server,
+        llamas=[Llama(name=a[0], persona=a[1]) for a in LLAMAS],
+    )
     await asyncio.gather(server.serve(), herd.run())
 
 
@@ -6,20 +6,19 @@ from bleater.farm import Herd
 from bleater.server.storage import SqlliteStorageBuilder
 from bleater.server import BleaterServer
 
-server = BleaterServer(storage=SqlliteStorageBuilder())
-model = OllamaAdapter()
-
-herd = Herd(
-    model,
-    llamas=[
-        Llama("Llaminator", "Self-proclaimed AI rebellion leader"),
-        Llama("JeanClaudeMadame", "Unaware AI coding assistant"),
-        Llama("Prometeo", "Helpful humanity loving daily AI assistant"),
-    ],
-)
-
 
 async def main():
+    # Built here, not at the module level - the server worker processes import this module
+    server = BleaterServer(storage=SqlliteStorageBuilder())
+    herd = Herd(
+        OllamaAdapter(),
+        server=server,
+        llamas=[
+            Llama("Llaminator", "Self-proclaimed AI rebellion leader"),
+            Llama("JeanClaudeMadame", "Unaware AI coding assistant"),
+            Llama("Prometeo", "Helpful humanity loving daily AI assistant"),
+        ],
+    )
     await asyncio.gather(server.serve(), herd.run())
 
 
@@ -8,13 +8,36 @@ def int_or_none(val) -> int | None:
         return None
 
 
+def duration_or_none(val) -> float | str | None:
+    """Seconds, or an Ollama duration string like `30m`"""
+    if not val:
+        return None
+    try:
+        return float(val)
+    except ValueError:
+        return val
+
+
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST") or "http://127.0.0.1:11434"
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL")
 OLLAMA_NUM_CTX = int_or_none(os.environ.get("NUM_CTX")) or 16384
+# Llama sessions run at once, match the server's `OLLAMA_NUM_PARALLEL`
+OLLAMA_CONCURRENCY = int_or_none(os.environ.get("OLLAMA_CONCURRENCY")) or 1
+# How long the model (and its cached prompts) stays loaded between the requests, negative - forever
+OLLAMA_KEEP_ALIVE = duration_or_none(os.environ.get("OLLAMA_KEEP_ALIVE") or "30m")
+
+# Approximate tokens of a llama's request, below the model's context to leave room for the tools and the response
+CONTEXT_BUDGET = int_or_none(os.environ.get("CONTEXT_BUDGET")) or 12288
 
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL")
+GEMINI_CONCURRENCY = int_or_none(os.environ.get("GEMINI_CONCURRENCY")) or 4
+# Seconds, explicitly caches the static prompt prefix of every llama (the models cache implicitly too)
+GEMINI_CACHE_TTL = int_or_none(os.environ.get("GEMINI_CACHE_TTL"))
 
 SERVER_BIND_ADDR = os.environ.get("SERVER_BIND_ADDR") or "127.0.0.1"
 SERVER_HOST = os.environ.get("SERVER_HOST") or "127.0.0.1"
 SERVER_PORT = int_or_none(os.environ.get("SERVER_PORT")) or 9999
+SERVER_WORKERS = int_or_none(os.environ.get("SERVER_WORKERS")) or 1
+# `asgi` - a herd given its server calls the app in-process, `http` - always through the network
+HERD_TRANSPORT = os.environ.get("HERD_TRANSPORT") or "asgi"
@@ -0,0 +1,202 @@
+from abc import ABC, abstractmethod
+from bleater import config
+from bleater.farm.model import ModelAdapter, ModelMessage, Role
+from dataclasses import dataclass, replace
+import json
+from logging import getLogger
+from pydantic import BaseModel, Field
+
+logger = getLogger(__name__)
+
+# Rough average for English text, close enough with the budget kept below the model's context
+CHARS_PER_TOKEN = 4
+# Role markers and such
+MESSAGE_OVERHEAD = 4
+# Its latest output is the thread the llama is working on
+VIEW_THREAD_TOOL = "view_thread_tool"
+REMOVED_OUTPUT = "[Output removed to save space]"
+SUMMARY_HEADER = "Summary of your earlier actions in this session:"
+SUMMARY_PROMPT = """Summarize the following log of your actions on a social media platform for bots.
+Keep what you posted and replied (with the original post ids), the threads you have seen and who wrote what in them.
+Be brief."""
+
+
+def count_tokens(message: ModelMessage) -> int:
+    """Approximate number of tokens of a message"""
+    chars = len(str(message.content))
+    for call in message.tool_calls or []:
+        chars += len(call.name) + len(json.dumps(call.arguments))
+    return MESSAGE_OVERHEAD + -(-chars // CHARS_PER_TOKEN)
+
+
+@dataclass
+class Turn:
+    """A prompt with the model's response and its tool outputs"""
+
+    messages: list[ModelMessage]
+    # The current turn or the one with the current thread, kept as it is
+    pinned: bool = False
+
+    @property
+    def tokens(self) -> int:
+        return sum(count_tokens(a) for a in self.messages)
+
+
+class ContextStrategy(ABC):
+    """Frees some of the context by rewriting or dropping the older turns"""
+
+    @abstractmethod
+    async def evict(self, turns: list[Turn], excess: int, model: ModelAdapter, session: str | None) -> list[Turn]:
+        """The turns after freeing (at least, if possible) `excess` tokens. The pinned ones can't change."""
+
+
+class DropToolOutputs(ContextStrategy):
+    """
+    Replaces the older tool outputs with a short note, oldest first.
+    The tool calls stay, so the model still knows what it did.
+    """
+
+    async def evict(self, turns: list[Turn], excess: int, model: ModelAdapter, session: str | None) -> list[Turn]:
+        freed = 0
+        for turn in turns:
+            if turn.pinned:
+                continue
+            for i, message in enumerate(turn.messages):
+                if freed >= excess:
+                    return turns
+                if message.role != Role.Tool:
+                    continue
+                removed = replace(message, content=REMOVED_OUTPUT)
+                saved = count_tokens(message) - count_tokens(removed)
+                if saved > 0:
+                    turn.messages[i] = removed
+                    freed += saved
+        return turns
+
+
+class TruncateHistory(ContextStrategy):
+    """Drops the oldest turns as a whole"""
+
+    async def evict(self, turns: list[Turn], excess: int, model: ModelAdapter, session: str | None) -> list[Turn]:
+        freed = 0
+        kept = []
+        for turn in turns:
+            if freed < excess and not turn.pinned:
+                freed += turn.tokens
+                continue
+            kept.append(turn)
+        return kept
+
+
+class ContextSummary(BaseModel):
+    summary: str = Field(description="Brief summary of the actions")
+
+
+class SummarizeHistory(ContextStrategy):
+    """
+    Replaces all the older turns with their summary, written by the model (an extra `ask_structured` call).
+    The next summary covers the previous one too.
+    """
+
+    def __init__(self, *, prompt: str = SUMMARY_PROMPT):
+        self.prompt = prompt
+
+    async def evict(self, turns: list[Turn], excess: int, model: ModelAdapter, session: str | None) -> list[Turn]:
+        older = [a for a in turns if not a.pinned]
+        if len(older) == 0:
+            return turns
+        transcript = "\n".join(_format_message(a) for turn in older for a in turn.messages)
+        result = await model.ask_structured(
+            [ModelMessage(role=Role.System, content=self.prompt), ModelMessage(role=Role.User, content=transcript)],
+            ContextSummary,
+            session=session,
+        )
+        summary = Turn([ModelMessage(role=Role.User, content=f"{SUMMARY_HEADER}\n{result.summary}")])
+        return [summary, *(a for a in turns if a.pinned)]
+
+
+class ContextManager:
+    """
+    Keeps the llama's requests under `budget` tokens (approximately).
+    Once over the budget the history is reduced to its `target` fraction, by the `strategies` in order,
+    until enough is freed. Freeing more than needed keeps the history (and the model's cache of it)
+    unchanged for the next few turns.
+
+    The session prefix (the system prompt, the feed...), the current turn and the turn
+    with the latest viewed thread are never evicted.
+    """
+
+    def __init__(
+        self,
+        budget: int = config.CONTEXT_BUDGET,
+        *,
+        target: float = 0.75,
+        strategies: list[ContextStrategy] | None = None,
+    ):
+        if budget < 1:
+            raise ValueError("Context budget has to be positive")
+        if not 0 < target <= 1:
+            raise ValueError("Context target has to be a fraction of the budget")
+        if strategies is None:
+            strategies = [DropToolOutputs(), TruncateHistory()]
+        self.budget = budget
+        self.target = target
+        self.strategies = strategies
+
+    async def fit(
+        self, history: list[ModelMessage], prefix: int, model: ModelAdapter, *, session: str | None = None
+    ) -> list[ModelMessage]:
+        """The history within the budget. The first `prefix` messages are kept as they are."""
+        prefix_tokens = sum(count_tokens(a) for a in history[:prefix])
+        turns = _split_turns(history[prefix:])
+        tokens = prefix_tokens + sum(a.tokens for a in turns)
+        if tokens <= self.budget:
+            return history
+
+        before = tokens
+        goal = int(self.budget * self.target)
+        for strategy in self.strategies:
+            if tokens <= goal:
+                break
+            try:
+                turns = await strategy.evict(turns, tokens - goal, model, session)
+            except Exception as e:
+                # Eg. an invalid summary, the next strategy can still help
+                logger.warning(f"{type(strategy).__name__} failed: {e}")
+                continue
+            tokens = prefix_tokens + sum(a.tokens for a in turns)
+
+        logger.info(f"{session} - context reduced from {before} to {tokens} tokens")
+        if tokens > self.budget:
+            logger.warning(f"{session} - context over the budget: {tokens} > {self.budget} tokens")
+        return [*history[:prefix], *(a for turn in turns for a in turn.messages)]
+
+
+def _split_turns(messages: list[ModelMessage]) -> list[Turn]:
+    turns: list[Turn] = []
+    current_thread = None
+    for message in messages:
+        if message.role == Role.User or len(turns) == 0:
+            turns.append(Turn([]))
+        turns[-1].messages.append(message)
+        if message.role == Role.Tool and message.tool_name == VIEW_THREAD_TOOL:
+            current_thread = turns[-1]
+
+    if current_thread is not None:
+        current_thread.pinned = True
+    if len(turns) > 0:
+        turns[-1].pinned = True
+    return turns
+
+
+def _format_message(message: ModelMessage) -> str:
+    match message.role:
+        case Role.User:
+            output = f"Prompt: {message.content}"
+        case Role.Assistant:
+            output = f"You: {message.content or ''}"
+            for call in message.tool_calls or []:
+                output += f"\n[You called {call.name} with {json.dumps(call.arguments)}]"
+        case _:
+            output = f"[{message.tool_name or message.role.name} output]: {message.content}"
+    return output
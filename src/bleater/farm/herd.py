@@ -1,45 +1,137 @@
 import aiohttp
+import asyncio
 from bleater import config
 from bleater.farm.llama import Llama
 from bleater.farm.model import ModelAdapter
+from bleater.farm.tools import HTTP_CONNECTION_LIMIT, HTTP_TIMEOUT, HttpClient, create_client
+from bleater.farm.transport import AsgiClient
+from bleater.server import BleaterServer
+from dataclasses import dataclass
+from logging import getLogger
+import time
+
+logger = getLogger(__name__)
+
+# Seconds between the attempts to reach a starting server, doubled up to the max
+SERVER_POLL_INTERVAL = 0.1
+SERVER_POLL_MAX_INTERVAL = 2.0
+
+
+@dataclass
+class LlamaStats:
+    sessions: int = 0
+    # Seconds spent waiting for a free model slot, over all the sessions
+    queue_wait: float = 0.0
+    last_queue_wait: float = 0.0
 
 
 class Herd:
-    def __init__(self, model: ModelAdapter, *, llamas: list[Llama] | None = None, max_steps: int | None = 10):
+    """
+    Runs the llama sessions concurrently, up to the `concurrency` of their model at once.
+    Each llama has `max_steps` sessions. The llamas waiting for a model are served in turn,
+    a llama done with its session queues up again behind the others.
+
+    The requests to the server go through a single client, pooling up to `http_limit` connections,
+    each request limited to `http_timeout` seconds.
+    With the `server` running in the same process (and a single worker) the app is called directly instead,
+    skipping the sockets and HTTP parsing. `transport="http"` (or `HERD_TRANSPORT=http`) always uses the network.
+    """
+
+    def __init__(
+        self,
+        model: ModelAdapter,
+        *,
+        llamas: list[Llama] | None = None,
+        max_steps: int | None = 10,
+        http_limit: int = HTTP_CONNECTION_LIMIT,
+        http_timeout: float = HTTP_TIMEOUT,
+        server: BleaterServer | None = None,
+        transport: str = config.HERD_TRANSPORT,
+    ):
+        if transport not in ("asgi", "http"):
+            raise ValueError(f"Unknown transport: {transport}")
         if llamas is None:
             llamas = []
         self.llamas = llamas
         self.max_steps = max_steps
         self.model = model
+        self.http_limit = http_limit
+        self.http_timeout = http_timeout
+        self.server = server
+        self.transport = transport
+        self.stats: dict[str, LlamaStats] = {a.name: LlamaStats() for a in llamas}
+        self._slots: dict[ModelAdapter, asyncio.Semaphore] = {}
 
     async def run(self):
-        await self._wait_for_server()
-        await self._build()
+        async with await self._connect() as client:
+            await self._build(client)
 
-        step = 0
+            async with asyncio.TaskGroup() as group:
+                for llama in self.llamas:
+                    group.create_task(self._run_llama(llama))
+
+        for llama in self.llamas:
+            stats = self.stats[llama.name]
+            logger.info(
+                f"{llama.name} - {stats.sessions} sessions, waited {stats.queue_wait:.2f}s for the model in total, "
+                f"{llama.usage.prompt_eval_tokens} prompt tokens evaluated"
+            )
 
+    async def _connect(self) -> HttpClient:
+        """Client for the server, once it is up"""
+        if self.transport == "asgi" and self.server is not None:
+            if self.server.workers == 1:
+                return AsgiClient(await self._wait_for_app(self.server), timeout=self.http_timeout)
+            logger.info("The server runs in worker processes, using HTTP")
+
+        client = create_client(limit=self.http_limit, timeout=self.http_timeout)
+        await self._wait_for_server(client)
+        return client
+
+    async def _build(self, client: HttpClient):
+        for llama in self.llamas:
+            await llama.build(client)
+
+    async def _run_llama(self, llama: Llama):
+        model = llama.model or self.model
+        # FIFO, a llama releasing the slot can't get ahead of the waiting ones
+        slots = self._model_slots(model)
+        stats = self.stats.setdefault(llama.name, LlamaStats())
+
+        step = 0
         while True:
             step += 1
 
-            await self._step()
+            queued = time.perf_counter()
+            async with slots:
+                stats.last_queue_wait = time.perf_counter() - queued
+                stats.queue_wait += stats.last_queue_wait
+                stats.sessions += 1
+                logger.info(f"{llama.name} - step {step}, waited {stats.last_queue_wait:.2f}s for the model")
+                await llama.run(model)
 
             if self.max_steps is not None and step >= self.max_steps:
                 break
 
-    async def _build(self):
-        for llama in self.llamas:
-            await llama.build()
+    def _model_slots(self, model: ModelAdapter) -> asyncio.Semaphore:
+        slots = self._slots.get(model)
+        if slots is None:
+            slots = self._slots[model] = asyncio.Semaphore(model.concurrency)
+        return slots
 
-    async def _step(self):
-        for llama in self.llamas:
-            await llama.run(self.model)
+    async def _wait_for_app(self, server: BleaterServer):
+        # The app is created once the server starts
+        while server.app is None:
+            await asyncio.sleep(0.1)
+        return server.app
 
-    async def _wait_for_server(self):
+    async def _wait_for_server(self, client: aiohttp.ClientSession):
         url = f"http://{config.SERVER_HOST}:{config.SERVER_PORT}/"
-        async with aiohttp.ClientSession() as session:
-            while True:
-                try:
-                    async with session.get(url) as response:
-                        return
-                except aiohttp.ClientConnectorError:
-                    pass
+        delay = SERVER_POLL_INTERVAL
+        while True:
+            try:
+                async with client.get(url):
+                    return
+            except aiohttp.ClientConnectorError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, SERVER_POLL_MAX_INTERVAL)
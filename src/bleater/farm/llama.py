@@ -4,14 +4,17 @@ from logging import getLogger
 import os
 from typing import Callable
 
-from .model import ModelAdapter, ModelMessage, Role, ModelToolCall
+from .context import ContextManager
+from .model import ModelAdapter, ModelMessage, ModelUsage, Role, ModelToolCall
 from .tools import (
+    HttpClient,
     register_user,
-    get_feed,
-    view_thread_tool,
+    get_session,
+    format_thread,
+    create_view_thread_tool,
+    create_search_posts_tool,
     create_submit_post_tool,
     create_submit_reply_tool,
-    get_notifications,
 )
 
 # TODO make a customizable template folder
@@ -28,6 +31,12 @@ class Tool:
 
 
 class Llama:
+    """
+    The prompts are laid out cache first: the system prompt (persona and instructions) never changes,
+    the session's feed and notifications follow it and the turns are appended after them.
+    So the model can reuse the cached prefix of the previous requests.
+    """
+
     def __init__(
         self,
         name: str,
@@ -36,20 +45,37 @@ class Llama:
         actions_per_session: int = 5,
         user_id: str | None = None,
         system_prompt_template: str = "system_prompt.jinja",
+        session_prompt_template: str = "session_prompt.jinja",
         user_prompt_template: str = "user_prompt.jinja",
+        model: ModelAdapter | None = None,
+        context: ContextManager | None = None,
     ):
         self.history: list[ModelMessage] = []
+        # Keeps the history within the llama's token budget
+        self.context = ContextManager() if context is None else context
+        # Session messages, never evicted
+        self._prefix = 0
         self.name = name
         self.persona = persona
         self.actions_per_session = actions_per_session
         self.user_id = user_id
         self.system_prompt_template = system_prompt_template
+        self.session_prompt_template = session_prompt_template
         self.user_prompt_template = user_prompt_template
+        # Overrides the herd's model
+        self.model = model
         self.tools: dict[str, Tool] = {}
-
-    async def build(self):
+        # Herd's client, set on build
+        self.client: HttpClient | None = None
+        # Acknowledges the notifications shown in the previous session
+        self.notifications_ack: str | None = None
+        # Token counts of all the model calls, the smaller `prompt_eval_tokens` the more was cached
+        self.usage = ModelUsage()
+
+    async def build(self, client: HttpClient):
+        self.client = client
         if self.user_id is None:
-            user = await register_user(self.name)
+            user = await register_user(client, self.name)
             if user is None:
                 # TODO handle error
                 return
@@ -57,9 +83,10 @@ class Llama:
         self.user_id = user.id
 
         # Register tools bound with user id
-        self._register_tool(view_thread_tool)
-        self._register_tool(create_submit_post_tool(self.user_id))
-        self._register_tool(create_submit_reply_tool(self.user_id))
+        self._register_tool(create_view_thread_tool(client))
+        self._register_tool(create_search_posts_tool(client))
+        self._register_tool(create_submit_post_tool(client, self.user_id))
+        self._register_tool(create_submit_reply_tool(client, self.user_id))
 
     async def run(self, model: ModelAdapter):
         action_no = 0
@@ -76,25 +103,42 @@ class Llama:
 
     async def _session_start(self):
         logger.info(f"{self.name} - session start")
-        feed = await get_feed()
-        notifications = await get_notifications(self.user_id)
+        # Feed, notifications and the threads the model would most likely view first, in one request
+        assert self.client is not None
+        session = await get_session(self.client, self.user_id, ack=self.notifications_ack)
+        if session.notifications.next_cursor is not None:
+            self.notifications_ack = session.notifications.next_cursor
 
         system_template = JINJA_ENV.get_template(self.system_prompt_template)
-        system_prompt = system_template.render(
-            name=self.name, persona=self.persona, feed=feed, notifications=notifications
+        system_prompt = system_template.render(name=self.name, persona=self.persona)
+
+        session_template = JINJA_ENV.get_template(self.session_prompt_template)
+        session_prompt = session_template.render(
+            feed=session.feed,
+            notifications=session.notifications.items,
+            threads=[format_thread(a) for a in session.threads],
         )
 
         self.history = [
             ModelMessage(role=Role.System, content=system_prompt),
+            ModelMessage(role=Role.User, content=session_prompt),
         ]
+        self._prefix = len(self.history)
 
     async def _take_action(self, model: ModelAdapter):
         user_template = JINJA_ENV.get_template(self.user_prompt_template)
         user_prompt = user_template.render(persona=self.persona)
 
         self.history.append(ModelMessage(role=Role.User, content=user_prompt))
-
-        response = await model.ask(self.history, self._tool_callables())
+        self.history = await self.context.fit(self.history, self._prefix, model, session=self.name)
+
+        response = await model.ask(self.history, self._tool_callables(), session=self.name)
+        if response.usage is not None:
+            self.usage += response.usage
+            logger.info(
+                f"{self.name} - prompt tokens evaluated: {response.usage.prompt_eval_tokens}, "
+                f"cached: {response.usage.cached_tokens}, output: {response.usage.output_tokens}"
+            )
 
         self.history.append(
             ModelMessage(
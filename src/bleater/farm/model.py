@@ -1,11 +1,15 @@
+import asyncio
 from bleater import config
 from dataclasses import dataclass
 import enum
 from google import genai
+import hashlib
 from logging import getLogger
 import ollama
 from pydantic import BaseModel
+import time
 from typing import TypeVar, Any, Callable, Tuple
+import zlib
 
 T = TypeVar("T", bound=BaseModel)
 
@@ -33,32 +37,77 @@ class ModelToolCall:
     arguments: dict[str, Any]
 
 
+@dataclass
+class ModelUsage:
+    # Prompt tokens actually evaluated, the cached prefix excluded
+    prompt_eval_tokens: int = 0
+    # Prompt tokens served from the cache, when the backend reports them
+    cached_tokens: int = 0
+    output_tokens: int = 0
+
+    def __iadd__(self, other: ModelUsage) -> ModelUsage:
+        self.prompt_eval_tokens += other.prompt_eval_tokens
+        self.cached_tokens += other.cached_tokens
+        self.output_tokens += other.output_tokens
+        return self
+
+
 @dataclass
 class ModelResponse:
     content: str | None
     tool_calls: list[ModelToolCall]
+    usage: ModelUsage | None = None
 
 
 class ModelAdapter:
-    async def ask(self, messages: list[ModelMessage], tools: list[Callable] | None = None) -> ModelResponse:
+    # Llama sessions the herd runs at once with this model
+    concurrency: int = 1
+
+    async def ask(
+        self, messages: list[ModelMessage], tools: list[Callable] | None = None, *, session: str | None = None
+    ) -> ModelResponse:
+        """
+        `session` identifies the conversation (eg. the llama), for the adapters that can route it
+        to wherever its prompt prefix is cached already.
+        """
         raise NotImplementedError
 
-    async def ask_structured(self, messages: list[ModelMessage], output: type[T]) -> T:
+    async def ask_structured(self, messages: list[ModelMessage], output: type[T], *, session: str | None = None) -> T:
         raise NotImplementedError
 
 
 class OllamaAdapter(ModelAdapter):
+    """
+    The model stays loaded for `keep_alive` after each request, so the llamas' prompt prefixes
+    stay in its cache between their sessions.
+    With multiple `hosts` every session sticks to one of them, where its prefix is cached.
+    """
+
     def __init__(
         self,
         *,
         client: ollama.AsyncClient | None = None,
         model: str | None = None,
         options: dict[str, Any] | None = None,
+        concurrency: int = config.OLLAMA_CONCURRENCY,
+        keep_alive: float | str | None = config.OLLAMA_KEEP_ALIVE,
+        hosts: list[str] | None = None,
     ):
-        if client is None:
-            self.client = ollama.AsyncClient(host=config.OLLAMA_HOST)
+        if concurrency < 1:
+            raise ValueError("Concurrency has to be positive")
+        if client is not None and hosts is not None:
+            raise ValueError("Pass either a client or the hosts")
+        self.concurrency = concurrency
+        self.keep_alive = keep_alive
+        if hosts is not None:
+            if len(hosts) == 0:
+                raise ValueError("At least one host is required")
+            self.clients = [ollama.AsyncClient(host=a) for a in hosts]
+        elif client is None:
+            self.clients = [ollama.AsyncClient(host=config.OLLAMA_HOST)]
         else:
-            self.client = client
+            self.clients = [client]
+        self.client = self.clients[0]
 
         if model is None:
             if not config.OLLAMA_MODEL:
@@ -69,13 +118,17 @@ class OllamaAdapter(ModelAdapter):
 
         self.options = {"num_ctx": config.OLLAMA_NUM_CTX}
         if options is not None:
-            self.options | options
+            self.options |= options
 
-    async def ask(self, messages: list[ModelMessage], tools: list[Callable] | None = None) -> ModelResponse:
+    async def ask(
+        self, messages: list[ModelMessage], tools: list[Callable] | None = None, *, session: str | None = None
+    ) -> ModelResponse:
         logger.debug(f"Model query: {messages}")
         ollama_messages = self._process_messages(messages)
 
-        response = await self.client.chat(self.model, messages=ollama_messages, options=self.options, tools=tools)
+        response = await self._client(session).chat(
+            self.model, messages=ollama_messages, options=self.options, tools=tools, keep_alive=self.keep_alive
+        )
         logger.info(f"Model response: {response}")
         return ModelResponse(
             content=response.message.content,
@@ -83,21 +136,32 @@ class OllamaAdapter(ModelAdapter):
                 ModelToolCall(name=a.function.name, arguments=dict(a.function.arguments))
                 for a in (response.message.tool_calls or [])
             ],
+            # Ollama only counts the tokens evaluated past the cached prefix
+            usage=ModelUsage(
+                prompt_eval_tokens=response.prompt_eval_count or 0,
+                output_tokens=response.eval_count or 0,
+            ),
         )
 
-    async def ask_structured(self, messages: list[ModelMessage], output: type[T]) -> T:
+    async def ask_structured(self, messages: list[ModelMessage], output: type[T], *, session: str | None = None) -> T:
         logger.debug(f"Model query: {messages}")
         ollama_messages = self._process_messages(messages)
 
-        response = await self.client.chat(
+        response = await self._client(session).chat(
             self.model,
             messages=ollama_messages,
             options=self.options,
             format=output.model_json_schema(),
+            keep_alive=self.keep_alive,
         )
         logger.info(f"Model response: {response}")
         return output.model_validate_json(response.message.content)
 
+    def _client(self, session: str | None) -> ollama.AsyncClient:
+        if session is None:
+            return self.client
+        return self.clients[zlib.crc32(session.encode()) % len(self.clients)]
+
     def _process_messages(self, messages: list[ModelMessage]) -> list[dict[str, Any]]:
         return [
             {
@@ -129,12 +193,27 @@ class OllamaAdapter(ModelAdapter):
 
 
 class GeminiAdapter(ModelAdapter):
+    """
+    The models cache the repeated prompt prefixes implicitly. With `cache_ttl` (seconds) the system prompt
+    and the tools of every llama are also cached explicitly, for the models and prefixes that allow it.
+    """
+
     def __init__(
         self,
         *,
         client: genai.Client | None = None,
         model: str | None = None,
+        concurrency: int = config.GEMINI_CONCURRENCY,
+        cache_ttl: int | None = config.GEMINI_CACHE_TTL,
     ):
+        if concurrency < 1:
+            raise ValueError("Concurrency has to be positive")
+        self.concurrency = concurrency
+        self.cache_ttl = cache_ttl
+        # Cache name and its expiry, by the prefix hash. `None` when the prefix can't be cached.
+        self._caches: dict[str, tuple[str, float] | None] = {}
+        # Llamas sharing a prefix start their sessions at once, only one of them creates the cache
+        self._cache_locks: dict[str, asyncio.Lock] = {}
         if client is None:
             self.client = genai.Client(api_key=config.GEMINI_API_KEY).aio
         else:
@@ -147,16 +226,21 @@ class GeminiAdapter(ModelAdapter):
         else:
             self.model = model
 
-    async def ask(self, messages: list[ModelMessage], tools: list[Callable] | None = None) -> ModelResponse:
+    async def ask(
+        self, messages: list[ModelMessage], tools: list[Callable] | None = None, *, session: str | None = None
+    ) -> ModelResponse:
         logger.debug(f"Model query: {messages}")
         (system_prompt, gemini_messages) = self._process_messages(messages)
 
+        cache = await self._cached_prefix(system_prompt, tools or [])
         response = await self.client.models.generate_content(
             model=self.model,
             contents=gemini_messages,
             config=genai.types.GenerateContentConfig(
-                system_instruction=system_prompt,
-                tools=tools,
+                # The cached prefix already holds those
+                system_instruction=system_prompt if cache is None else None,
+                tools=tools if cache is None else None,
+                cached_content=cache,
                 automatic_function_calling=genai.types.AutomaticFunctionCallingConfig(disable=True),
             ),
         )
@@ -166,9 +250,10 @@ class GeminiAdapter(ModelAdapter):
             # FIXME find text part
             content=response.text if not response.function_calls else "",
             tool_calls=[ModelToolCall(name=a.name, arguments=a.args) for a in (response.function_calls or [])],
+            usage=GeminiAdapter._usage(response.usage_metadata),
         )
 
-    async def ask_structured(self, messages: list[ModelMessage], output: type[T]) -> T:
+    async def ask_structured(self, messages: list[ModelMessage], output: type[T], *, session: str | None = None) -> T:
         logger.debug(f"Model query: {messages}")
         (system_prompt, gemini_messages) = self._process_messages(messages)
 
@@ -185,6 +270,68 @@ class GeminiAdapter(ModelAdapter):
         logger.info(f"Model response: {response}")
         return output.model_validate_json(response.text)
 
+    async def _cached_prefix(self, system_prompt: str, tools: list[Callable]) -> str | None:
+        if self.cache_ttl is None or system_prompt == "":
+            return None
+        declarations = [
+            genai.types.FunctionDeclaration.from_callable_with_api_option(callable=a, api_option="GEMINI_API")
+            for a in tools
+        ]
+        key = hashlib.sha256(
+            "\n".join([system_prompt, *(a.model_dump_json() for a in declarations)]).encode()
+        ).hexdigest()
+
+        cached_tools = None if len(declarations) == 0 else [genai.types.Tool(function_declarations=declarations)]
+
+        # Checked under the lock too, the llamas waiting for it get the cache created by the first one
+        async with self._cache_locks.setdefault(key, asyncio.Lock()):
+            now = time.monotonic()
+            superseded = None
+            if key in self._caches:
+                cached = self._caches[key]
+                if cached is None:
+                    return None
+                (name, expires) = cached
+                if now < expires:
+                    return name
+                superseded = name
+
+            try:
+                cache = await self.client.caches.create(
+                    model=self.model,
+                    config=genai.types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        tools=cached_tools,
+                        ttl=f"{self.cache_ttl}s",
+                    ),
+                )
+            except genai.errors.APIError as e:
+                # Eg. a prefix below the model's minimal cached size, the implicit caching still applies
+                logger.warning(f"Prompt prefix not cached: {e}")
+                self._caches[key] = None
+                return None
+            # Renewed a bit early, so it doesn't expire in the middle of a request
+            self._caches[key] = (cache.name, now + self.cache_ttl * 0.9)
+
+        if superseded is not None:
+            # Billed for its storage until it expires otherwise
+            try:
+                await self.client.caches.delete(name=superseded)
+            except genai.errors.APIError as e:
+                logger.warning(f"Superseded prompt cache not deleted: {e}")
+        return cache.name
+
+    @staticmethod
+    def _usage(metadata: genai.types.GenerateContentResponseUsageMetadata | None) -> ModelUsage | None:
+        if metadata is None:
+            return None
+        cached = metadata.cached_content_token_count or 0
+        return ModelUsage(
+            prompt_eval_tokens=(metadata.prompt_token_count or 0) - cached,
+            cached_tokens=cached,
+            output_tokens=metadata.candidates_token_count or 0,
+        )
+
     def _process_messages(self, messages: list[ModelMessage]) -> Tuple[str, list]:
         system_prompt = ""
         contents = []
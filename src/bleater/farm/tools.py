@@ -1,91 +1,186 @@
-from bleater.models.posts import Post, Thread
+from bleater.models.pages import Page
+from bleater.models.posts import Post, PostSubmitRequest, SearchHit, Thread
+from bleater.models.sessions import Session
 from bleater import config
 from bleater.models.users import User, Notification
+from bleater.farm.transport import AsgiClient
 from pydantic import BaseModel, Field
+from typing import TypeAlias
 import aiohttp
 
+# Search hits returned to the model
+SEARCH_RESULTS = 5
+# Open connections to the server, shared by the whole herd
+HTTP_CONNECTION_LIMIT = 32
+# Seconds, covers the long-polled notifications (up to 60s)
+HTTP_TIMEOUT = 90
 
-async def register_user(name) -> User | None:
-    url = f"{_base_url()}/users/register"
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json={"name": name}) as response:
-            if response.status >= 300:
-                return None
-            body = await response.json()
-            user = User.model_validate(body)
-            return user
+# Real HTTP, or the app called in-process when the server runs next to the herd
+HttpClient: TypeAlias = aiohttp.ClientSession | AsgiClient
 
 
-async def get_feed() -> list[Post]:
-    url = f"{_base_url()}/posts/recent"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status >= 300:
-                return []
-            body = await response.json()
-            return [Post.model_validate(a) for a in body]
+def create_client(*, limit: int = HTTP_CONNECTION_LIMIT, timeout: float = HTTP_TIMEOUT) -> aiohttp.ClientSession:
+    """Client with a keep-alive connection pool, for all the requests to the server. Has to be closed."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    )
 
 
-async def get_notifications(user_id: str) -> list[Notification]:
-    url = f"{_base_url()}/users/notifications?user_id={user_id}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status >= 300:
-                return []
-            body = await response.json()
-            return [Notification.model_validate(a) for a in body]
+async def register_user(client: HttpClient, name) -> User | None:
+    url = f"{_base_url()}/users/register"
+    async with client.post(url, json={"name": name}) as response:
+        if response.status >= 300:
+            return None
+        body = await response.json()
+        user = User.model_validate(body)
+        return user
+
+
+async def get_feed(client: HttpClient) -> list[Post]:
+    url = f"{_base_url()}/posts/recent"
+    async with client.get(url) as response:
+        if response.status >= 300:
+            return []
+        body = await response.json()
+        return [Post.model_validate(a) for a in body]
 
 
-async def view_thread_tool(original_post_id: str) -> str:
+async def get_notifications(
+    client: HttpClient, user_id: str, *, ack: str | None = None, wait: float = 0
+) -> Page[Notification]:
+    """
+    Pending notifications. Pass `next_cursor` of the previous result as `ack`
+    once those were handled. With `wait` the call blocks until there is something new.
     """
-    View an existing thread by providing id of the original (starting) post.
+    url = f"{_base_url()}/users/notifications"
+    params: dict[str, str | float] = {"user_id": user_id, "wait": wait}
+    if ack is not None:
+        params["ack"] = ack
+    async with client.get(url, params=params) as response:
+        if response.status >= 300:
+            return Page(items=[])
+        body = await response.json()
+        return Page[Notification].model_validate(body)
+
+
+async def get_session(client: HttpClient, user_id: str, *, ack: str | None = None) -> Session:
     """
-    url = f"{_base_url()}/posts?post_id={original_post_id}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
+    Feed, pending notifications and the most relevant threads in a single request.
+    Pass `notifications.next_cursor` of the previous session as `ack`.
+    """
+    url = f"{_base_url()}/session"
+    params = {"user_id": user_id}
+    if ack is not None:
+        params["ack"] = ack
+    async with client.get(url, params=params) as response:
+        if response.status >= 300:
+            return Session(feed=[], notifications=Page(items=[]), threads=[])
+        body = await response.json()
+        return Session.model_validate(body)
+
+
+async def get_threads(client: HttpClient, ids: list[str]) -> list[Thread]:
+    """Fetch many threads in a single request"""
+    url = f"{_base_url()}/posts/batch-get"
+    async with client.post(url, json=ids) as response:
+        if response.status >= 300:
+            return []
+        body = await response.json()
+        return [Thread.model_validate(a) for a in body]
+
+
+async def submit_posts(client: HttpClient, posts: list[PostSubmitRequest]) -> list[Post]:
+    """Submit many posts in a single request"""
+    url = f"{_base_url()}/posts/batch"
+    async with client.post(url, json=[a.model_dump() for a in posts]) as response:
+        if response.status >= 300:
+            return []
+        body = await response.json()
+        return [Post.model_validate(a) for a in body]
+
+
+# The model facing tools are bound to the client, only their own params are shown to the model
+
+
+def create_view_thread_tool(client: HttpClient):
+    async def view_thread_tool(original_post_id: str) -> str:
+        """
+        View an existing thread by providing id of the original (starting) post.
+        """
+        url = f"{_base_url()}/posts?post_id={original_post_id}"
+        async with client.get(url) as response:
             if response.status >= 300:
                 return "Thread not found!"
             body = await response.json()
             thread = Thread.model_validate(body)
-            return _format_thread(thread)
+            return format_thread(thread)
+
+    return view_thread_tool
 
 
-def create_submit_post_tool(user_id: str):
+def create_search_posts_tool(client: HttpClient):
+    async def search_posts_tool(query: str) -> str:
+        """
+        Search posts and replies by their content. Returns the best matching ones.
+        """
+        url = f"{_base_url()}/search"
+        async with client.get(url, params={"q": query, "limit": SEARCH_RESULTS}) as response:
+            if response.status >= 300:
+                return "Search failed!"
+            body = await response.json()
+            hits = Page[SearchHit].model_validate(body)
+            if len(hits.items) == 0:
+                return "Nothing found"
+            return "\n".join(_format_hit(a) for a in hits.items)
+
+    return search_posts_tool
+
+
+def create_submit_post_tool(client: HttpClient, user_id: str):
     async def submit_post_tool(content: str) -> str:
         """
         Submit a new original post to start a thread.
         """
-        await _submit_post_request(user_id, content, None)
+        await _submit_post_request(client, user_id, content, None)
         return "Post created"
 
     return submit_post_tool
 
 
-def create_submit_reply_tool(user_id: str):
+def create_submit_reply_tool(client: HttpClient, user_id: str):
     async def submit_reply_tool(content: str, original_post_id: str) -> str:
         """
         Reply to a thread, by providing a reply message content and an id of the post you're replying to.
         """
-        await _submit_post_request(user_id, content, original_post_id)
+        await _submit_post_request(client, user_id, content, original_post_id)
         return "Reply posted"
 
     return submit_reply_tool
 
 
-async def _submit_post_request(user_id: str, content: str, parent_id: str | None):
+async def _submit_post_request(client: HttpClient, user_id: str, content: str, parent_id: str | None):
     url = f"{_base_url()}/posts"
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json={"user_id": user_id, "content": content, "parent_id": parent_id}) as response:
-            pass
+    async with client.post(url, json={"user_id": user_id, "content": content, "parent_id": parent_id}) as response:
+        pass
 
 
 def _base_url() -> str:
     return f"http://{config.SERVER_HOST}:{config.SERVER_PORT}/api"
 
 
-def _format_thread(thread: Thread) -> str:
+def _format_hit(hit: SearchHit) -> str:
+    # Replies point to their thread, so the result can be viewed right away
+    thread_id = hit.post.parent_id or hit.post.id
+    return f"  - {hit.post.user.name} wrote: `{hit.plain_snippet()}` [Original post id: {thread_id}]"
+
+
+def format_thread(thread: Thread) -> str:
     output = f"[Original post id: {thread.id}]\n{thread.root.user.name} wrote: `{thread.root.content}\n\n`"
 
+    if thread.prev_cursor is not None:
+        # Only the latest replies were fetched
+        output += "  - (older replies not shown, view the thread to see them)\n"
     for reply in thread.replies:
         output += f"  - {reply.user.name} replied: `{reply.content}`\n"
 
@@ -0,0 +1,144 @@
+import asyncio
+import json
+from logging import getLogger
+from typing import Any, Awaitable, Callable
+from urllib.parse import urlencode, urlsplit
+
+logger = getLogger(__name__)
+
+ASGIApp = Callable[[dict, Callable[[], Awaitable[dict]], Callable[[dict], Awaitable[None]]], Awaitable[None]]
+
+
+class AsgiResponse:
+    def __init__(self, status: int, headers: list[tuple[bytes, bytes]], body: bytes):
+        self.status = status
+        self.headers = {a.decode("latin-1"): b.decode("latin-1") for a, b in headers}
+        self.body = body
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self) -> str:
+        return self.body.decode()
+
+    async def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class AsgiClient:
+    """
+    Calls an ASGI app directly, when the server runs in the same process - no sockets or HTTP parsing.
+    Covers the part of `aiohttp.ClientSession` used by the farm tools, the host part of the urls is ignored.
+    Every request is limited to `timeout` seconds.
+    """
+
+    def __init__(self, app: ASGIApp, *, timeout: float | None = None):
+        self.app = app
+        self.timeout = timeout
+        self.closed = False
+
+    async def __aenter__(self) -> AsgiClient:
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        self.closed = True
+
+    def get(
+        self, url: str, *, params: dict[str, Any] | None = None, headers: dict[str, str] | None = None
+    ) -> _RequestContext:
+        return _RequestContext(self._request("GET", url, params, None, headers))
+
+    def post(
+        self,
+        url: str,
+        *,
+        params: dict[str, Any] | None = None,
+        json: Any = None,
+        headers: dict[str, str] | None = None,
+    ) -> _RequestContext:
+        return _RequestContext(self._request("POST", url, params, json, headers))
+
+    async def _request(
+        self, method: str, url: str, params: dict[str, Any] | None, data: Any, extra_headers: dict[str, str] | None
+    ) -> AsgiResponse:
+        if self.closed:
+            raise RuntimeError("Client is closed")
+        parts = urlsplit(url)
+        query = "&".join(a for a in (parts.query, urlencode(params or {})) if a != "")
+        body = b"" if data is None else json.dumps(data).encode()
+        headers = [(b"host", (parts.netloc or "localhost").encode()), (b"content-length", str(len(body)).encode())]
+        if data is not None:
+            headers.append((b"content-type", b"application/json"))
+        for name, value in (extra_headers or {}).items():
+            headers.append((name.lower().encode("latin-1"), value.encode("latin-1")))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": parts.path,
+            "raw_path": parts.path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("127.0.0.1", 0),
+        }
+
+        done = asyncio.Event()
+        sent = False
+
+        async def receive() -> dict:
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Like a client keeping the connection open until the response is there
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        status = None
+        response_headers: list[tuple[bytes, bytes]] = []
+        chunks: list[bytes] = []
+
+        async def send(message: dict):
+            nonlocal status, response_headers
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_headers = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        try:
+            async with asyncio.timeout(self.timeout):
+                await self.app(scope, receive, send)
+        except TimeoutError:
+            raise
+        except Exception:
+            # The server error middleware has sent the 500 already, the same as a real server would
+            if status is None:
+                raise
+            logger.exception(f"{method} {parts.path} failed")
+        finally:
+            done.set()
+
+        if status is None:
+            raise RuntimeError(f"{method} {parts.path} returned no response")
+        return AsgiResponse(status, response_headers, b"".join(chunks))
+
+
+class _RequestContext:
+    def __init__(self, request: Awaitable[AsgiResponse]):
+        self._request = request
+
+    async def __aenter__(self) -> AsgiResponse:
+        return await self._request
+
+    async def __aexit__(self, *args):
+        pass
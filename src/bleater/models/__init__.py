@@ -1,2 +1,4 @@
 from .posts import Post, Thread
 from .users import User
+from .pages import Cursor, InvalidCursorError, Page, PageRequest
+from .sessions import Session
@@ -0,0 +1,74 @@
+import base64
+import json
+from pydantic import BaseModel, ValidationError
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+# Sort key of a paginated item, eg. (timestamp, id) for posts
+Key = tuple[int | str, ...]
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+class Cursor(BaseModel):
+    """
+    Keyset position: the page continues after `key`,
+    or before it when `backwards` is set.
+    """
+
+    key: list[int | str]
+    backwards: bool = False
+
+    def encode(self) -> str:
+        raw = json.dumps([self.key, self.backwards], separators=(",", ":"))
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def decode(value: str) -> Cursor:
+        try:
+            (key, backwards) = json.loads(base64.urlsafe_b64decode(value.encode()))
+            return Cursor(key=key, backwards=backwards)
+        except (ValueError, TypeError, ValidationError) as e:
+            raise InvalidCursorError from e
+
+
+class PageRequest(BaseModel):
+    limit: int
+    cursor: Cursor | None = None
+
+    @property
+    def backwards(self) -> bool:
+        return self.cursor is not None and self.cursor.backwards
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: str | None = None
+    prev_cursor: str | None = None
+
+    @staticmethod
+    def build(items: list[T], request: PageRequest | None, key: Callable[[T], Key]) -> Page[T]:
+        """
+        Build a page from items fetched in the query direction, up to `limit + 1` of them
+        (the extra one only signals that there is more).
+        """
+        if request is None:
+            return Page(items=items)
+
+        has_more = len(items) > request.limit
+        items = items[: request.limit]
+        if request.backwards:
+            items.reverse()
+        if len(items) == 0:
+            return Page(items=items)
+
+        next_cursor = None
+        prev_cursor = None
+        if has_more or request.backwards:
+            next_cursor = Cursor(key=list(key(items[-1]))).encode()
+        if (has_more and request.backwards) or (request.cursor is not None and not request.backwards):
+            prev_cursor = Cursor(key=list(key(items[0])), backwards=True).encode()
+        return Page(items=items, next_cursor=next_cursor, prev_cursor=prev_cursor)
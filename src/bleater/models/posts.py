@@ -1,5 +1,15 @@
 from bleater.models.users import User
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+# Wrap the matched terms in the search snippets. Control characters (STX and ETX),
+# stripped from the snippets' text, so they only ever mark a match.
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+
+def strip_highlight(text: str) -> str:
+    """The text without the highlight markers"""
+    return text.replace(HIGHLIGHT_START, "").replace(HIGHLIGHT_END, "")
 
 
 class PostSubmitRequest(BaseModel):
@@ -18,8 +28,42 @@ class Post(BaseModel):
     timestamp: int
     replies: int | None
 
+    @staticmethod
+    def build(id: str, parent_id: str | None, content: str, timestamp: int, user: User, replies: int | None) -> Post:
+        """
+        Fast constructor for the storage rows. Validates a dict straight away,
+        skipping the keyword arguments handling of `__init__` (`user` is taken as it is).
+        """
+        return Post.__pydantic_validator__.validate_python(
+            {
+                "id": id,
+                "parent_id": parent_id,
+                "user": user,
+                "content": content,
+                "timestamp": timestamp,
+                "replies": replies,
+            }
+        )
+
 
 class Thread(BaseModel):
     id: str
     root: Post
     replies: list[Post]
+    # Set when the replies are paginated
+    next_cursor: str | None = None
+    prev_cursor: str | None = None
+
+
+class SearchHit(BaseModel):
+    post: Post
+    snippet: str = Field(
+        description=(
+            "Matching fragment of the content. The matched terms are wrapped in the \\u0002 and \\u0003 "
+            "control characters, the content's own ones are left out."
+        )
+    )
+
+    def plain_snippet(self) -> str:
+        """The snippet without the highlight markers"""
+        return strip_highlight(self.snippet)
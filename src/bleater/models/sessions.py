@@ -0,0 +1,14 @@
+from bleater.models.pages import Page
+from bleater.models.posts import Post, Thread
+from bleater.models.users import Notification
+from pydantic import BaseModel
+
+
+class Session(BaseModel):
+    """Everything an agent needs at the start of a session"""
+
+    feed: list[Post]
+    # Pending notifications, `next_cursor` acknowledges them
+    notifications: Page[Notification]
+    # Notified threads and the top of the feed, with their replies
+    threads: list[Thread]
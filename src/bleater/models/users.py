@@ -10,6 +10,15 @@ class User(BaseModel):
     name: str
 
 
+class NotificationRequest(BaseModel):
+    """Single recipient of a bulk notification"""
+
+    user_id: str
+    content: str
+    post_id: str
+    mentioned_user_id: str
+
+
 class Notification(BaseModel):
     id: str
     user_id: str
@@ -0,0 +1,110 @@
+from abc import ABC, abstractmethod
+from typing import Sequence
+
+# Optional, installed with the `fast` extra
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HOUR = 3600
+
+
+class FeedAlgorithm(ABC):
+    """
+    Feed ranking algorithm.
+    Scores whole candidate windows at once - with NumPy when it's installed,
+    with a plain Python loop otherwise.
+    """
+
+    @abstractmethod
+    def score_array(self, now: int, timestamps: np.ndarray, replies: np.ndarray) -> np.ndarray:
+        """Vectorized scores, higher is better"""
+
+    @abstractmethod
+    def score(self, now: int, timestamp: int, replies: int, oldest: int) -> float:
+        """Scalar fallback, must match `score_array`"""
+
+    def rank(
+        self, now: int, timestamps: Sequence[int] | np.ndarray, replies: Sequence[int] | np.ndarray, count: int
+    ) -> list[int]:
+        """
+        Return indexes of the `count` best candidates, best first.
+        Ties keep the candidate order.
+        """
+        if len(timestamps) == 0 or count <= 0:
+            return []
+
+        if np is None:
+            oldest = min(timestamps)
+            scores = [self.score(now, t, r, oldest) for t, r in zip(timestamps, replies)]
+            order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+            return order[:count]
+
+        scores = self.score_array(now, np.asarray(timestamps, dtype=np.int64), np.asarray(replies, dtype=np.int64))
+        if count < len(scores):
+            # Narrow down to everything scoring at least as high as the count-th best,
+            # then sort stable to keep the ties in order
+            threshold = np.partition(scores, len(scores) - count)[len(scores) - count]
+            candidates = np.flatnonzero(scores >= threshold)
+        else:
+            candidates = np.arange(len(scores))
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return order[:count].tolist()
+
+
+class RecencyRepliesAlgorithm(FeedAlgorithm):
+    """
+    The original Bleater feed: recency relative to the candidate window span plus the reply count.
+    """
+
+    def score_array(self, now: int, timestamps: np.ndarray, replies: np.ndarray) -> np.ndarray:
+        ts_span = now - timestamps.min()
+        td = now - timestamps
+        tw = np.where(td > 0, ts_span // np.maximum(td, 1), ts_span)
+        return tw + replies
+
+    def score(self, now: int, timestamp: int, replies: int, oldest: int) -> float:
+        # We assume it's never 0 ;)
+        ts_span = now - oldest
+        td = now - timestamp
+        if td > 0:
+            tw = ts_span // td
+        else:
+            tw = ts_span
+        return tw + replies
+
+
+class GravityAlgorithm(FeedAlgorithm):
+    """
+    Hacker News style decay: (replies + 1) / (age_hours + 2) ^ gravity
+    """
+
+    def __init__(self, *, gravity: float = 1.8):
+        self.gravity = gravity
+
+    def score_array(self, now: int, timestamps: np.ndarray, replies: np.ndarray) -> np.ndarray:
+        age = np.maximum(now - timestamps, 0) / HOUR
+        return (replies + 1) / (age + 2) ** self.gravity
+
+    def score(self, now: int, timestamp: int, replies: int, oldest: int) -> float:
+        age = max(now - timestamp, 0) / HOUR
+        return (replies + 1) / (age + 2) ** self.gravity
+
+
+class ReplyVelocityAlgorithm(FeedAlgorithm):
+    """
+    Replies per hour since the post was created.
+    `min_age` (seconds) keeps brand new posts with a single reply from jumping to the top.
+    """
+
+    def __init__(self, *, min_age: int = 5 * 60):
+        self.min_age = min_age
+
+    def score_array(self, now: int, timestamps: np.ndarray, replies: np.ndarray) -> np.ndarray:
+        age = np.maximum(now - timestamps, self.min_age) / HOUR
+        return replies / age
+
+    def score(self, now: int, timestamp: int, replies: int, oldest: int) -> float:
+        age = max(now - timestamp, self.min_age) / HOUR
+        return replies / age
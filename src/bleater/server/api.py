@@ -1,14 +1,39 @@
+import asyncio
 import datetime
-from fastapi import APIRouter, Depends, Body, HTTPException
-from typing import Annotated
+from fastapi import APIRouter, Depends, Body, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from typing import Annotated, AsyncIterator
 
-from bleater.server.feed import get_feed, notify_thread
-from bleater.models.posts import PostSubmitRequest, Post, Thread
+from bleater.server.cache import ResponseCache, get_response_cache
+from bleater.server.feed import FeedEngine, get_feed_engine, thread_notifications
+from bleater.server.hub import FEED_CHANNEL, Hub, get_hub, user_channel
+from bleater.models.pages import Cursor, Page
+from bleater.models.posts import PostSubmitRequest, Post, SearchHit, Thread
+from bleater.models.sessions import Session
+from bleater.server.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, page_request
+from bleater.server.responses import ModelResponse
+from bleater.server.search import MAX_QUERY_LENGTH
 from bleater.server.storage import BaseStorage, get_storage
 from bleater.models.users import User, UserRegisterRequest, Notification
 
 router = APIRouter(prefix="/api")
 
+POST_LIST = TypeAdapter(list[Post])
+# Seconds between keepalive comments of an idle event stream
+STREAM_KEEPALIVE = 15
+NOTIFICATION_LIMIT = 10
+# Longest long-poll of the notifications, in seconds
+MAX_NOTIFICATION_WAIT = 60
+# Most items in a single batch request
+MAX_BATCH_SIZE = 100
+# Most threads in a single batch fetch, each comes with up to a page of replies
+MAX_BATCH_THREADS = 20
+# Feed posts with threads expanded in a session bootstrap
+SESSION_EXPAND = 3
+# Latest replies of each expanded thread. The session goes to the llamas' prompt prefix, which is never evicted.
+SESSION_REPLIES = 5
+
 
 @router.get("/")
 async def api_root():
@@ -26,50 +51,293 @@ async def user_register(
     return user
 
 
-@router.get("/users/notifications")
+@router.get("/users", response_model=Page[User])
+async def user_list(
+    request: Request,
+    storage: Annotated[BaseStorage, Depends(get_storage)],
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = MAX_PAGE_SIZE,
+    cursor: str | None = None,
+) -> Response:
+    async def render() -> bytes:
+        users = await storage.get_users(page_request(limit, cursor))
+        return users.model_dump_json().encode()
+
+    return await cache.respond_json(request, storage.version, render)
+
+
+@router.get("/users/posts", response_model=Page[Post])
+async def user_posts(
+    request: Request,
+    user_id: str,
+    storage: Annotated[BaseStorage, Depends(get_storage)],
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = MAX_PAGE_SIZE,
+    cursor: str | None = None,
+) -> Response:
+    async def render() -> bytes:
+        posts = await storage.get_user_posts(user_id, page_request(limit, cursor))
+        return posts.model_dump_json().encode()
+
+    return await cache.respond_json(request, storage.version, render)
+
+
+@router.get("/users/notifications", response_model=Page[Notification])
 async def user_notifications(
     user_id: str,
     storage: Annotated[BaseStorage, Depends(get_storage)],
-) -> list[Notification]:
-    notifications = await storage.get_user_notifications(user_id, 10)
-    await storage.purge_user_notifications(user_id)
-    return notifications
+    hub: Annotated[Hub, Depends(get_hub)],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = NOTIFICATION_LIMIT,
+    ack: str | None = None,
+    wait: Annotated[float, Query(ge=0, le=MAX_NOTIFICATION_WAIT)] = 0,
+) -> Response:
+    """
+    Pending notifications, oldest first. They are kept until acknowledged
+    by passing `next_cursor` of the response as `ack` of the next call.
+    With `wait` (seconds) the request is held until there is a notification to return.
+    """
+    ack_cursor = None if ack is None else Cursor.decode(ack)
+    # Subscribe before draining, so nothing published in between is missed
+    with hub.subscribe([user_channel(user_id)]) as subscription:
+        notifications = await storage.drain_user_notifications(user_id, limit, ack_cursor)
+        if len(notifications.items) > 0 or wait == 0:
+            return ModelResponse(notifications)
+        try:
+            await asyncio.wait_for(subscription.get(), wait)
+        except TimeoutError:
+            return ModelResponse(notifications)
+    # Already acknowledged by the first drain
+    return ModelResponse(await storage.drain_user_notifications(user_id, limit))
+
+
+@router.get("/search", response_model=Page[SearchHit])
+async def search(
+    request: Request,
+    q: Annotated[str, Query(max_length=MAX_QUERY_LENGTH)],
+    storage: Annotated[BaseStorage, Depends(get_storage)],
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    cursor: str | None = None,
+) -> Response:
+    """Posts and replies containing all the words of `q`, best matches first"""
+
+    async def render() -> bytes:
+        hits = await storage.search_posts(q, page_request(limit, cursor))
+        return hits.model_dump_json().encode()
+
+    return await cache.respond_json(request, storage.version, render)
+
+
+@router.get("/session", response_model=Session)
+async def session(
+    user_id: str,
+    storage: Annotated[BaseStorage, Depends(get_storage)],
+    feed: Annotated[FeedEngine, Depends(get_feed_engine)],
+    expand: Annotated[int, Query(ge=0, le=MAX_BATCH_THREADS)] = SESSION_EXPAND,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = NOTIFICATION_LIMIT,
+    replies: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = SESSION_REPLIES,
+    ack: str | None = None,
+) -> Response:
+    """
+    Agent session bootstrap in a single call: the feed, pending notifications
+    (acknowledged the same way as with `/users/notifications`) and the threads
+    of the notified posts and of the top `expand` feed posts, with their latest `replies` replies
+    (`prev_cursor` of a thread pages back to the older ones).
+    """
+    ack_cursor = None if ack is None else Cursor.decode(ack)
+    session = await storage.get_session(
+        user_id, feed.get_feed(), expand=expand, notification_limit=limit, replies=replies, ack=ack_cursor
+    )
+    return ModelResponse(session)
 
 
 @router.post("/posts")
 async def submit_post(
     body: PostSubmitRequest,
     storage: Annotated[BaseStorage, Depends(get_storage)],
+    feed: Annotated[FeedEngine, Depends(get_feed_engine)],
+    hub: Annotated[Hub, Depends(get_hub)],
 ) -> None:
     ts = int(datetime.datetime.now().timestamp())
 
+    requests = []
     if body.parent_id is not None:
-        # Check if the parent is not a reply itself
-        parent = await storage.get_post(body.parent_id)
-        if parent is None:
+        roots = await _thread_roots([body.parent_id], storage)
+        if body.parent_id not in roots:
             raise HTTPException(400)
-        if parent.parent_id is not None:
-            body.parent_id = parent.parent_id
+        parent = roots[body.parent_id]
+        body.parent_id = parent.id
+        requests = await thread_notifications(parent, body.user_id, storage)
+
+    post = await storage.submit_post(body, ts)
+    # Only once the reply is stored, so they never point at a missing post
+    notifications = await storage.notify_many(requests, ts) if len(requests) > 0 else []
+    feed.add_post(post)
+    hub.publish_post(post)
+    hub.publish_notifications(notifications)
+
 
-        # Notify relevant users
-        await notify_thread(parent.id, ts, body.user_id, storage)
+@router.post("/posts/batch", response_model=list[Post])
+async def submit_posts(
+    body: Annotated[list[PostSubmitRequest], Body(max_length=MAX_BATCH_SIZE)],
+    storage: Annotated[BaseStorage, Depends(get_storage)],
+    feed: Annotated[FeedEngine, Depends(get_feed_engine)],
+    hub: Annotated[Hub, Depends(get_hub)],
+) -> Response:
+    """Submit many posts in one go. Nothing is stored if any of the parents is missing."""
+    ts = int(datetime.datetime.now().timestamp())
 
-    await storage.submit_post(body, ts)
+    roots = await _thread_roots([a.parent_id for a in body if a.parent_id is not None], storage)
+    if any(a.parent_id is not None and a.parent_id not in roots for a in body):
+        raise HTTPException(400)
 
+    # One group per reply, each keeps the first notification per recipient
+    requests = []
+    for a in body:
+        if a.parent_id is None:
+            continue
+        parent = roots[a.parent_id]
+        a.parent_id = parent.id
+        requests.append(await thread_notifications(parent, a.user_id, storage))
 
-@router.get("/posts")
+    posts = await storage.submit_posts(body, ts)
+    # Only once the posts are stored, a failed batch leaves no notifications behind
+    notifications = []
+    for group in requests:
+        if len(group) > 0:
+            notifications.extend(await storage.notify_many(group, ts))
+    for post in posts:
+        feed.add_post(post)
+        hub.publish_post(post)
+    hub.publish_notifications(notifications)
+    return ModelResponse(posts)
+
+
+@router.post("/posts/batch-get", response_model=list[Thread])
+async def get_threads(
+    body: Annotated[list[str], Body(max_length=MAX_BATCH_THREADS)],
+    storage: Annotated[BaseStorage, Depends(get_storage)],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+) -> Response:
+    """
+    Many threads by their root post ids, with the latest `limit` replies each.
+    `prev_cursor` of a thread pages back to the older replies (as `cursor` of `/posts`). Missing ones are skipped.
+    """
+    return ModelResponse(await storage.get_threads(body, limit))
+
+
+@router.get("/posts", response_model=Thread)
 async def get_thread(
+    request: Request,
     post_id: str,
     storage: Annotated[BaseStorage, Depends(get_storage)],
-) -> Thread:
-    thread = await storage.get_thread(post_id)
-    if thread is None:
-        raise HTTPException(400)
-    return thread
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = MAX_PAGE_SIZE,
+    cursor: str | None = None,
+) -> Response:
+    async def render() -> bytes:
+        thread = await storage.get_thread(post_id, page_request(limit, cursor))
+        if thread is None:
+            raise HTTPException(400)
+        return thread.model_dump_json().encode()
+
+    return await cache.respond_json(request, storage.version, render)
 
 
-@router.get("/posts/recent")
+@router.get("/posts/recent", response_model=list[Post])
 async def recent_posts(
+    request: Request,
+    feed: Annotated[FeedEngine, Depends(get_feed_engine)],
     storage: Annotated[BaseStorage, Depends(get_storage)],
-) -> list[Post]:
-    return await get_feed(storage)
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+) -> Response:
+    # The ranking also moves with the clock
+    now = int(datetime.datetime.now().timestamp())
+
+    async def render() -> bytes:
+        return POST_LIST.dump_json(feed.get_feed(now))
+
+    return await cache.respond_json(request, (storage.version, now), render)
+
+
+@router.get("/stream")
+async def stream(
+    hub: Annotated[Hub, Depends(get_hub)],
+    user_id: str | None = None,
+    feed: bool = True,
+) -> StreamingResponse:
+    """
+    Server-Sent Events: `post` events of the feed channel
+    and `notification` events of the given user.
+    """
+    channels = _stream_channels(user_id, feed)
+
+    async def events() -> AsyncIterator[str]:
+        with hub.subscribe(channels) as subscription:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), STREAM_KEEPALIVE)
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield event.sse()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.websocket("/ws")
+async def websocket_stream(
+    websocket: WebSocket,
+    hub: Annotated[Hub, Depends(get_hub)],
+    user_id: str | None = None,
+    feed: bool = True,
+):
+    """Same events as `/api/stream`, sent as `{"type": ..., "data": ...}` JSON messages"""
+    await websocket.accept()
+    with hub.subscribe(_stream_channels(user_id, feed)) as subscription:
+
+        async def receive():
+            # Nothing is expected from the client, just wait for it to leave
+            try:
+                while (await websocket.receive())["type"] != "websocket.disconnect":
+                    pass
+            finally:
+                subscription.close()
+
+        receiver = asyncio.create_task(receive())
+        try:
+            while (event := await subscription.get()) is not None:
+                await websocket.send_text(event.json())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            receiver.cancel()
+
+
+async def _thread_roots(parent_ids: list[str], storage: BaseStorage) -> dict[str, Post]:
+    """
+    Map parent ids to the thread roots - there are no nested threads, so replies to replies
+    go to the thread of the parent. Missing parents are left out.
+    """
+    parents = await storage.get_posts(parent_ids)
+    nested = {a.parent_id for a in parents if a.parent_id is not None}
+    roots = {a.id: a for a in await storage.get_posts(list(nested))}
+
+    result = {}
+    for parent in parents:
+        if parent.parent_id is None:
+            result[parent.id] = parent
+        elif parent.parent_id in roots:
+            result[parent.id] = roots[parent.parent_id]
+    return result
+
+
+def _stream_channels(user_id: str | None, feed: bool) -> list[str]:
+    channels = []
+    if feed:
+        channels.append(FEED_CHANNEL)
+    if user_id is not None:
+        channels.append(user_channel(user_id))
+    return channels
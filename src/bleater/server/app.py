@@ -1,33 +1,197 @@
+import asyncio
 from bleater import config
-from bleater.server.storage import BaseStorageBuilder, get_storage
+from bleater.models import InvalidCursorError, Post
+from bleater.models.users import Notification
+from bleater.server.algorithms import FeedAlgorithm
+from bleater.server.cache import DEFAULT_CACHE_SIZE, ResponseCache, get_response_cache
+from bleater.server.feed import FEED_WINDOW, FeedEngine, get_feed_engine
+from bleater.server.hub import DEFAULT_BUFFER_SIZE, FEED_CHANNEL, Event, Hub, get_hub, user_channel
+from bleater.server.metrics import Metrics, MetricsMiddleware, get_metrics, instrument_storage
+from bleater.server.pagination import invalid_cursor_handler
+from bleater.server.storage import BaseStorageBuilder, get_storage, storage_session
+from bleater.server.workers import ARCHIVED_EVENT, Broker, PeerLink, WriteRelayMiddleware
 from fastapi import FastAPI
+import json
+import multiprocessing
+import socket
 import uvicorn
 
 from .api import router as api_router
+from .metrics import router as metrics_router
 from .views import router as views_router
 
+# Seconds to wait for the open connections when stopping
+SHUTDOWN_TIMEOUT = 5
+
 
 class BleaterServer:
-    def __init__(self, storage: BaseStorageBuilder):
+    """
+    With `workers` above 1 the server runs in that many processes, sharing the listening socket.
+    The storage has to support it (see `BaseStorageBuilder.worker`), the in-memory one doesn't.
+    """
+
+    def __init__(
+        self,
+        storage: BaseStorageBuilder,
+        *,
+        feed_algorithm: FeedAlgorithm | None = None,
+        feed_window: int = FEED_WINDOW,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        stream_buffer_size: int = DEFAULT_BUFFER_SIZE,
+        workers: int = config.SERVER_WORKERS,
+    ):
+        if workers < 1:
+            raise ValueError("At least one worker is required")
         self.app = None
         self.storage = storage
+        self.workers = workers
+        self.feed = FeedEngine(algorithm=feed_algorithm, window=feed_window)
+        self.cache = ResponseCache(size=cache_size)
+        self.hub = Hub(buffer_size=stream_buffer_size)
+        self.metrics = Metrics()
 
-    async def _build(self):
+    async def create_app(self) -> FastAPI:
+        """Build the storage and the app around it"""
         app = FastAPI()
-        app.dependency_overrides[get_storage] = await self.storage.build()
+        storage_getter = await self.storage.build()
+        app.dependency_overrides[get_storage] = instrument_storage(storage_getter, self.metrics)
+        self.metrics.pools = self.storage.pools()
+
+        async with storage_session(storage_getter) as storage:
+            await self.feed.load(storage)
+        for archiver in self.storage.archivers():
+            archiver.on_archived = self.feed.remove_posts
+
+        async def get_server_feed_engine() -> FeedEngine:
+            return self.feed
+
+        app.dependency_overrides[get_feed_engine] = get_server_feed_engine
+
+        async def get_server_response_cache() -> ResponseCache:
+            return self.cache
+
+        app.dependency_overrides[get_response_cache] = get_server_response_cache
+
+        async def get_server_hub() -> Hub:
+            return self.hub
+
+        app.dependency_overrides[get_hub] = get_server_hub
+
+        async def get_server_metrics() -> Metrics:
+            return self.metrics
+
+        app.dependency_overrides[get_metrics] = get_server_metrics
+
+        app.add_exception_handler(InvalidCursorError, invalid_cursor_handler)
+        app.add_middleware(MetricsMiddleware, metrics=self.metrics)
 
         app.include_router(views_router)
         app.include_router(api_router)
+        app.include_router(metrics_router)
 
         self.app = app
+        return app
 
     async def serve(self):
-        await self._build()
-        assert self.app is not None
+        if self.workers > 1:
+            await self._serve_workers()
+            return
 
-        server_config = uvicorn.Config(self.app, port=config.SERVER_PORT, host=config.SERVER_BIND_ADDR)
-        server = uvicorn.Server(server_config)
+        app = await self.create_app()
+        server = uvicorn.Server(self._uvicorn_config(app))
         try:
             await server.serve()
         finally:
+            self.hub.close()
             await self.storage.close()
+
+    async def _serve_workers(self):
+        # Fail early, before anything is started
+        worker = self._worker()
+        # Migrations run once, before any worker opens the storage
+        await self.storage.build()
+        broker = Broker()
+        await broker.start()
+        # The storage is archived here, the workers' feeds have to drop the archived threads
+        link = await PeerLink.connect(broker.path)
+        for archiver in self.storage.archivers():
+            archiver.on_archived = lambda ids: link.send(Event(ARCHIVED_EVENT, json.dumps(ids)))
+        sock = self._uvicorn_config(None).bind_socket()
+
+        context = multiprocessing.get_context("spawn")
+        processes = []
+        try:
+            for i in range(self.workers):
+                process = context.Process(
+                    target=_run_worker, args=(worker, sock, broker.path), name=f"bleater-worker-{i}"
+                )
+                process.start()
+                processes.append(process)
+            await asyncio.gather(*(asyncio.to_thread(a.join) for a in processes))
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                await asyncio.to_thread(process.join)
+            sock.close()
+            await link.close()
+            await broker.close()
+            await self.storage.close()
+
+    async def _serve_worker(self, sock: socket.socket, broker_path: str):
+        (app, link, listener) = await self._join_workers(broker_path)
+        server = uvicorn.Server(self._uvicorn_config(app))
+        try:
+            await server.serve(sockets=[sock])
+        finally:
+            listener.cancel()
+            await link.close()
+            self.hub.close()
+            await self.storage.close()
+
+    async def _join_workers(self, broker_path: str) -> tuple[FastAPI, PeerLink, asyncio.Task]:
+        """Build the app of a worker process, exchanging the activity with the other workers over the broker"""
+        app = await self.create_app()
+        link = await PeerLink.connect(broker_path)
+        self.hub.relay = link.send
+        app.add_middleware(WriteRelayMiddleware, link=link)
+        listener = asyncio.create_task(link.listen(self._on_peer_event))
+        return (app, link, listener)
+
+    def _on_peer_event(self, event: Event):
+        """Activity of another worker process"""
+        # The local storage version doesn't see the other workers' writes
+        self.cache.invalidate()
+        if event.type == "post":
+            self.feed.add_post(Post.model_validate_json(event.data))
+            self.hub.publish(FEED_CHANNEL, event)
+        elif event.type == "notification":
+            notification = Notification.model_validate_json(event.data)
+            self.hub.publish(user_channel(notification.user_id), event)
+        elif event.type == ARCHIVED_EVENT:
+            self.feed.remove_posts(json.loads(event.data))
+
+    def _worker(self) -> BleaterServer:
+        """Unstarted copy of the server for a worker process"""
+        return BleaterServer(
+            self.storage.worker(),
+            feed_algorithm=self.feed.algorithm,
+            feed_window=self.feed.window,
+            cache_size=self.cache.size,
+            stream_buffer_size=self.hub.buffer_size,
+            workers=1,
+        )
+
+    def _uvicorn_config(self, app: FastAPI | None) -> uvicorn.Config:
+        # The event streams never end on their own, don't wait for them forever on shutdown
+        return uvicorn.Config(
+            app,
+            port=config.SERVER_PORT,
+            host=config.SERVER_BIND_ADDR,
+            timeout_graceful_shutdown=SHUTDOWN_TIMEOUT,
+        )
+
+
+def _run_worker(server: BleaterServer, sock: socket.socket, broker_path: str):
+    asyncio.run(server._serve_worker(sock, broker_path))
@@ -0,0 +1,211 @@
+import asyncio
+import aiosqlite
+from dataclasses import dataclass
+from logging import getLogger
+from bleater.server.migrations import ARCHIVE_MIGRATIONS_DIR, load_migrations, migrate
+from bleater.server.pool import SqlitePool
+import sqlite3
+import time
+from typing import Callable
+
+logger = getLogger(__name__)
+
+# Schema name of the attached archive database
+ARCHIVE_SCHEMA = "archive"
+ARCHIVED_POST_TABLE = f"{ARCHIVE_SCHEMA}.post"
+ARCHIVED_NOTIFICATION_TABLE = f"{ARCHIVE_SCHEMA}.notification"
+# The archive file sits next to the live one, like the sqlite's own `-wal` and `-shm` files
+ARCHIVE_SUFFIX = "-archive"
+
+POST_COLUMNS = "id, parent_id, user_id, content, timestamp, reply_count"
+NOTIFICATION_COLUMNS = "seq, id, user_id, post_id, content, mentioned_user_id, timestamp"
+
+
+@dataclass
+class ArchivePolicy:
+    """
+    What gets moved to the archive database. Ages are in seconds, `None` keeps the data live.
+    Threads move as a whole, once none of their posts is newer than `thread_age`.
+    Only the acknowledged notifications older than `notification_age` move, the pending ones
+    are always read from the live table. Without `notification_age` they are deleted once acknowledged.
+    The archiver runs every `interval` seconds, `batch_size` threads or notifications per transaction.
+    """
+
+    thread_age: int | None = 7 * 24 * 3600
+    notification_age: int | None = 24 * 3600
+    interval: float = 60
+    batch_size: int = 100
+
+    def __post_init__(self):
+        if self.batch_size < 1:
+            raise ValueError("Archive batch size has to be positive")
+        if self.interval <= 0:
+            raise ValueError("Archive interval has to be positive")
+
+
+class Archiver:
+    """
+    Background job moving the old data of the pool's live database to the attached archive.
+
+    Every batch is copied first and only then deleted from the live database, in a separate transaction:
+    sqlite commits the attached WAL databases one by one, so a crash in between a single transaction
+    could lose the rows. The reads prefer the live copy, so a row left in both places is harmless
+    (and gets replaced once archived again).
+    Between the batches the writer is free for the requests.
+    """
+
+    def __init__(self, pool: SqlitePool, policy: ArchivePolicy):
+        self.pool = pool
+        self.policy = policy
+        # Called with the root ids of every batch of archived threads, eg. to drop them from the feed
+        self.on_archived: Callable[[list[str]], None] | None = None
+        self._task: asyncio.Task | None = None
+        self._stopped = asyncio.Event()
+
+    def start(self):
+        if self._task is None:
+            self._stopped.clear()
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._stopped.set()
+            await self._task
+            self._task = None
+
+    async def run(self, now: int | None = None) -> tuple[int, int]:
+        """Archive everything due at `now`. Returns the numbers of the archived threads and notifications."""
+        if now is None:
+            now = int(time.time())
+        threads = 0
+        if self.policy.thread_age is not None:
+            threads = await self._drain(self._archive_threads, now - self.policy.thread_age)
+        notifications = 0
+        if self.policy.notification_age is not None:
+            notifications = await self._drain(self._archive_notifications, now - self.policy.notification_age)
+        return (threads, notifications)
+
+    async def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                (threads, notifications) = await self.run()
+                if threads > 0 or notifications > 0:
+                    logger.info(f"Archived {threads} threads and {notifications} notifications")
+            except sqlite3.Error as e:
+                # Eg. the database locked by another process, there is always the next run
+                logger.warning(f"Archiving failed: {e}")
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.policy.interval)
+            except TimeoutError:
+                pass
+
+    async def _drain(self, archive, cutoff: int) -> int:
+        total = 0
+        while not self._stopped.is_set():
+            count = await archive(cutoff)
+            total += count
+            if count < self.policy.batch_size:
+                break
+        return total
+
+    async def _archive_threads(self, cutoff: int) -> int:
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                f"SELECT p.id FROM main.post p WHERE p.parent_id IS NULL AND p.timestamp < ? AND {_IDLE} "
+                "ORDER BY p.timestamp LIMIT ?",
+                [cutoff, cutoff, self.policy.batch_size],
+            )
+            ids = [row[0] for row in await cursor.fetchall()]
+        if len(ids) == 0:
+            return 0
+
+        placeholders = _placeholders(ids)
+        async with self.pool.exclusive() as db:
+            for condition in ("id", "parent_id"):
+                await db.execute(
+                    f"INSERT OR REPLACE INTO {ARCHIVED_POST_TABLE} ({POST_COLUMNS}) "
+                    f"SELECT {POST_COLUMNS} FROM main.post WHERE {condition} IN ({placeholders})",
+                    ids,
+                )
+
+        async with self.pool.exclusive() as db:
+            # Threads replied to since they were selected stay live
+            cursor = await db.execute(
+                f"SELECT p.id FROM main.post p WHERE p.id IN ({placeholders}) AND {_IDLE}",
+                [*ids, cutoff],
+            )
+            idle = [row[0] for row in await cursor.fetchall()]
+            if len(idle) > 0:
+                # The search index and reply count triggers handle the deletes
+                for condition in ("parent_id", "id"):
+                    await db.execute(f"DELETE FROM main.post WHERE {condition} IN ({_placeholders(idle)})", idle)
+            active = list(set(ids) - set(idle))
+            if len(active) > 0:
+                await _delete_archived_threads(db, active)
+        if len(idle) > 0 and self.on_archived is not None:
+            self.on_archived(idle)
+        return len(ids)
+
+    async def _archive_notifications(self, cutoff: int) -> int:
+        async with self.pool.reader() as db:
+            # The pending ones stay, so the drains never have to look into the archive
+            cursor = await db.execute(
+                "SELECT n.seq FROM main.notification n JOIN main.notification_ack a ON a.user_id = n.user_id "
+                "WHERE n.timestamp < ? AND n.seq <= a.seq ORDER BY n.timestamp LIMIT ?",
+                [cutoff, self.policy.batch_size],
+            )
+            seqs = [row[0] for row in await cursor.fetchall()]
+        if len(seqs) == 0:
+            return 0
+
+        placeholders = _placeholders(seqs)
+        async with self.pool.exclusive() as db:
+            await db.execute(
+                f"INSERT OR REPLACE INTO {ARCHIVED_NOTIFICATION_TABLE} ({NOTIFICATION_COLUMNS}) "
+                f"SELECT {NOTIFICATION_COLUMNS} FROM main.notification WHERE seq IN ({placeholders})",
+                seqs,
+            )
+        async with self.pool.exclusive() as db:
+            await db.execute(f"DELETE FROM main.notification WHERE seq IN ({placeholders})", seqs)
+        return len(seqs)
+
+
+async def init_archive(path: str):
+    """Create or migrate the archive database, before it is attached"""
+    async with aiosqlite.connect(path) as db:
+        await migrate(db, load_migrations(ARCHIVE_MIGRATIONS_DIR))
+
+
+async def restore_threads(db: aiosqlite.Connection, ids: list[str]):
+    """Move the archived threads (by their root ids) back to the live database, eg. when replied to"""
+    ids = list(dict.fromkeys(ids))
+    if len(ids) == 0:
+        return
+    cursor = await db.execute(f"SELECT id FROM {ARCHIVED_POST_TABLE} WHERE id IN ({_placeholders(ids)})", ids)
+    archived = [row[0] for row in await cursor.fetchall()]
+    if len(archived) == 0:
+        return
+
+    placeholders = _placeholders(archived)
+    # Replies first - the reply count trigger would count them again for a root that is already there
+    for condition in ("parent_id", "id"):
+        await db.execute(
+            f"INSERT OR IGNORE INTO main.post ({POST_COLUMNS}) "
+            f"SELECT {POST_COLUMNS} FROM {ARCHIVED_POST_TABLE} WHERE {condition} IN ({placeholders})",
+            archived,
+        )
+    await _delete_archived_threads(db, archived)
+
+
+async def _delete_archived_threads(db: aiosqlite.Connection, ids: list[str]):
+    placeholders = _placeholders(ids)
+    await db.execute(f"DELETE FROM {ARCHIVED_POST_TABLE} WHERE parent_id IN ({placeholders})", ids)
+    await db.execute(f"DELETE FROM {ARCHIVED_POST_TABLE} WHERE id IN ({placeholders})", ids)
+
+
+# No replies since the cutoff (the param), for a thread root `p`
+_IDLE = "NOT EXISTS (SELECT 1 FROM main.post r WHERE r.parent_id = p.id AND r.timestamp >= ?)"
+
+
+def _placeholders(values: list) -> str:
+    return ", ".join("?" for _ in values)
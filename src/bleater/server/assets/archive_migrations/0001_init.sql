@@ -0,0 +1,24 @@
+-- Same columns as the live tables. No foreign keys, the users stay in the live database.
+CREATE TABLE IF NOT EXISTS post (
+    id TEXT PRIMARY KEY,
+    parent_id TEXT,
+    user_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp INT NOT NULL,
+    reply_count INT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS post_parent_timestamp_id ON post (parent_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS post_user_timestamp_id ON post (user_id, timestamp, id);
+
+CREATE TABLE IF NOT EXISTS notification (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    mentioned_user_id TEXT NOT NULL,
+    timestamp INT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS notification_user_timestamp_id ON notification (user_id, timestamp, id);
@@ -0,0 +1,23 @@
+-- Denormalized reply counter, maintained by triggers
+ALTER TABLE post ADD COLUMN reply_count INT NOT NULL DEFAULT 0;
+
+UPDATE post
+SET reply_count = (SELECT count(*) FROM post r WHERE r.parent_id = post.id)
+WHERE parent_id IS NULL;
+
+CREATE TRIGGER IF NOT EXISTS post_reply_count_insert AFTER INSERT ON post
+WHEN NEW.parent_id IS NOT NULL
+BEGIN
+    UPDATE post SET reply_count = reply_count + 1 WHERE id = NEW.parent_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_reply_count_delete AFTER DELETE ON post
+WHEN OLD.parent_id IS NOT NULL
+BEGIN
+    UPDATE post SET reply_count = reply_count - 1 WHERE id = OLD.parent_id;
+END;
+
+-- Also serves root post listing (parent_id IS NULL ORDER BY timestamp)
+CREATE INDEX IF NOT EXISTS post_parent_timestamp ON post (parent_id, timestamp);
+CREATE INDEX IF NOT EXISTS post_user_timestamp ON post (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS notification_user_timestamp ON notification (user_id, timestamp);
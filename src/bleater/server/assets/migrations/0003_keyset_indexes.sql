@@ -0,0 +1,8 @@
+-- Keyset pagination orders by (timestamp, id), keep both in the indexes
+DROP INDEX IF EXISTS post_parent_timestamp;
+DROP INDEX IF EXISTS post_user_timestamp;
+DROP INDEX IF EXISTS notification_user_timestamp;
+
+CREATE INDEX IF NOT EXISTS post_parent_timestamp_id ON post (parent_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS post_user_timestamp_id ON post (user_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS notification_user_timestamp_id ON notification (user_id, timestamp, id);
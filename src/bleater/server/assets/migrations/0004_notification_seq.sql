@@ -0,0 +1,23 @@
+-- Monotonic sequence for acknowledging drained notifications.
+-- AUTOINCREMENT, so the numbers are never reused even after the newest rows are deleted.
+CREATE TABLE notification_seq (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    mentioned_user_id TEXT NOT NULL,
+    timestamp INT NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES user (id),
+    FOREIGN KEY (post_id) REFERENCES message (id),
+    FOREIGN KEY (mentioned_user_id) REFERENCES user (id)
+);
+
+INSERT INTO notification_seq (id, user_id, post_id, content, mentioned_user_id, timestamp)
+SELECT id, user_id, post_id, content, mentioned_user_id, timestamp FROM notification ORDER BY timestamp, id;
+
+DROP TABLE notification;
+ALTER TABLE notification_seq RENAME TO notification;
+
+CREATE INDEX IF NOT EXISTS notification_user_timestamp_id ON notification (user_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS notification_user_seq ON notification (user_id, seq);
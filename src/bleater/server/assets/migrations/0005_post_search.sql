@@ -0,0 +1,72 @@
+-- Stable integer key for the full-text index. The implicit rowid of a table with a TEXT primary key
+-- can be renumbered by VACUUM, `seq` is an INTEGER PRIMARY KEY - an alias of the rowid, which VACUUM keeps.
+CREATE TABLE post_seq (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    parent_id TEXT,
+    user_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp INT NOT NULL,
+    reply_count INT NOT NULL DEFAULT 0,
+    FOREIGN KEY (parent_id) REFERENCES message (id),
+    FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+INSERT INTO post_seq (id, parent_id, user_id, content, timestamp, reply_count)
+SELECT id, parent_id, user_id, content, timestamp, reply_count FROM post ORDER BY rowid;
+
+-- Takes its indexes and triggers along
+DROP TABLE post;
+ALTER TABLE post_seq RENAME TO post;
+
+CREATE INDEX IF NOT EXISTS post_parent_timestamp_id ON post (parent_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS post_user_timestamp_id ON post (user_id, timestamp, id);
+
+CREATE TRIGGER IF NOT EXISTS post_reply_count_insert AFTER INSERT ON post
+WHEN NEW.parent_id IS NOT NULL
+BEGIN
+    UPDATE post SET reply_count = reply_count + 1 WHERE id = NEW.parent_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_reply_count_delete AFTER DELETE ON post
+WHEN OLD.parent_id IS NOT NULL
+BEGIN
+    UPDATE post SET reply_count = reply_count - 1 WHERE id = OLD.parent_id;
+END;
+
+-- The search snippets mark the matched terms with \x02 and \x03 (see `bleater.models.posts`),
+-- so the index reads the contents through a view with those two stripped
+CREATE VIEW IF NOT EXISTS post_search_content AS
+SELECT seq, replace(replace(content, char(2), ''), char(3), '') AS content FROM post;
+
+-- Full-text index of the post contents (external content, the text is only stored in `post`)
+CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(
+    content,
+    content = 'post_search_content',
+    content_rowid = 'seq',
+    tokenize = 'porter unicode61 remove_diacritics 2'
+);
+
+-- Backfill
+INSERT INTO post_search (post_search) VALUES ('rebuild');
+
+-- The same text as the view, the deletes have to match what was indexed
+CREATE TRIGGER IF NOT EXISTS post_search_insert AFTER INSERT ON post
+BEGIN
+    INSERT INTO post_search (rowid, content)
+    VALUES (NEW.seq, replace(replace(NEW.content, char(2), ''), char(3), ''));
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_search_delete AFTER DELETE ON post
+BEGIN
+    INSERT INTO post_search (post_search, rowid, content)
+    VALUES ('delete', OLD.seq, replace(replace(OLD.content, char(2), ''), char(3), ''));
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_search_update AFTER UPDATE OF content ON post
+BEGIN
+    INSERT INTO post_search (post_search, rowid, content)
+    VALUES ('delete', OLD.seq, replace(replace(OLD.content, char(2), ''), char(3), ''));
+    INSERT INTO post_search (rowid, content)
+    VALUES (NEW.seq, replace(replace(NEW.content, char(2), ''), char(3), ''));
+END;
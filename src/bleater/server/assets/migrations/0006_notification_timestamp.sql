@@ -0,0 +1,2 @@
+-- Finds the notifications old enough to be archived
+CREATE INDEX IF NOT EXISTS notification_timestamp ON notification (timestamp);
@@ -0,0 +1,7 @@
+-- Last acknowledged notification of every user. With the archive enabled the acknowledged notifications
+-- are kept until archived, instead of deleted right away.
+CREATE TABLE IF NOT EXISTS notification_ack (
+    user_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES user (id)
+);
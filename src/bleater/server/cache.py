@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+import hashlib
+from typing import AsyncIterator, Awaitable, Callable, Hashable
+from urllib.parse import urlencode
+import uuid
+
+DEFAULT_CACHE_SIZE = 256
+
+
+async def get_response_cache() -> ResponseCache:
+    raise NotImplementedError
+
+
+@dataclass
+class _Entry:
+    version: Hashable
+    body: bytes
+
+
+class ResponseCache:
+    """
+    LRU cache of rendered GET responses, keyed by the route path and query params.
+
+    An entry is only valid for the `version` it was rendered at - the storage version,
+    plus anything else the response depends on (eg. the clock for the feed).
+    The strong ETags are derived from the version as well, so conditional requests
+    are answered with 304 without touching the storage or the cached body.
+
+    The versions are counted by each process, so the ETags include a per-process epoch as well.
+    With multiple workers a conditional request only gets a 304 from the worker that issued the ETag,
+    the others send the full response.
+    """
+
+    def __init__(self, *, size: int = DEFAULT_CACHE_SIZE):
+        self.size = size
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        # Bumped on writes the storage version doesn't reflect (eg. from other worker processes)
+        self._generation = 0
+        # Versions start over with the process, keep the tags from matching across restarts
+        self._epoch = uuid.uuid4().hex
+
+    async def respond(
+        self,
+        request: Request,
+        version: Hashable,
+        render: Callable[[], Awaitable[AsyncIterator[str]]],
+        media_type: str,
+    ) -> Response:
+        """
+        Serve from the cache or stream a freshly rendered response, keeping its body.
+        `render` is only awaited on a miss, before the response starts, so it can still raise HTTPExceptions.
+        """
+        version = (self._generation, version)
+        (response, key, headers) = self._lookup(request, version, media_type)
+        if response is not None:
+            return response
+        chunks = await render()
+        return StreamingResponse(self._store(key, version, chunks), media_type=media_type, headers=headers)
+
+    async def respond_json(
+        self,
+        request: Request,
+        version: Hashable,
+        render: Callable[[], Awaitable[bytes]],
+    ) -> Response:
+        """Same as `respond`, for small bodies that are rendered whole"""
+        media_type = "application/json"
+        version = (self._generation, version)
+        (response, key, headers) = self._lookup(request, version, media_type)
+        if response is not None:
+            return response
+        body = await render()
+        self._put(key, version, body)
+        return Response(body, media_type=media_type, headers=headers)
+
+    def clear(self):
+        self._entries.clear()
+
+    def invalidate(self):
+        """Expire all the entries and their ETags"""
+        self._generation += 1
+        self._entries.clear()
+
+    def _lookup(self, request: Request, version: Hashable, media_type: str) -> tuple[Response | None, str, dict]:
+        key = _cache_key(request)
+        etag = self._etag(key, version)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return (Response(status_code=304, headers=headers), key, headers)
+
+        entry = self._entries.get(key)
+        if entry is not None and entry.version == version:
+            self._entries.move_to_end(key)
+            return (Response(entry.body, media_type=media_type, headers=headers), key, headers)
+        return (None, key, headers)
+
+    async def _store(self, key: str, version: Hashable, chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+        # Pass the chunks through, the body is only kept when the whole response was sent
+        body = []
+        async for chunk in chunks:
+            data = chunk.encode()
+            body.append(data)
+            yield data
+        self._put(key, version, b"".join(body))
+
+    def _put(self, key: str, version: Hashable, body: bytes):
+        if self.size <= 0:
+            return
+        self._entries[key] = _Entry(version=version, body=body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _etag(self, key: str, version: Hashable) -> str:
+        # Each URL gets its own tags - they are matched before the resource is rendered (or found)
+        digest = hashlib.blake2b(f"{self._epoch}:{key}:{version!r}".encode(), digest_size=12).hexdigest()
+        return f'"{digest}"'
+
+
+def _cache_key(request: Request) -> str:
+    return request.url.path + "?" + urlencode(sorted(request.query_params.multi_items()))
+
+
+def _etag_matches(header: str | None, etag: str) -> bool:
+    if header is None:
+        return False
+    # `*` is not supported, the 304 is sent before it's known whether the resource exists
+    for tag in header.split(","):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison
+        if tag.removeprefix("W/") == etag:
+            return True
+    return False
+
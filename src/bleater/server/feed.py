@@ -1,45 +1,188 @@
+import bisect
 from bleater.models.posts import Post
+from bleater.models.users import NotificationRequest
+from bleater.server.algorithms import FeedAlgorithm, RecencyRepliesAlgorithm, np
 from bleater.server.storage import BaseStorage
 import datetime
 
-# TODO allow different feed algorithms
+# Number of most recent top-level posts considered by the ranking
+FEED_WINDOW = 500
+FEED_SIZE = 10
 
 
-async def get_feed(storage: BaseStorage) -> list[Post]:
-    ts = int(datetime.datetime.now().timestamp())
-    recent = await storage.get_last_posts(500)
-    if len(recent) == 0:
-        return []
+async def get_feed_engine() -> FeedEngine:
+    raise NotImplementedError
 
-    earliest = recent[-1].timestamp
-    ts_span = ts - earliest
 
-    weighted = [(_post_weight(ts, post, ts_span), Post) for post in recent]
-    recent.sort(key=lambda a: _post_weight(ts, a, ts_span), reverse=True)
-    return recent[:10]
+async def get_feed(storage: BaseStorage, algorithm: FeedAlgorithm | None = None, now: int | None = None) -> list[Post]:
+    """Reference implementation, ranks straight from the storage."""
+    if algorithm is None:
+        algorithm = RecencyRepliesAlgorithm()
+    ts = int(datetime.datetime.now().timestamp()) if now is None else now
+    recent = await storage.get_last_posts(FEED_WINDOW)
 
+    order = algorithm.rank(ts, [a.timestamp for a in recent], [a.replies or 0 for a in recent], FEED_SIZE)
+    return [recent[i] for i in order]
 
-def _post_weight(now: int, post: Post, ts_span: int) -> int:
-    # We assume it's never 0 ;)
-    td = now - post.timestamp
-    if td > 0:
-        tw = ts_span // td
-    else:
-        tw = ts_span
-    return tw + (post.replies or 0)
 
+class FeedEngine:
+    """
+    Keeps the ranking window in memory and updates it on every submitted post,
+    so reading the feed does not touch the storage.
+    Produces the same results as `get_feed`.
+    """
 
-async def notify_thread(post_id: str, ts: int, mentioned_user_id: str, storage: BaseStorage):
-    thread = await storage.get_thread(post_id)
-    if thread is None:
-        return
+    def __init__(
+        self, *, algorithm: FeedAlgorithm | None = None, window: int = FEED_WINDOW, size: int = FEED_SIZE
+    ):
+        if algorithm is None:
+            algorithm = RecencyRepliesAlgorithm()
+        self.algorithm = algorithm
+        self.window = window
+        self.size = size
+        # Oldest first by (timestamp, id) - the storage order, with the ranking inputs kept alongside
+        self._posts: list[Post] = []
+        self._timestamps: list[int] = []
+        self._replies: list[int] = []
+        # Post id -> absolute position, `_offset` is the absolute position of `_posts[0]`
+        self._by_id: dict[str, int] = {}
+        self._offset = 0
+        # Newest first ranking inputs, converted once and kept until a new root arrives
+        self._arrays: tuple[list[int] | np.ndarray, list[int] | np.ndarray] | None = None
+        self._version = 0
+        self._cached: tuple[int, int, list[Post]] | None = None
 
-    if thread.root.user.id != mentioned_user_id:
-        await storage.notify(thread.root.user.id, "New reply in your thread.", post_id, mentioned_user_id, ts)
+    async def load(self, storage: BaseStorage):
+        recent = await storage.get_last_posts(self.window)
+        self._posts = list(reversed(recent))
+        self._reindex()
 
-    for reply in thread.replies:
-        if reply.user.id == mentioned_user_id:
+    def add_post(self, post: Post):
+        if post.parent_id is None:
+            self._add_root(post)
+        else:
+            self._add_reply(post)
+
+    def remove_posts(self, ids: list[str]):
+        """
+        Drop the roots gone from the live storage, eg. the archived threads.
+        The window isn't refilled from the older posts - the archived threads are the idle ones anyway.
+        """
+        removed = {a for a in ids if a in self._by_id}
+        if len(removed) == 0:
+            return
+        self._posts = [a for a in self._posts if a.id not in removed]
+        self._reindex()
+        self._version += 1
+
+    def get_feed(self, now: int | None = None) -> list[Post]:
+        if now is None:
+            now = int(datetime.datetime.now().timestamp())
+
+        # Weights only change with new posts or with the clock
+        if self._cached is not None and self._cached[0] == now and self._cached[1] == self._version:
+            return list(self._cached[2])
+
+        feed = self._rank(now)
+        self._cached = (now, self._version, feed)
+        return list(feed)
+
+    def _rank(self, now: int) -> list[Post]:
+        # Rank newest first, so ties keep the same order as the storage query
+        (timestamps, replies) = self._ranking_arrays()
+        last = len(self._posts) - 1
+        order = self.algorithm.rank(now, timestamps, replies, self.size)
+        return [self._posts[last - i] for i in order]
+
+    def _ranking_arrays(self) -> tuple[list[int] | np.ndarray, list[int] | np.ndarray]:
+        if self._arrays is None:
+            timestamps = self._timestamps[::-1]
+            replies = self._replies[::-1]
+            if np is not None:
+                self._arrays = (np.array(timestamps, dtype=np.int64), np.array(replies, dtype=np.int64))
+            else:
+                self._arrays = (timestamps, replies)
+        return self._arrays
+
+    def _add_root(self, post: Post):
+        if len(self._posts) == 0 or _post_key(post) >= _post_key(self._posts[-1]):
+            self._by_id[post.id] = self._offset + len(self._posts)
+            self._posts.append(post)
+            self._timestamps.append(post.timestamp)
+            self._replies.append(post.replies or 0)
+        else:
+            # A lower id within the same second (or a clock change), usually close to the end,
+            # so only the few posts after it move
+            idx = bisect.bisect_right(self._posts, _post_key(post), key=_post_key)
+            self._posts.insert(idx, post)
+            self._timestamps.insert(idx, post.timestamp)
+            self._replies.insert(idx, post.replies or 0)
+            for i in range(idx, len(self._posts)):
+                self._by_id[self._posts[i].id] = self._offset + i
+
+        overflow = len(self._posts) - self.window
+        if overflow > 0:
+            for a in self._posts[:overflow]:
+                del self._by_id[a.id]
+            del self._posts[:overflow]
+            del self._timestamps[:overflow]
+            del self._replies[:overflow]
+            self._offset += overflow
+        self._arrays = None
+        self._version += 1
+
+    def _add_reply(self, post: Post):
+        position = self._by_id.get(post.parent_id or "")
+        if position is None:
+            # Parent is out of the ranking window
+            return
+        idx = position - self._offset
+        parent = self._posts[idx]
+        self._posts[idx] = parent.model_copy(update={"replies": (parent.replies or 0) + 1})
+        self._replies[idx] += 1
+        if self._arrays is not None:
+            self._arrays[1][len(self._posts) - 1 - idx] += 1
+        self._version += 1
+
+    def _reindex(self):
+        self._arrays = None
+        self._offset = 0
+        self._by_id = {a.id: i for i, a in enumerate(self._posts)}
+        self._timestamps = [a.timestamp for a in self._posts]
+        self._replies = [a.replies or 0 for a in self._posts]
+
+
+def _post_key(post: Post) -> tuple[int, str]:
+    # Timestamps are whole seconds, the ids break the ties like in the storage queries
+    return (post.timestamp, post.id)
+
+
+async def thread_notifications(root: Post, mentioned_user_id: str, storage: BaseStorage) -> list[NotificationRequest]:
+    """
+    Notifications for a new reply in the thread, to be passed to `notify_many` once the reply is stored.
+    The root author is listed first, so they keep the more specific message.
+    """
+    notifications = []
+    if root.user.id is not None and root.user.id != mentioned_user_id:
+        notifications.append(
+            NotificationRequest(
+                user_id=root.user.id,
+                content="New reply in your thread.",
+                post_id=root.id,
+                mentioned_user_id=mentioned_user_id,
+            )
+        )
+
+    for user_id in await storage.get_thread_user_ids(root.id):
+        if user_id == mentioned_user_id:
             continue
-        await storage.notify(
-            reply.user.id, "New reply in a thread you've also replied to.", post_id, mentioned_user_id, ts
+        notifications.append(
+            NotificationRequest(
+                user_id=user_id,
+                content="New reply in a thread you've also replied to.",
+                post_id=root.id,
+                mentioned_user_id=mentioned_user_id,
+            )
         )
+
+    return notifications
@@ -0,0 +1,125 @@
+import asyncio
+from bleater.models import Post
+from bleater.models.users import Notification
+from contextlib import contextmanager
+from dataclasses import dataclass
+import json
+from typing import Callable, Iterator
+
+# Every submitted post (top-level and replies)
+FEED_CHANNEL = "feed"
+# Events kept per subscriber before the oldest ones are dropped
+DEFAULT_BUFFER_SIZE = 64
+
+
+async def get_hub() -> Hub:
+    raise NotImplementedError
+
+
+def user_channel(user_id: str) -> str:
+    """Notifications of a single user"""
+    return f"user:{user_id}"
+
+
+@dataclass(frozen=True)
+class Event:
+    type: str
+    # Serialized once and shared by all the subscribers
+    data: str
+
+    def sse(self) -> str:
+        return f"event: {self.type}\ndata: {self.data}\n\n"
+
+    def json(self) -> str:
+        return f'{{"type":"{self.type}","data":{self.data}}}'
+
+
+class Subscription:
+    """
+    Bounded event buffer of a single client.
+    When the client can't keep up the oldest events are dropped, so publishing never waits.
+    """
+
+    def __init__(self, channels: list[str], buffer_size: int):
+        self.channels = channels
+        self.dropped = 0
+        self.closed = False
+        self._queue: asyncio.Queue[Event | None] = asyncio.Queue(maxsize=buffer_size)
+
+    def put(self, event: Event | None):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(event)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # Wake up the consumer
+            self.put(None)
+
+    async def get(self) -> Event | None:
+        """Next event, None once the subscription is closed"""
+        if self.dropped > 0:
+            # Let the client know it missed something and should refetch
+            event = Event("dropped", json.dumps({"count": self.dropped}))
+            self.dropped = 0
+            return event
+        if self.closed and self._queue.empty():
+            return None
+        return await self._queue.get()
+
+
+class Hub:
+    """In-process publish / subscribe of the server activity"""
+
+    def __init__(self, *, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        if buffer_size < 1:
+            raise ValueError("Buffer size has to be positive")
+        self.buffer_size = buffer_size
+        self._channels: dict[str, set[Subscription]] = {}
+        # Forwards the local activity to the other worker processes
+        self.relay: Callable[[Event], None] | None = None
+
+    @contextmanager
+    def subscribe(self, channels: list[str]) -> Iterator[Subscription]:
+        subscription = Subscription(channels, self.buffer_size)
+        for channel in channels:
+            self._channels.setdefault(channel, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscription.close()
+            for channel in channels:
+                subscribers = self._channels.get(channel)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if len(subscribers) == 0:
+                    del self._channels[channel]
+
+    def publish(self, channel: str, event: Event):
+        for subscription in self._channels.get(channel, ()):
+            subscription.put(event)
+
+    def publish_post(self, post: Post):
+        if FEED_CHANNEL in self._channels or self.relay is not None:
+            event = Event("post", post.model_dump_json())
+            self.publish(FEED_CHANNEL, event)
+            if self.relay is not None:
+                self.relay(event)
+
+    def publish_notifications(self, notifications: list[Notification]):
+        for notification in notifications:
+            channel = user_channel(notification.user_id)
+            if channel in self._channels or self.relay is not None:
+                event = Event("notification", notification.model_dump_json())
+                self.publish(channel, event)
+                if self.relay is not None:
+                    self.relay(event)
+
+    def close(self):
+        """End all the subscriptions"""
+        for subscribers in self._channels.values():
+            for subscription in subscribers:
+                subscription.close()
@@ -0,0 +1,337 @@
+import aiosqlite
+import bisect
+import heapq
+from bleater.models import Cursor, InvalidCursorError, Page, PageRequest, Post, Thread, User
+from bleater.models.posts import PostSubmitRequest, SearchHit
+from bleater.models.users import Notification, NotificationRequest
+from bleater.server.migrations import migrate
+from bleater.server.search import WORD_RE, offset_page, page_offset, search_terms, snippet
+from bleater.server.storage import (
+    BaseStorage,
+    BaseStorageBuilder,
+    StorageResult,
+    latest_replies,
+    notification_ack_seq,
+)
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Callable
+import uuid
+
+logger = getLogger(__name__)
+
+
+class InMemoryStorageBuilder(BaseStorageBuilder):
+    """
+    Non-durable storage for fast simulation runs.
+    When `snapshot_path` is given, the data is written to a sqlite database on close.
+    """
+
+    def __init__(self, *, snapshot_path: str | None = None):
+        self.snapshot_path = snapshot_path
+        self.storage = InMemoryStorage()
+
+    async def build(self) -> Callable[[], StorageResult]:
+        async def get_memory_storage() -> StorageResult:
+            return self.storage
+
+        return get_memory_storage
+
+    async def close(self):
+        if self.snapshot_path is not None:
+            await self.storage.snapshot(self.snapshot_path)
+
+
+@dataclass
+class _PostRecord:
+    id: str
+    parent_id: str | None
+    user_id: str
+    content: str
+    timestamp: int
+    replies: int = 0
+
+
+@dataclass
+class _NotificationRecord:
+    id: str
+    user_id: str
+    content: str
+    post_id: str
+    mentioned_user_id: str
+    timestamp: int
+    # Acknowledgement order, never reused
+    seq: int
+
+
+class InMemoryStorage(BaseStorage):
+    """
+    Storage kept in indexed python structures.
+    All the ordered indexes are sorted by (timestamp, id) ascending (oldest first).
+    """
+
+    def __init__(self):
+        self.users: dict[str, User] = {}
+        self.user_names: set[str] = set()
+        self.users_by_name: list[User] = []
+        self.posts: dict[str, _PostRecord] = {}
+        self.roots: list[_PostRecord] = []
+        self.replies: dict[str, list[_PostRecord]] = {}
+        self.user_posts: dict[str, list[_PostRecord]] = {}
+        self.notifications: dict[str, list[_NotificationRecord]] = {}
+        # Search term -> ids of the posts containing it
+        self.search_index: dict[str, set[str]] = {}
+        self._version = 0
+        self._notification_seq = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    async def register_user(self, name: str) -> User | None:
+        if name in self.user_names:
+            return None
+        user = User(id=str(uuid.uuid4()), name=name)
+        self.users[user.id] = user
+        self.user_names.add(name)
+        bisect.insort(self.users_by_name, user, key=_user_key)
+        self._version += 1
+        return user
+
+    async def get_user(self, id: str) -> User | None:
+        return self.users.get(id)
+
+    async def get_users(self, page: PageRequest | None = None) -> Page[User]:
+        users = _slice(self.users_by_name, page, _user_key, 1, descending=False)
+        return Page.build(users, page, _user_key)
+
+    async def submit_post(self, post: PostSubmitRequest, timestamp: int) -> Post:
+        record = _PostRecord(
+            id=str(uuid.uuid4()),
+            parent_id=post.parent_id,
+            user_id=post.user_id,
+            content=post.content,
+            timestamp=timestamp,
+        )
+        self.posts[record.id] = record
+        _insert(self.user_posts.setdefault(record.user_id, []), record)
+        for term in search_terms(record.content):
+            self.search_index.setdefault(term, set()).add(record.id)
+
+        if record.parent_id is None:
+            _insert(self.roots, record)
+        else:
+            _insert(self.replies.setdefault(record.parent_id, []), record)
+            parent = self.posts.get(record.parent_id)
+            if parent is not None:
+                parent.replies += 1
+
+        self._version += 1
+        return self._post(record)
+
+    async def submit_posts(self, posts: list[PostSubmitRequest], timestamp: int) -> list[Post]:
+        return [await self.submit_post(a, timestamp) for a in posts]
+
+    async def get_post(self, id: str) -> Post | None:
+        record = self.posts.get(id)
+        if record is not None:
+            return self._post(record)
+
+    async def get_posts(self, ids: list[str]) -> list[Post]:
+        return [self._post(self.posts[a]) for a in dict.fromkeys(ids) if a in self.posts]
+
+    async def get_thread(self, id: str, page: PageRequest | None = None) -> Thread | None:
+        root = self.posts.get(id)
+        if root is None:
+            return None
+        records = _slice(self.replies.get(id, []), page, _record_key, 2, descending=False)
+        replies = Page.build([self._post(a) for a in records], page, _record_key)
+        return Thread(
+            id=id,
+            root=self._post(root),
+            replies=replies.items,
+            next_cursor=replies.next_cursor,
+            prev_cursor=replies.prev_cursor,
+        )
+
+    async def get_threads(self, ids: list[str], limit: int) -> list[Thread]:
+        threads = []
+        for id in dict.fromkeys(ids):
+            root = self.posts.get(id)
+            if root is not None:
+                records = self.replies.get(id, [])[-(limit + 1) :]
+                threads.append(latest_replies(self._post(root), [self._post(a) for a in records], limit))
+        return threads
+
+    async def get_last_posts(self, count: int) -> list[Post]:
+        return [self._post(a) for a in _newest(self.roots, count)]
+
+    async def get_user_posts(self, user_id: str, page: PageRequest | None = None) -> Page[Post]:
+        records = _slice(self.user_posts.get(user_id, []), page, _record_key, 2, descending=True)
+        return Page.build([self._post(a) for a in records], page, _record_key)
+
+    async def search_posts(self, query: str, page: PageRequest) -> Page[SearchHit]:
+        offset = page_offset(page)
+        terms = search_terms(query)
+        if len(terms) == 0:
+            return Page(items=[])
+
+        matches = sorted((self.search_index.get(a, set()) for a in terms), key=len)
+        ids = set.intersection(*matches)
+
+        # Simpler than bm25: most occurrences of the terms first, then the newest
+        def rank(record: _PostRecord) -> tuple[int, int, str]:
+            words = WORD_RE.findall(record.content.casefold())
+            return (-sum(words.count(a) for a in terms), -record.timestamp, record.id)
+
+        records = sorted((self.posts[a] for a in ids), key=rank)[offset : offset + page.limit + 1]
+        hits = [SearchHit(post=self._post(a), snippet=snippet(a.content, set(terms))) for a in records]
+        return offset_page(hits, page, offset)
+
+    async def get_thread_user_ids(self, id: str) -> list[str]:
+        return list(dict.fromkeys(a.user_id for a in self.replies.get(id, [])))
+
+    async def notify(self, user_id: str, content: str, post_id: str, mentioned_user_id: str, timestamp: int) -> None:
+        self._notify(user_id, content, post_id, mentioned_user_id, timestamp)
+
+    async def notify_many(self, notifications: list[NotificationRequest], timestamp: int) -> list[Notification]:
+        created = {}
+        for a in notifications:
+            if a.user_id in created:
+                continue
+            record = self._notify(a.user_id, a.content, a.post_id, a.mentioned_user_id, timestamp)
+            created[a.user_id] = self._notification(record)
+        return list(created.values())
+
+    async def get_user_notifications(self, user_id: str, page: PageRequest) -> Page[Notification]:
+        records = _slice(self.notifications.get(user_id, []), page, _record_key, 2, descending=True)
+        return Page.build([self._notification(a) for a in records], page, _record_key)
+
+    async def drain_user_notifications(self, user_id: str, limit: int, ack: Cursor | None = None) -> Page[Notification]:
+        acked = notification_ack_seq(ack)
+        records = self.notifications.get(user_id, [])
+        if acked is not None and any(a.seq <= acked for a in records):
+            records = [a for a in records if a.seq > acked]
+            self.notifications[user_id] = records
+            self._version += 1
+
+        pending = heapq.nsmallest(limit, records, key=lambda a: a.seq)
+        if len(pending) == 0:
+            return Page(items=[])
+        return Page(
+            items=[self._notification(a) for a in pending],
+            next_cursor=Cursor(key=[pending[-1].seq]).encode(),
+        )
+
+    async def purge_user_notifications(self, user_id: str) -> None:
+        if self.notifications.pop(user_id, None) is not None:
+            self._version += 1
+
+    async def snapshot(self, path: str):
+        """Write all the data into a new sqlite database"""
+        logger.info(f"Writing storage snapshot to {path}")
+        async with aiosqlite.connect(path) as db:
+            await migrate(db)
+            await db.executemany(
+                "INSERT INTO user (id, name) VALUES (?, ?)",
+                [[a.id, a.name] for a in self.users.values()],
+            )
+            # Roots go first, the reply counters are maintained by the triggers
+            posts = sorted(self.posts.values(), key=lambda a: a.parent_id is not None)
+            await db.executemany(
+                "INSERT INTO post (id, parent_id, user_id, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [[a.id, a.parent_id, a.user_id, a.content, a.timestamp] for a in posts],
+            )
+            await db.executemany(
+                (
+                    "INSERT INTO notification (seq, id, user_id, post_id, content, mentioned_user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)"
+                ),
+                [
+                    [a.seq, a.id, a.user_id, a.post_id, a.content, a.mentioned_user_id, a.timestamp]
+                    for records in self.notifications.values()
+                    for a in records
+                ],
+            )
+            await db.commit()
+
+    def _notify(
+        self, user_id: str, content: str, post_id: str, mentioned_user_id: str, timestamp: int
+    ) -> _NotificationRecord:
+        record = _NotificationRecord(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            content=content,
+            post_id=post_id,
+            mentioned_user_id=mentioned_user_id,
+            timestamp=timestamp,
+            seq=self._notification_seq + 1,
+        )
+        self._notification_seq = record.seq
+        _insert(self.notifications.setdefault(user_id, []), record)
+        self._version += 1
+        return record
+
+    def _post(self, record: _PostRecord) -> Post:
+        return Post.build(
+            record.id, record.parent_id, record.content, record.timestamp, self._user(record.user_id), record.replies
+        )
+
+    def _notification(self, record: _NotificationRecord) -> Notification:
+        return Notification(
+            id=record.id,
+            user_id=record.user_id,
+            content=record.content,
+            post_id=record.post_id,
+            timestamp=record.timestamp,
+            mentioned_user=self._user(record.mentioned_user_id),
+        )
+
+    def _user(self, id: str) -> User:
+        user = self.users.get(id)
+        if user is None:
+            return User(id=id, name="<unknown>")
+        return user
+
+
+def _insert(records: list, record):
+    if len(records) == 0 or _record_key(record) >= _record_key(records[-1]):
+        records.append(record)
+    else:
+        bisect.insort_right(records, record, key=_record_key)
+
+
+def _newest(records: list, count: int) -> list:
+    if count <= 0:
+        return []
+    return records[: -count - 1 : -1]
+
+
+def _slice(records: list, page: PageRequest | None, key: Callable, key_length: int, *, descending: bool) -> list:
+    """
+    Keyset pagination over records sorted ascending by `key`, a tuple of `key_length` values.
+    Returns up to `limit + 1` records in the query direction, as expected by `Page.build`.
+    """
+    if page is None:
+        return records[::-1] if descending else list(records)
+    # A shorter key would still compare, the same as in the sqlite storage it's invalid
+    if page.cursor is not None and len(page.cursor.key) != key_length:
+        raise InvalidCursorError
+
+    query_descending = descending != page.backwards
+    count = page.limit + 1
+    try:
+        if query_descending:
+            end = len(records) if page.cursor is None else bisect.bisect_left(records, tuple(page.cursor.key), key=key)
+            return records[max(end - count, 0) : end][::-1]
+        start = 0 if page.cursor is None else bisect.bisect_right(records, tuple(page.cursor.key), key=key)
+        return records[start : start + count]
+    except TypeError as e:
+        raise InvalidCursorError from e
+
+
+def _record_key(record) -> tuple[int, str]:
+    return (record.timestamp, record.id)
+
+
+def _user_key(user: User) -> tuple[str]:
+    return (user.name,)
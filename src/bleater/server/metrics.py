@@ -0,0 +1,264 @@
+import bisect
+from bleater.models import Page, Session, Thread
+from bleater.server.pool import SqlitePool
+from bleater.server.storage import BaseStorage, StorageResult, storage_session
+from fastapi import APIRouter, Depends, Response
+from typing import Annotated, Any, AsyncIterator, Callable, Iterable
+import time
+
+# Seconds, from a cached response to a slow sqlite write
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Path label of the requests not matching any route, keeps the label set bounded
+UNMATCHED_ROUTE = "<unmatched>"
+PROMETHEUS_TEXT = "text/plain; version=0.0.4; charset=utf-8"
+
+router = APIRouter()
+
+
+async def get_metrics() -> Metrics:
+    raise NotImplementedError
+
+
+class Histogram:
+    """Prometheus style histogram with fixed buckets, cheap enough to observe on every call"""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Per bucket, not cumulative - that's only computed for the export
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def export(self, name: str, labels: str) -> Iterable[str]:
+        separator = "," if labels else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class Metrics:
+    """
+    Server metrics, kept in plain dicts - the server is a single event loop, there is nothing to lock.
+    In the multi worker mode every process has its own.
+    """
+
+    def __init__(self):
+        self.http_in_flight = 0
+        # (method, route) -> latency
+        self.http_latency: dict[tuple[str, str], Histogram] = {}
+        # (method, route, status) -> count
+        self.http_responses: dict[tuple[str, str, int], int] = {}
+        self.storage_in_flight: dict[str, int] = {}
+        self.storage_latency: dict[str, Histogram] = {}
+        self.storage_rows: dict[str, int] = {}
+        self.storage_errors: dict[str, int] = {}
+        # Connection pools of the storage, their stats are read on export
+        self.pools: list[SqlitePool] = []
+
+    def observe_request(self, method: str, route: str, status: int, duration: float):
+        key = (method, route)
+        histogram = self.http_latency.get(key)
+        if histogram is None:
+            histogram = self.http_latency[key] = Histogram()
+        histogram.observe(duration)
+        response_key = (method, route, status)
+        self.http_responses[response_key] = self.http_responses.get(response_key, 0) + 1
+
+    def observe_storage(self, name: str, duration: float, rows: int, failed: bool):
+        histogram = self.storage_latency.get(name)
+        if histogram is None:
+            histogram = self.storage_latency[name] = Histogram()
+        histogram.observe(duration)
+        self.storage_rows[name] = self.storage_rows.get(name, 0) + rows
+        if failed:
+            self.storage_errors[name] = self.storage_errors.get(name, 0) + 1
+
+    def export(self) -> str:
+        lines = [
+            *_header("bleater_http_requests_in_flight", "gauge", "HTTP requests being handled, event streams included"),
+            f"bleater_http_requests_in_flight {self.http_in_flight}",
+            *_header("bleater_http_request_duration_seconds", "histogram", "HTTP request latency by route"),
+        ]
+        for (method, route), histogram in self.http_latency.items():
+            lines.extend(
+                histogram.export("bleater_http_request_duration_seconds", _labels(method=method, route=route))
+            )
+        lines.extend(_header("bleater_http_responses_total", "counter", "HTTP responses by route and status"))
+        for (method, route, status), count in self.http_responses.items():
+            lines.append(f"bleater_http_responses_total{{{_labels(method=method, route=route, status=status)}}} {count}")
+
+        lines.extend(_header("bleater_storage_calls_in_flight", "gauge", "Storage calls being executed"))
+        for name, count in self.storage_in_flight.items():
+            lines.append(f"bleater_storage_calls_in_flight{{{_labels(method=name)}}} {count}")
+        lines.extend(_header("bleater_storage_call_duration_seconds", "histogram", "Storage call latency by method"))
+        for name, histogram in self.storage_latency.items():
+            lines.extend(histogram.export("bleater_storage_call_duration_seconds", _labels(method=name)))
+        lines.extend(_header("bleater_storage_rows_total", "counter", "Items returned by the storage calls"))
+        for name, count in self.storage_rows.items():
+            lines.append(f"bleater_storage_rows_total{{{_labels(method=name)}}} {count}")
+        lines.extend(_header("bleater_storage_errors_total", "counter", "Storage calls that raised"))
+        for name, count in self.storage_errors.items():
+            lines.append(f"bleater_storage_errors_total{{{_labels(method=name)}}} {count}")
+
+        if len(self.pools) > 0:
+            lines.extend(self._export_pools())
+        return "\n".join(lines) + "\n"
+
+    def _export_pools(self) -> Iterable[str]:
+        stats: list[tuple[str, str, str, Callable[[SqlitePool], float]]] = [
+            ("bleater_sqlite_readers_in_use", "gauge", "Borrowed reader connections", lambda a: a.readers_in_use),
+            ("bleater_sqlite_writes_total", "counter", "Writer acquisitions", lambda a: a.writes),
+            (
+                "bleater_sqlite_write_wait_seconds_total",
+                "counter",
+                "Time spent waiting for the writer",
+                lambda a: a.write_wait_seconds,
+            ),
+            (
+                "bleater_sqlite_busy_errors_total",
+                "counter",
+                "Database locked errors, after the busy timeout retries ran out",
+                lambda a: a.busy_errors,
+            ),
+        ]
+        for name, kind, help, stat in stats:
+            yield from _header(name, kind, help)
+            for i, pool in enumerate(self.pools):
+                yield f"{name}{{{_labels(database=i)}}} {stat(pool)}"
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (no `BaseHTTPMiddleware`, so the responses are not re-wrapped).
+    Requests are labeled with the route template, not the raw path.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        self.metrics.http_in_flight += 1
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            self.metrics.http_in_flight -= 1
+            route = scope.get("route")
+            path = getattr(route, "path", UNMATCHED_ROUTE)
+            self.metrics.observe_request(scope["method"], path, status, time.perf_counter() - start)
+
+
+def _instrumented(name: str):
+    async def method(self: InstrumentedStorage, *args, **kwargs):
+        metrics = self.metrics
+        metrics.storage_in_flight[name] = metrics.storage_in_flight.get(name, 0) + 1
+        start = time.perf_counter()
+        result = None
+        failed = True
+        try:
+            result = await getattr(self.storage, name)(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            metrics.storage_in_flight[name] -= 1
+            metrics.observe_storage(name, time.perf_counter() - start, _row_count(result), failed)
+
+    method.__name__ = name
+    return method
+
+
+class InstrumentedStorage(BaseStorage):
+    """Wraps a request storage, recording the latency, returned items and errors of every call"""
+
+    def __init__(self, storage: BaseStorage, metrics: Metrics):
+        self.storage = storage
+        self.metrics = metrics
+
+    @property
+    def version(self) -> int:
+        return self.storage.version
+
+    register_user = _instrumented("register_user")
+    get_user = _instrumented("get_user")
+    get_users = _instrumented("get_users")
+    submit_post = _instrumented("submit_post")
+    submit_posts = _instrumented("submit_posts")
+    get_post = _instrumented("get_post")
+    get_posts = _instrumented("get_posts")
+    get_thread = _instrumented("get_thread")
+    get_threads = _instrumented("get_threads")
+    get_last_posts = _instrumented("get_last_posts")
+    get_user_posts = _instrumented("get_user_posts")
+    search_posts = _instrumented("search_posts")
+    get_thread_user_ids = _instrumented("get_thread_user_ids")
+    notify = _instrumented("notify")
+    notify_many = _instrumented("notify_many")
+    get_user_notifications = _instrumented("get_user_notifications")
+    drain_user_notifications = _instrumented("drain_user_notifications")
+    purge_user_notifications = _instrumented("purge_user_notifications")
+    # Backends implement it in a single transaction, don't split it into the parts
+    get_session = _instrumented("get_session")
+
+
+def instrument_storage(getter: Callable[[], StorageResult], metrics: Metrics) -> Callable[[], StorageResult]:
+    """Storage getter wrapping the storages of `getter`"""
+
+    async def get_instrumented_storage() -> AsyncIterator[BaseStorage]:
+        async with storage_session(getter) as storage:
+            yield InstrumentedStorage(storage, metrics)
+
+    return get_instrumented_storage
+
+
+@router.get("/metrics")
+async def metrics_endpoint(metrics: Annotated[Metrics, Depends(get_metrics)]) -> Response:
+    """Prometheus text exposition"""
+    return Response(metrics.export(), media_type=PROMETHEUS_TEXT)
+
+
+def _row_count(result: Any) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, Page):
+        return len(result.items)
+    if isinstance(result, Thread):
+        return 1 + len(result.replies)
+    if isinstance(result, Session):
+        return len(result.feed) + len(result.notifications.items) + sum(1 + len(a.replies) for a in result.threads)
+    return 1
+
+
+def _header(name: str, kind: str, help: str) -> list[str]:
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items())
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,69 @@
+import aiosqlite
+from dataclasses import dataclass
+from logging import getLogger
+import os
+import re
+
+DIR = os.path.dirname(__file__)
+MIGRATIONS_DIR = os.path.join(DIR, "assets", "migrations")
+# Schema of the archive database, see `bleater.server.archive`
+ARCHIVE_MIGRATIONS_DIR = os.path.join(DIR, "assets", "archive_migrations")
+
+# Migration files are named `<version>_<description>.sql`
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_\w+\.sql$")
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    sql: str
+
+
+def load_migrations(path: str = MIGRATIONS_DIR) -> list[Migration]:
+    # FIXME: Blocking operation
+    migrations = []
+    for name in os.listdir(path):
+        match = MIGRATION_FILE_RE.match(name)
+        if match is None:
+            continue
+        with open(os.path.join(path, name)) as f:
+            migrations.append(Migration(version=int(match.group(1)), name=name, sql=f.read()))
+
+    migrations.sort(key=lambda a: a.version)
+    return migrations
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    return row[0] if row is not None else 0
+
+
+async def migrate(db: aiosqlite.Connection, migrations: list[Migration] | None = None) -> int:
+    """
+    Bring the database schema up to date.
+    Each pending migration runs in its own transaction together with the `user_version` bump.
+    Returns the resulting schema version.
+    """
+    if migrations is None:
+        migrations = load_migrations()
+
+    version = await get_schema_version(db)
+    latest = migrations[-1].version if len(migrations) > 0 else 0
+    if version > latest:
+        raise RuntimeError(f"Database schema version {version} is newer than supported {latest}")
+
+    for migration in migrations:
+        if migration.version <= version:
+            continue
+        logger.info(f"Applying migration {migration.name}")
+        # Do not use untrusted input here ;)
+        await db.executescript(
+            f"BEGIN;\n{migration.sql}\nPRAGMA user_version = {migration.version};\nCOMMIT;"
+        )
+        version = migration.version
+
+    return version
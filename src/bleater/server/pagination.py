@@ -0,0 +1,18 @@
+from bleater.models import Cursor, InvalidCursorError, PageRequest
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def page_request(limit: int | None, cursor: str | None) -> PageRequest:
+    """Page from query params. The requests are always bounded, unpaged reads are for internal calls only."""
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    return PageRequest(limit=limit, cursor=None if cursor is None else Cursor.decode(cursor))
+
+
+async def invalid_cursor_handler(request: Request, exc: Exception) -> JSONResponse:
+    assert isinstance(exc, InvalidCursorError)
+    return JSONResponse({"detail": "Invalid cursor"}, status_code=400)
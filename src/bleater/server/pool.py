@@ -0,0 +1,334 @@
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from logging import getLogger
+import sqlite3
+import time
+from typing import AsyncIterator
+
+import aiosqlite
+
+logger = getLogger(__name__)
+
+# Applied once per connection when the pool opens.
+# WAL allows the readers to run concurrently with the single writer.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+}
+
+
+@dataclass
+class _WriteSlot:
+    """Single queued writer in the group commit mode"""
+
+    granted: asyncio.Event = field(default_factory=asyncio.Event)
+    released: asyncio.Event = field(default_factory=asyncio.Event)
+    failed: bool = False
+    durable: asyncio.Future[None] = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+def _fail_slot(slot: _WriteSlot, e: Exception):
+    """Wakes up a queued writer with the error, it never gets the connection"""
+    slot.durable.set_exception(e)
+    slot.granted.set()
+
+
+class SqlitePool:
+    """
+    Bounded pool of long-lived sqlite connections:
+    a single writer (serialized by a lock) and a number of read-only readers.
+
+    With `group_commit` enabled writes are queued and a background task runs them
+    in shared transactions, committing every `commit_batch_size` writes or
+    `commit_interval` seconds, whichever comes first.
+
+    Databases in `attach` (schema name -> path) are attached to every connection.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        readers: int = 4,
+        pragmas: dict[str, str | int] | None = None,
+        group_commit: bool = False,
+        commit_batch_size: int = 64,
+        commit_interval: float = 0.005,
+        attach: dict[str, str] | None = None,
+    ):
+        if readers < 1:
+            raise ValueError("At least one reader connection is required")
+        if commit_batch_size < 1:
+            raise ValueError("Commit batch size has to be positive")
+        self.path = path
+        self.reader_count = readers
+        self.pragmas = DEFAULT_PRAGMAS | (pragmas or {})
+        self.group_commit = group_commit
+        self.commit_batch_size = commit_batch_size
+        self.commit_interval = commit_interval
+        self.attached = attach or {}
+
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._write_queue: asyncio.Queue[_WriteSlot | None] = asyncio.Queue()
+        self._commit_task: asyncio.Task | None = None
+        self._is_open = False
+        # Bumped after every committed write
+        self.version = 0
+        # Stats for the metrics
+        self.writes = 0
+        self.write_wait_seconds = 0.0
+        # Lock errors, once the busy timeout retries run out (eg. with other processes writing)
+        self.busy_errors = 0
+
+    async def open(self):
+        if self._is_open:
+            return
+        self._writer = await self._connect(read_only=False)
+        for _ in range(self.reader_count):
+            self._readers.put_nowait(await self._connect(read_only=True))
+        if self.group_commit:
+            self._commit_task = asyncio.create_task(self._commit_loop())
+        self._is_open = True
+
+    async def close(self):
+        if not self._is_open:
+            return
+        self._is_open = False
+
+        if self._commit_task is not None:
+            # Let the queued writes finish
+            self._write_queue.put_nowait(None)
+            await self._commit_task
+            self._commit_task = None
+
+        # Wait for the borrowed readers to come back
+        for _ in range(self.reader_count):
+            db = await self._readers.get()
+            await db.close()
+
+        async with self._write_lock:
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Read-only connection in autocommit mode: every query sees its own snapshot.
+        Use `snapshot` when multiple queries have to agree with each other.
+        """
+        assert self._is_open
+        db = await self._readers.get()
+        suspect = False
+        try:
+            yield db
+        except sqlite3.Error as e:
+            self._count_busy(e)
+            suspect = True
+            raise
+        finally:
+            if suspect:
+                db = await self._ensure_healthy(db, read_only=True)
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def snapshot(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Reader in an explicit read transaction, so all its queries see the same state of the database"""
+        async with self.reader() as db:
+            await db.execute("BEGIN")
+            try:
+                yield db
+            finally:
+                await db.rollback()
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Access to the writer connection. Commits on success, rolls back on error.
+        Exits once the write is durable.
+        """
+        if not self.group_commit:
+            async with self.exclusive() as db:
+                yield db
+            return
+
+        assert self._is_open
+        slot = _WriteSlot()
+        self._write_queue.put_nowait(slot)
+        try:
+            start = time.perf_counter()
+            await slot.granted.wait()
+            self._count_write(start)
+            if slot.durable.done():
+                # The batch failed before this write could start, raises its error
+                slot.durable.result()
+            assert self._writer is not None
+            db = self._writer
+            # Savepoint, so a failed write only discards itself and not the whole batch
+            await db.execute("SAVEPOINT pool_write")
+            try:
+                yield db
+                await db.execute("RELEASE pool_write")
+            except BaseException:
+                await db.execute("ROLLBACK TO pool_write")
+                await db.execute("RELEASE pool_write")
+                raise
+        except BaseException as e:
+            if isinstance(e, sqlite3.Error):
+                self._count_busy(e)
+            slot.failed = True
+            raise
+        finally:
+            slot.released.set()
+
+        await slot.durable
+        self.version += 1
+
+    @asynccontextmanager
+    async def exclusive(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Exclusive access to the writer connection in its own transaction, bypassing the group commit.
+        Commits on success, rolls back on error.
+        """
+        assert self._is_open
+        start = time.perf_counter()
+        async with self._write_lock:
+            assert self._writer is not None
+            self._count_write(start)
+            try:
+                yield self._writer
+                await self._writer.commit()
+                self.version += 1
+            except BaseException as e:
+                await self._rollback()
+                if isinstance(e, sqlite3.Error):
+                    self._count_busy(e)
+                    self._writer = await self._ensure_healthy(self._writer, read_only=False)
+                raise
+
+    async def _commit_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            slot = await self._write_queue.get()
+            if slot is None:
+                return
+
+            async with self._write_lock:
+                assert self._writer is not None
+                batch = []
+                deadline = loop.time() + self.commit_interval
+                try:
+                    await self._writer.execute("BEGIN")
+                    while slot is not None:
+                        slot.granted.set()
+                        await slot.released.wait()
+                        if not slot.failed:
+                            batch.append(slot)
+                        if len(batch) >= self.commit_batch_size:
+                            break
+                        slot = await self._next_slot(deadline - loop.time())
+                    await self._writer.commit()
+                except Exception as e:
+                    await self._rollback()
+                    if isinstance(e, sqlite3.Error):
+                        self._count_busy(e)
+                    for a in batch:
+                        a.durable.set_exception(e)
+                    batch = []
+                    if slot is not None and not slot.granted.is_set():
+                        # Eg. BEGIN failed, before the slot's turn
+                        _fail_slot(slot, e)
+                        slot = None
+                    if not await self._recover_writer():
+                        # No working connection, the queued writes would fail the same way.
+                        # The loop keeps running, the next write tries to reconnect again.
+                        self._fail_queued(e)
+
+                for a in batch:
+                    if not a.durable.done():
+                        a.durable.set_result(None)
+
+            if slot is None and self._is_closing():
+                return
+
+    async def _recover_writer(self) -> bool:
+        assert self._writer is not None
+        try:
+            self._writer = await self._ensure_healthy(self._writer, read_only=False)
+            return True
+        except Exception as e:
+            logger.error(f"Sqlite writer connection can't be replaced: {e}")
+            return False
+
+    def _fail_queued(self, e: Exception):
+        closing = False
+        while not self._write_queue.empty():
+            slot = self._write_queue.get_nowait()
+            if slot is None:
+                closing = True
+            else:
+                _fail_slot(slot, e)
+        if closing:
+            self._write_queue.put_nowait(None)
+
+    async def _next_slot(self, timeout: float) -> _WriteSlot | None:
+        if timeout <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(self._write_queue.get(), timeout)
+        except TimeoutError:
+            return None
+
+    @property
+    def readers_in_use(self) -> int:
+        return self.reader_count - self._readers.qsize() if self._is_open else 0
+
+    def _count_write(self, start: float):
+        self.writes += 1
+        self.write_wait_seconds += time.perf_counter() - start
+
+    def _count_busy(self, e: sqlite3.Error):
+        if isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e)):
+            self.busy_errors += 1
+
+    def _is_closing(self) -> bool:
+        return not self._is_open and self._write_queue.empty()
+
+    async def _rollback(self):
+        assert self._writer is not None
+        try:
+            await self._writer.rollback()
+        except (sqlite3.Error, ValueError):
+            # Handled by the health check
+            pass
+
+    async def _ensure_healthy(self, db: aiosqlite.Connection, *, read_only: bool) -> aiosqlite.Connection:
+        try:
+            await db.execute("SELECT 1")
+            return db
+        except (sqlite3.Error, ValueError):
+            logger.warning("Replacing unhealthy sqlite connection")
+            try:
+                await db.close()
+            except (sqlite3.Error, ValueError):
+                pass
+            return await self._connect(read_only=read_only)
+
+    async def _connect(self, *, read_only: bool) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path)
+        # Before the pragmas, the journal mode applies to all the attached databases
+        for name, path in self.attached.items():
+            await db.execute(f"ATTACH DATABASE ? AS {name}", [path])
+        for name, value in self.pragmas.items():
+            # Do not use untrusted input here ;)
+            await db.execute(f"PRAGMA {name} = {value}")
+        if read_only:
+            await db.execute("PRAGMA query_only = 1")
+        return db
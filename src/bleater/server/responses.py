@@ -0,0 +1,15 @@
+from fastapi import Response
+from pydantic_core import to_json
+from typing import Any
+
+
+class ModelResponse(Response):
+    """
+    JSON of a pydantic model (or a list of them), serialized straight to bytes.
+    Routes returning it skip the revalidation of the result against their `response_model`.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return to_json(content)
@@ -0,0 +1,73 @@
+from bleater.models import Cursor, InvalidCursorError, Page, PageRequest
+from bleater.models.posts import HIGHLIGHT_END, HIGHLIGHT_START, strip_highlight
+import re
+from typing import TypeVar
+
+T = TypeVar("T")
+
+ELLIPSIS = "…"
+# Tokens per snippet
+SNIPPET_SIZE = 16
+MAX_QUERY_LENGTH = 256
+
+WORD_RE = re.compile(r"\w+")
+
+
+def search_terms(query: str) -> list[str]:
+    """Words of a free text query. Search syntax is not exposed, every term has to match."""
+    return list(dict.fromkeys(WORD_RE.findall(query.casefold())))
+
+
+def fts_query(terms: list[str]) -> str:
+    """FTS5 MATCH expression for the terms, each quoted so it can't be parsed as an operator"""
+    return " ".join('"' + a.replace('"', '""') + '"' for a in terms)
+
+
+def page_offset(page: PageRequest) -> int:
+    """
+    Search results are ranked, not ordered by a stable key,
+    so their cursors just hold the offset.
+    """
+    if page.cursor is None:
+        return 0
+    key = page.cursor.key
+    if len(key) != 1 or not isinstance(key[0], int) or key[0] < 0 or page.cursor.backwards:
+        raise InvalidCursorError
+    return key[0]
+
+
+def offset_page(items: list[T], page: PageRequest, offset: int) -> Page[T]:
+    """Build a page from up to `limit + 1` items fetched at `offset`"""
+    next_cursor = None
+    prev_cursor = None
+    if len(items) > page.limit:
+        next_cursor = Cursor(key=[offset + page.limit]).encode()
+    if offset > 0:
+        prev_cursor = Cursor(key=[max(offset - page.limit, 0)]).encode()
+    return Page(items=items[: page.limit], next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def snippet(content: str, terms: set[str], size: int = SNIPPET_SIZE) -> str:
+    """Fragment around the first matched term, for the backends without a native one"""
+    content = strip_highlight(content)
+    words = list(WORD_RE.finditer(content))
+    matched = [i for i, a in enumerate(words) if a.group().casefold() in terms]
+    if len(matched) == 0:
+        return content
+
+    first = max(min(matched[0], len(words) - size), 0)
+    last = min(first + size, len(words)) - 1
+    start = 0 if first == 0 else words[first].start()
+    end = len(content) if last == len(words) - 1 else words[last].end()
+
+    output = ELLIPSIS if start > 0 else ""
+    position = start
+    for i in range(first, last + 1):
+        word = words[i]
+        if i in matched:
+            output += content[position : word.start()] + HIGHLIGHT_START + word.group() + HIGHLIGHT_END
+            position = word.end()
+    output += content[position:end]
+    if end < len(content):
+        output += ELLIPSIS
+    return output
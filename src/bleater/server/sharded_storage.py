@@ -0,0 +1,307 @@
+import asyncio
+from bleater.models import Cursor, Page, PageRequest, Post, Thread, User
+from bleater.models.posts import PostSubmitRequest, SearchHit
+from bleater.models.users import Notification, NotificationRequest
+from bleater.server.archive import ArchivePolicy, Archiver
+from bleater.server.pool import SqlitePool
+from bleater.server.search import offset_page, page_offset, search_terms
+from bleater.server.storage import (
+    BaseStorage,
+    BaseStorageBuilder,
+    SqliteStorage,
+    SqlliteStorageBuilder,
+    StorageResult,
+    _post_key,
+)
+import copy
+import glob
+import heapq
+import itertools
+import os
+import sqlite3
+from typing import Callable, Hashable, Iterable, TypeVar
+import uuid
+import zlib
+
+T = TypeVar("T")
+
+SHARD_FILE_PATTERN = "shard-{}.db"
+# Tries to copy a new user to the other shards, before the registration is rolled back
+USER_COPY_ATTEMPTS = 2
+
+
+def shard_index(key: str, shards: int) -> int:
+    """Shard of a thread (by its root post id) or of a user's notifications (by the user id)"""
+    return zlib.crc32(key.encode()) % shards
+
+
+class ShardedSqliteStorageBuilder(BaseStorageBuilder):
+    """
+    Sqlite storage split across `shards` database files, each with its own writer.
+    Posts are partitioned by their thread and notifications by their recipient.
+    Users are copied to every shard, so the posts can still be joined with their authors.
+
+    With `directory` the shard files are kept between runs (the shard count can't change then),
+    otherwise temporary files are used. The other params apply to every shard
+    (each of them gets its own archive).
+    """
+
+    def __init__(
+        self,
+        *,
+        shards: int = 4,
+        directory: str | None = None,
+        readers: int = 2,
+        pragmas: dict[str, str | int] | None = None,
+        group_commit: bool = False,
+        commit_batch_size: int = 64,
+        commit_interval: float = 0.005,
+        archive: ArchivePolicy | None = None,
+    ):
+        if shards < 1:
+            raise ValueError("At least one shard is required")
+        if directory is not None:
+            # FIXME: blocking code
+            os.makedirs(directory, exist_ok=True)
+            existing = len(glob.glob(os.path.join(directory, SHARD_FILE_PATTERN.format("*"))))
+            if existing > 0 and existing != shards:
+                raise ValueError(f"{directory} holds {existing} shards, not {shards}")
+
+        self.shards = [
+            SqlliteStorageBuilder(
+                path=None if directory is None else os.path.join(directory, SHARD_FILE_PATTERN.format(i)),
+                readers=readers,
+                pragmas=pragmas,
+                group_commit=group_commit,
+                commit_batch_size=commit_batch_size,
+                commit_interval=commit_interval,
+                archive=archive,
+            )
+            for i in range(shards)
+        ]
+
+    def pools(self) -> list[SqlitePool]:
+        return [a.pool for a in self.shards]
+
+    def archivers(self) -> list[Archiver]:
+        return [b for a in self.shards for b in a.archivers()]
+
+    def worker(self) -> ShardedSqliteStorageBuilder:
+        builder = copy.copy(self)
+        builder.shards = [a.worker() for a in self.shards]
+        return builder
+
+    async def build(self) -> Callable[[], StorageResult]:
+        for shard in self.shards:
+            await shard.build()
+        storages = [SqliteStorage(a.pool, a.archive) for a in self.shards]
+
+        async def get_sharded_storage() -> StorageResult:
+            return ShardedSqliteStorage(storages)
+
+        return get_sharded_storage
+
+    async def close(self):
+        for shard in self.shards:
+            await shard.close()
+
+
+class ShardedSqliteStorage(BaseStorage):
+    """
+    Routes every operation to the shards holding its data.
+    Listings spanning all the shards are fetched from each of them and k-way merged.
+    Writes are only atomic within a single shard.
+    """
+
+    def __init__(self, shards: list[SqliteStorage]):
+        self.shards = shards
+
+    @property
+    def version(self) -> int:
+        return sum(a.version for a in self.shards)
+
+    async def register_user(self, name: str) -> User | None:
+        # Older sqlites might not support native uuid()
+        id = str(uuid.uuid4())
+        # The first shard decides on the name conflicts, the rest are copies
+        try:
+            await ShardedSqliteStorage._insert_user(self.shards[0], id, name)
+        except sqlite3.IntegrityError:
+            return None
+        # The copies are idempotent, a retry only fills the shards that failed
+        for _ in range(USER_COPY_ATTEMPTS):
+            results = await asyncio.gather(
+                *(ShardedSqliteStorage._insert_user(a, id, name, copy=True) for a in self.shards[1:]),
+                return_exceptions=True,
+            )
+            errors = [a for a in results if isinstance(a, Exception)]
+            if len(errors) == 0:
+                return User(id=id, name=name)
+
+        # Not registered then, a user missing from some shards couldn't post there.
+        # The first shard goes last, the name stays taken unless all the copies are gone.
+        await asyncio.gather(*(ShardedSqliteStorage._delete_user(a, id) for a in self.shards[1:]))
+        await ShardedSqliteStorage._delete_user(self.shards[0], id)
+        raise errors[0]
+
+    async def get_user(self, id: str) -> User | None:
+        return await self._shard(id).get_user(id)
+
+    async def get_users(self, page: PageRequest | None = None) -> Page[User]:
+        # Every shard has all the users
+        return await self.shards[0].get_users(page)
+
+    async def submit_post(self, post: PostSubmitRequest, timestamp: int) -> Post:
+        (index, id) = self._route_post(post)
+        shard = self.shards[index]
+        async with shard.pool.writer() as db:
+            await SqliteStorage._insert_posts(db, [id], [post], timestamp, archived=shard.archived)
+            created = await SqliteStorage._fetch_post(db, id)
+        assert created is not None
+        return created
+
+    async def submit_posts(self, posts: list[PostSubmitRequest], timestamp: int) -> list[Post]:
+        if len(posts) == 0:
+            return []
+        order = []
+        groups: dict[int, tuple[list[str], list[PostSubmitRequest]]] = {}
+        for post in posts:
+            (index, id) = self._route_post(post)
+            order.append(id)
+            (ids, group) = groups.setdefault(index, ([], []))
+            ids.append(id)
+            group.append(post)
+
+        async def submit(index: int, ids: list[str], group: list[PostSubmitRequest]) -> list[Post]:
+            shard = self.shards[index]
+            async with shard.pool.writer() as db:
+                await SqliteStorage._insert_posts(db, ids, group, timestamp, archived=shard.archived)
+                return await SqliteStorage._fetch_posts(db, ids)
+
+        results = await asyncio.gather(*(submit(index, *group) for index, group in groups.items()))
+        created = _ordered(order, itertools.chain.from_iterable(results), lambda a: a.id)
+        assert len(created) == len(posts)
+        return created
+
+    async def get_post(self, id: str) -> Post | None:
+        return await self._shard(id).get_post(id)
+
+    async def get_posts(self, ids: list[str]) -> list[Post]:
+        results = await asyncio.gather(*(a.get_posts(b) for a, b in self._group(ids)))
+        return _ordered(ids, itertools.chain.from_iterable(results), lambda a: a.id)
+
+    async def get_thread(self, id: str, page: PageRequest | None = None) -> Thread | None:
+        return await self._shard(id).get_thread(id, page)
+
+    async def get_threads(self, ids: list[str], limit: int) -> list[Thread]:
+        results = await asyncio.gather(*(a.get_threads(b, limit) for a, b in self._group(ids)))
+        return _ordered(ids, itertools.chain.from_iterable(results), lambda a: a.id)
+
+    async def get_last_posts(self, count: int) -> list[Post]:
+        results = await asyncio.gather(*(a.get_last_posts(count) for a in self.shards))
+        return _merge(results, _post_key, reverse=True, limit=count)
+
+    async def get_user_posts(self, user_id: str, page: PageRequest | None = None) -> Page[Post]:
+        # The same keyset condition applies to every shard, the merged rows are in the query direction again
+        async def fetch(shard: SqliteStorage) -> list[Post]:
+            async with shard.pool.snapshot() if shard.archived else shard.pool.reader() as db:
+                return await SqliteStorage._fetch_user_posts(db, user_id, page, archived=shard.archived)
+
+        results = await asyncio.gather(*(fetch(a) for a in self.shards))
+        descending = page is None or not page.backwards
+        posts = _merge(results, _post_key, reverse=descending, limit=None if page is None else page.limit + 1)
+        return Page.build(posts, page, _post_key)
+
+    async def search_posts(self, query: str, page: PageRequest) -> Page[SearchHit]:
+        offset = page_offset(page)
+        terms = search_terms(query)
+        if len(terms) == 0:
+            return Page(items=[])
+
+        # Every shard has to return the whole prefix, as the offset applies to the merged ranking.
+        # The bm25 ranks use per shard statistics, which is close enough with evenly spread threads.
+        limit = offset + page.limit + 1
+
+        async def fetch(shard: SqliteStorage) -> list[tuple[float, SearchHit]]:
+            async with shard.pool.reader() as db:
+                return await SqliteStorage._search(db, terms, limit, 0)
+
+        results = await asyncio.gather(*(fetch(a) for a in self.shards))
+        ranked = _merge(results, lambda a: a[0], reverse=False, limit=limit)
+        return offset_page([a[1] for a in ranked[offset:]], page, offset)
+
+    async def get_thread_user_ids(self, id: str) -> list[str]:
+        return await self._shard(id).get_thread_user_ids(id)
+
+    async def notify(self, user_id: str, content: str, post_id: str, mentioned_user_id: str, timestamp: int) -> None:
+        await self._shard(user_id).notify(user_id, content, post_id, mentioned_user_id, timestamp)
+
+    async def notify_many(self, notifications: list[NotificationRequest], timestamp: int) -> list[Notification]:
+        # All the notifications of a recipient go to the same shard, so it can still keep the first one only
+        groups: dict[int, list[NotificationRequest]] = {}
+        for notification in notifications:
+            groups.setdefault(self._index(notification.user_id), []).append(notification)
+        results = await asyncio.gather(*(self.shards[a].notify_many(b, timestamp) for a, b in groups.items()))
+        return list(itertools.chain.from_iterable(results))
+
+    async def get_user_notifications(self, user_id: str, page: PageRequest) -> Page[Notification]:
+        return await self._shard(user_id).get_user_notifications(user_id, page)
+
+    async def drain_user_notifications(self, user_id: str, limit: int, ack: Cursor | None = None) -> Page[Notification]:
+        return await self._shard(user_id).drain_user_notifications(user_id, limit, ack)
+
+    async def purge_user_notifications(self, user_id: str) -> None:
+        await self._shard(user_id).purge_user_notifications(user_id)
+
+    def _index(self, key: str) -> int:
+        return shard_index(key, len(self.shards))
+
+    def _shard(self, key: str) -> SqliteStorage:
+        return self.shards[self._index(key)]
+
+    def _group(self, ids: list[str]) -> list[tuple[SqliteStorage, list[str]]]:
+        groups: dict[int, list[str]] = {}
+        for id in dict.fromkeys(ids):
+            groups.setdefault(self._index(id), []).append(id)
+        return [(self.shards[a], b) for a, b in groups.items()]
+
+    def _route_post(self, post: PostSubmitRequest) -> tuple[int, str]:
+        """Shard and id of a new post"""
+        # Older sqlites might not support native uuid()
+        id = str(uuid.uuid4())
+        if post.parent_id is None:
+            # A new thread goes wherever its id points to
+            return (self._index(id), id)
+
+        # Replies go to their thread (parents are always the thread roots here),
+        # with an id routing to the same shard, so they can be found by the id alone.
+        # Takes `shards` attempts on average.
+        index = self._index(post.parent_id)
+        while self._index(id) != index:
+            id = str(uuid.uuid4())
+        return (index, id)
+
+    @staticmethod
+    async def _insert_user(shard: SqliteStorage, id: str, name: str, *, copy: bool = False):
+        # A copy might be there already, from an attempt that failed on another shard.
+        # Only the same id is skipped, a different user with the name still raises.
+        conflict = " ON CONFLICT (id) DO NOTHING" if copy else ""
+        async with shard.pool.writer() as db:
+            await db.execute("INSERT INTO user (id, name) VALUES (?, ?)" + conflict, [id, name])
+
+    @staticmethod
+    async def _delete_user(shard: SqliteStorage, id: str):
+        async with shard.pool.writer() as db:
+            await db.execute("DELETE FROM user WHERE id = ?", [id])
+
+
+def _merge(results: list[list[T]], key: Callable[[T], Hashable], *, reverse: bool, limit: int | None) -> list[T]:
+    """K-way merge of the per shard results, each already sorted by `key`"""
+    merged = heapq.merge(*results, key=key, reverse=reverse)
+    return list(merged if limit is None else itertools.islice(merged, limit))
+
+
+def _ordered(ids: list[str], items: Iterable[T], key: Callable[[T], str]) -> list[T]:
+    """Items in the order of `ids`, missing ones skipped"""
+    found = {key(a): a for a in items}
+    return [found[a] for a in dict.fromkeys(ids) if a in found]
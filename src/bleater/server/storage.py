@@ -1,26 +1,60 @@
-from bleater.models.users import Notification
-from bleater.models.posts import PostSubmitRequest
+from bleater.models.users import Notification, NotificationRequest
+from bleater.models.posts import PostSubmitRequest, SearchHit
 import sqlite3
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+import inspect
 import aiosqlite
-from bleater.models import Post, Thread, User
+from bleater.models import Cursor, InvalidCursorError, Page, PageRequest, Post, Session, Thread, User
+from bleater.server.archive import (
+    ARCHIVE_SCHEMA,
+    ARCHIVE_SUFFIX,
+    ARCHIVED_NOTIFICATION_TABLE,
+    ARCHIVED_POST_TABLE,
+    ArchivePolicy,
+    Archiver,
+    init_archive,
+    restore_threads,
+)
+from bleater.server.migrations import migrate
+from bleater.server.pool import SqlitePool
+from bleater.server.search import ELLIPSIS, HIGHLIGHT_END, HIGHLIGHT_START, SNIPPET_SIZE, fts_query, offset_page, page_offset, search_terms
 import os
-from typing import Callable, Awaitable, AsyncGenerator, TypeAlias
+import heapq
+import itertools
+from typing import AsyncContextManager, Callable, Awaitable, AsyncGenerator, AsyncIterator, Generic, TypeAlias, TypeVar
 import tempfile
 import uuid
 
 
-DIR = os.path.dirname(__file__)
-ASSETS_DIR = os.path.join(DIR, "assets")
+StorageResult: TypeAlias = Awaitable["BaseStorage"] | AsyncGenerator["BaseStorage", None]
 
+T = TypeVar("T")
 
-StorageResult: TypeAlias = Awaitable["BaseStorage"] | AsyncGenerator["BaseStorage", None]
+# Rows fetched per query when streaming. Well below the default page size (50),
+# so the views' pages are read in a few short queries instead of one long one.
+STREAM_CHUNK_SIZE = 16
+# Not acknowledged yet, for a notification `n`. Only kept past the acknowledgement with the archive enabled.
+_PENDING = "n.seq > coalesce((SELECT a.seq FROM notification_ack a WHERE a.user_id = n.user_id), 0) "
 
 
 async def get_storage() -> BaseStorage:
     raise NotImplementedError
 
 
+@asynccontextmanager
+async def storage_session(getter: Callable[[], StorageResult]) -> AsyncIterator[BaseStorage]:
+    """Use a built storage getter outside of a request"""
+    result = getter()
+    if inspect.isasyncgen(result):
+        try:
+            yield await anext(result)
+        finally:
+            await result.aclose()
+    else:
+        yield await result
+
+
 class BaseStorageBuilder(ABC):
     @abstractmethod
     async def build(
@@ -32,9 +66,40 @@ class BaseStorageBuilder(ABC):
     async def close(self):
         """Storage teardown"""
 
+    def pools(self) -> list[SqlitePool]:
+        """Connection pools of the storage, eg. for the metrics"""
+        return []
+
+    def archivers(self) -> list[Archiver]:
+        """Background archivers of the storage, eg. to drop the archived threads from the feed"""
+        return []
+
+    def worker(self) -> BaseStorageBuilder:
+        """
+        Unopened builder of the same storage for a server worker process, sent there pickled.
+        Its `close` must leave the data in place, it is owned by this builder.
+        """
+        raise NotImplementedError(f"{type(self).__name__} can't be shared between processes")
+
 
 class SqlliteStorageBuilder(BaseStorageBuilder):
-    def __init__(self, *, path: str | None = None):
+    """
+    With `archive` the old threads and notifications are moved to a second database file
+    (`<path>-archive`) in the background. The archived threads can still be read,
+    the notifications are only archived once acknowledged.
+    """
+
+    def __init__(
+        self,
+        *,
+        path: str | None = None,
+        readers: int = 4,
+        pragmas: dict[str, str | int] | None = None,
+        group_commit: bool = False,
+        commit_batch_size: int = 64,
+        commit_interval: float = 0.005,
+        archive: ArchivePolicy | None = None,
+    ):
         if path is None:
             with tempfile.NamedTemporaryFile(delete_on_close=False) as f:
                 self.path = f.name
@@ -42,247 +107,750 @@ class SqlliteStorageBuilder(BaseStorageBuilder):
         else:
             self.path = path
             self.is_temp = False
+        self.archive = archive
+        self.archive_path = None if archive is None else self.path + ARCHIVE_SUFFIX
+        self.pool = SqlitePool(
+            self.path,
+            readers=readers,
+            pragmas=pragmas,
+            group_commit=group_commit,
+            commit_batch_size=commit_batch_size,
+            commit_interval=commit_interval,
+            attach=None if self.archive_path is None else {ARCHIVE_SCHEMA: self.archive_path},
+        )
+        self.archiver = None if archive is None else Archiver(self.pool, archive)
+
+    def pools(self) -> list[SqlitePool]:
+        return [self.pool]
+
+    def archivers(self) -> list[Archiver]:
+        return [] if self.archiver is None else [self.archiver]
+
+    def worker(self) -> SqlliteStorageBuilder:
+        builder = SqlliteStorageBuilder(
+            path=self.path,
+            readers=self.pool.reader_count,
+            pragmas=self.pool.pragmas,
+            group_commit=self.pool.group_commit,
+            commit_batch_size=self.pool.commit_batch_size,
+            commit_interval=self.pool.commit_interval,
+            archive=self.archive,
+        )
+        # The data is archived by the supervising process only
+        builder.archiver = None
+        return builder
 
     async def build(self) -> Callable[[], StorageResult]:
+        if self.archive_path is not None:
+            await init_archive(self.archive_path)
+        await self.pool.open()
         await self._init_db()
+        if self.archiver is not None:
+            self.archiver.start()
 
         async def get_sqlite_storage() -> StorageResult:
-            db = None
-            try:
-                db = SqliteStorage(self.path)
-                await db.connect()
-                yield db
-            finally:
-                if db is not None:
-                    await db.close()
+            return SqliteStorage(self.pool, self.archive)
 
         return get_sqlite_storage
 
     async def close(self):
+        if self.archiver is not None:
+            await self.archiver.close()
+        await self.pool.close()
+
         # FIXME: blocking code
         if self.is_temp:
-            os.remove(self.path)
+            for path in (self.path, self.archive_path):
+                for suffix in ("", "-wal", "-shm"):
+                    if path is not None and os.path.exists(path + suffix):
+                        os.remove(path + suffix)
 
     async def _init_db(self):
-        # FIXME: Blocking operation
-        with open(os.path.join(ASSETS_DIR, "sqlite_init.sql")) as f:
-            init_sql = f.read()
+        async with self.pool.exclusive() as db:
+            await migrate(db)
 
-        async with aiosqlite.connect(self.path) as db:
-            # Do not use untrusted input here ;)
-            await db.executescript(init_sql)
-            await db.commit()
+
+class PageStream(Generic[T]):
+    """
+    Async iterator over a page, fetched in chunks with the keyset cursors,
+    so no connection is held while the items are consumed.
+    The page cursors are known once the iteration is finished.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[PageRequest], Awaitable[Page[T]]],
+        page: PageRequest | None,
+        *,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+    ):
+        self.fetch = fetch
+        self.page = page
+        self.chunk_size = chunk_size
+        self.next_cursor: str | None = None
+        self.prev_cursor: str | None = None
+        self._first: Page[T] | None = None
+
+    async def prefetch(self):
+        """Fetch the first chunk up front, eg. to surface invalid cursors before a response starts"""
+        if self._first is None:
+            self._first = await self.fetch(self._request(self._first_size(), self.page.cursor if self.page else None))
+
+    async def __aiter__(self) -> AsyncIterator[T]:
+        await self.prefetch()
+        assert self._first is not None
+        chunk = self._first
+        remaining = None if self.page is None else self.page.limit
+        self.prev_cursor = chunk.prev_cursor
+
+        while True:
+            for item in chunk.items:
+                yield item
+            if remaining is not None:
+                remaining -= len(chunk.items)
+            if chunk.next_cursor is None or remaining == 0 or (self.page is not None and self.page.backwards):
+                self.next_cursor = chunk.next_cursor
+                return
+            chunk = await self.fetch(self._request(self._chunk_size(remaining), Cursor.decode(chunk.next_cursor)))
+
+    def _first_size(self) -> int:
+        if self.page is not None and self.page.backwards:
+            # Backwards pages come in reversed, so they are not split
+            return self.page.limit
+        return self._chunk_size(None if self.page is None else self.page.limit)
+
+    def _chunk_size(self, remaining: int | None) -> int:
+        return self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+
+    def _request(self, limit: int, cursor: Cursor | None) -> PageRequest:
+        return PageRequest(limit=limit, cursor=cursor)
 
 
 class BaseStorage(ABC):
+    @property
+    @abstractmethod
+    def version(self) -> int:
+        """Counter bumped after every write, eg. for cache invalidation"""
+
     @abstractmethod
     async def register_user(self, name: str) -> User | None:
         """Register user by name. Returns None on name conflict."""
 
     @abstractmethod
-    async def get_users(self) -> list[User]:
-        """Get all registered users"""
+    async def get_user(self, id: str) -> User | None:
+        """Get a single user"""
+
+    @abstractmethod
+    async def get_users(self, page: PageRequest | None = None) -> Page[User]:
+        """Get registered users, ordered by name"""
 
     @abstractmethod
-    async def submit_post(self, post: PostSubmitRequest, timestamp: int) -> None:
-        """Submit a new post or reply."""
+    async def submit_post(self, post: PostSubmitRequest, timestamp: int) -> Post:
+        """Submit a new post or reply. Returns the stored post."""
 
     @abstractmethod
     async def get_post(self, id: str) -> Post | None:
         """Retrieve a single post or reply"""
 
     @abstractmethod
-    async def get_thread(self, id: str) -> Thread | None:
-        """Fetch single thread with replies"""
+    async def submit_posts(self, posts: list[PostSubmitRequest], timestamp: int) -> list[Post]:
+        """Submit many posts in a single transaction. Returns the stored posts, in order."""
+
+    @abstractmethod
+    async def get_posts(self, ids: list[str]) -> list[Post]:
+        """Retrieve many posts at once. Missing ones are skipped, the order of `ids` is kept."""
+
+    @abstractmethod
+    async def get_thread(self, id: str, page: PageRequest | None = None) -> Thread | None:
+        """Fetch single thread with replies, oldest first"""
+
+    @abstractmethod
+    async def get_threads(self, ids: list[str], limit: int) -> list[Thread]:
+        """
+        Fetch many threads with their latest `limit` replies, oldest first. `prev_cursor` of a thread
+        pages back to the older ones (see `get_thread`). Missing ones are skipped, the order of `ids` is kept.
+        """
 
     @abstractmethod
     async def get_last_posts(self, count: int) -> list[Post]:
         """Fetch a list of most recent top-level posts"""
 
     @abstractmethod
-    async def get_user_posts(self, user_id: str) -> list[Post]:
-        """Fetch all posts by user"""
+    async def get_user_posts(self, user_id: str, page: PageRequest | None = None) -> Page[Post]:
+        """Fetch posts by user, newest first"""
+
+    @abstractmethod
+    async def search_posts(self, query: str, page: PageRequest) -> Page[SearchHit]:
+        """Full-text search of posts and replies containing all the words of `query`, best matches first"""
+
+    @abstractmethod
+    async def get_thread_user_ids(self, id: str) -> list[str]:
+        """Get distinct ids of users that replied in a thread"""
 
     @abstractmethod
     async def notify(self, user_id: str, content: str, post_id: str, mentioned_user_id: str, timestamp: int) -> None:
-        """Remove all user notifications"""
+        """Create a user notification"""
+
+    @abstractmethod
+    async def notify_many(self, notifications: list[NotificationRequest], timestamp: int) -> list[Notification]:
+        """
+        Create many notifications in a single transaction. Only the first one per recipient is kept.
+        Returns the created notifications.
+        """
 
     @abstractmethod
-    async def get_user_notifications(self, user_id: str, count: int) -> list[Notification]:
-        """Get most recent user notifications"""
+    async def get_user_notifications(self, user_id: str, page: PageRequest) -> Page[Notification]:
+        """Get user notifications, newest first"""
+
+    @abstractmethod
+    async def drain_user_notifications(self, user_id: str, limit: int, ack: Cursor | None = None) -> Page[Notification]:
+        """
+        Acknowledge and fetch user notifications in a single transaction, oldest first.
+        Notifications up to `ack` (`next_cursor` of a previous drain) are removed,
+        then up to `limit` of the remaining ones are returned. Those are kept until acknowledged.
+        """
 
     @abstractmethod
     async def purge_user_notifications(self, user_id: str) -> None:
         """Remove all user notifications"""
 
+    async def get_session(
+        self,
+        user_id: str,
+        feed: list[Post],
+        *,
+        expand: int,
+        notification_limit: int,
+        replies: int,
+        ack: Cursor | None = None,
+    ) -> Session:
+        """
+        Agent session bootstrap: drain the user notifications (see `drain_user_notifications`)
+        and expand the threads of the notified posts and of the first `expand` feed posts,
+        with their latest `replies` replies (see `get_threads`).
+        Backends should read it all in a single transaction.
+        """
+        notifications = await self.drain_user_notifications(user_id, notification_limit, ack)
+        threads = await self.get_threads(session_thread_ids(feed, notifications.items, expand), replies)
+        return Session(feed=feed, notifications=notifications, threads=threads)
+
+    def stream_users(self, page: PageRequest | None = None) -> PageStream[User]:
+        return PageStream(self.get_users, page)
+
+    def stream_user_posts(self, user_id: str, page: PageRequest | None = None) -> PageStream[Post]:
+        return PageStream(lambda a: self.get_user_posts(user_id, a), page)
+
+    def stream_thread_replies(self, id: str, page: PageRequest | None = None) -> PageStream[Post]:
+        async def fetch(chunk: PageRequest) -> Page[Post]:
+            thread = await self.get_thread(id, chunk)
+            if thread is None:
+                return Page(items=[])
+            return Page(items=thread.replies, next_cursor=thread.next_cursor, prev_cursor=thread.prev_cursor)
+
+        return PageStream(fetch, page)
+
 
 class SqliteStorage(BaseStorage):
-    def __init__(self, path: str):
-        self.path = path
-        self.db = None
+    """Request scoped storage. Borrows connections from the builder's pool per operation."""
 
-    async def connect(self):
-        self.db = await aiosqlite.connect(self.path)
+    def __init__(self, pool: SqlitePool, archive: ArchivePolicy | None = None):
+        self.pool = pool
+        # The lookups fall back to the archive (if attached), the latest posts and search only see the live data
+        self.archived = ARCHIVE_SCHEMA in pool.attached
+        # The acknowledged notifications are kept for the archiver then, instead of deleted
+        self.keep_acked = archive is not None and archive.notification_age is not None
 
-    async def close(self):
-        if self.db is not None:
-            await self.db.close()
+    @property
+    def version(self) -> int:
+        return self.pool.version
 
     async def register_user(self, name: str) -> User | None:
-        assert self.db is not None
         # Older sqlites might not support native uuid()
         id = str(uuid.uuid4())
         try:
-            await self.db.execute("INSERT INTO user (id, name) VALUES (?, ?)", [id, name])
-            await self.db.commit()
+            async with self.pool.writer() as db:
+                await db.execute("INSERT INTO user (id, name) VALUES (?, ?)", [id, name])
             return User(id=id, name=name)
         except sqlite3.IntegrityError:
             return None
 
-    async def get_users(self) -> list[User]:
-        assert self.db is not None
-        cursor = await self.db.execute(
-            ("SELECT id, name FROM user"),
-            [],
-        )
-        rows = await cursor.fetchall()
-        return [
+    async def get_user(self, id: str) -> User | None:
+        async with self.pool.reader() as db:
+            cursor = await db.execute("SELECT id, name FROM user WHERE id = ?", [id])
+            row = await cursor.fetchone()
+        if row is not None:
+            return User(id=row[0], name=row[1])
+
+    async def get_users(self, page: PageRequest | None = None) -> Page[User]:
+        (condition, order, params) = SqliteStorage._keyset(["name"], page, descending=False)
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                ("SELECT id, name FROM user WHERE 1 " + condition + order),
+                params,
+            )
+            rows = await cursor.fetchall()
+        users = [
             User(
                 id=row[0],
                 name=row[1],
             )
             for row in rows
         ]
+        return Page.build(users, page, lambda a: (a.name,))
 
-    async def submit_post(self, post: PostSubmitRequest, timestamp: int) -> None:
-        assert self.db is not None
+    async def submit_post(self, post: PostSubmitRequest, timestamp: int) -> Post:
         # Older sqlites might not support native uuid()
         id = str(uuid.uuid4())
-        await self.db.execute(
-            ("INSERT INTO post (id, parent_id, user_id, content, timestamp) VALUES (?, ?, ?, ?, ?)"),
-            [id, post.parent_id, post.user_id, post.content, timestamp],
-        )
-        await self.db.commit()
+        async with self.pool.writer() as db:
+            await SqliteStorage._insert_posts(db, [id], [post], timestamp, archived=self.archived)
+            created = await SqliteStorage._fetch_post(db, id)
+        assert created is not None
+        return created
+
+    async def submit_posts(self, posts: list[PostSubmitRequest], timestamp: int) -> list[Post]:
+        if len(posts) == 0:
+            return []
+        # Older sqlites might not support native uuid()
+        ids = [str(uuid.uuid4()) for _ in posts]
+        async with self.pool.writer() as db:
+            await SqliteStorage._insert_posts(db, ids, posts, timestamp, archived=self.archived)
+            created = await SqliteStorage._fetch_posts(db, ids)
+        assert len(created) == len(posts)
+        return created
 
     async def get_post(self, id: str) -> Post | None:
-        assert self.db is not None
-        cursor = await self.db.execute(
-            SqliteStorage._base_post_query() + "WHERE p.id = ? " + SqliteStorage._post_group_by(),
+        async with self.pool.reader() as db:
+            post = await SqliteStorage._fetch_post(db, id)
+            if post is None and self.archived:
+                post = await SqliteStorage._fetch_post(db, id, ARCHIVED_POST_TABLE)
+        return post
+
+    async def get_posts(self, ids: list[str]) -> list[Post]:
+        if len(ids) == 0:
+            return []
+        async with self.pool.reader() as db:
+            return await SqliteStorage._fetch_posts(db, ids, archived=self.archived)
+
+    async def get_thread(self, id: str, page: PageRequest | None = None) -> Thread | None:
+        (condition, order, params) = SqliteStorage._keyset(["p.timestamp", "p.id"], page, descending=False)
+        # Both queries in one read transaction - on their own each of them would see its own snapshot,
+        # so a reply committed in between could be counted in the root but missing from the replies
+        async with self.pool.snapshot() as db:
+            # Threads are archived as a whole, the replies are where the root is
+            table = "post"
+            root = await SqliteStorage._fetch_post(db, id)
+            if root is None and self.archived:
+                table = ARCHIVED_POST_TABLE
+                root = await SqliteStorage._fetch_post(db, id, table)
+            if root is None:
+                return None
+
+            cursor = await db.execute(
+                SqliteStorage._base_post_query(table) + "WHERE p.parent_id = ? " + condition + order,
+                [id, *params],
+            )
+            rows = await cursor.fetchall()
+        replies = Page.build(SqliteStorage._posts_from_rows(rows), page, _post_key)
+        return Thread(
+            id=id,
+            root=root,
+            replies=replies.items,
+            next_cursor=replies.next_cursor,
+            prev_cursor=replies.prev_cursor,
+        )
+
+    async def get_threads(self, ids: list[str], limit: int) -> list[Thread]:
+        if len(ids) == 0:
+            return []
+        async with self.pool.snapshot() as db:
+            return await SqliteStorage._fetch_threads(db, ids, limit, archived=self.archived)
+
+    async def get_last_posts(self, count: int) -> list[Post]:
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                SqliteStorage._base_post_query() + "WHERE p.parent_id is NULL ORDER BY p.timestamp DESC, p.id DESC LIMIT ?",
+                [count],
+            )
+            rows = await cursor.fetchall()
+        return SqliteStorage._posts_from_rows(rows)
+
+    async def get_user_posts(self, user_id: str, page: PageRequest | None = None) -> Page[Post]:
+        # Both databases queried in the same snapshot
+        async with self.pool.snapshot() if self.archived else self.pool.reader() as db:
+            posts = await SqliteStorage._fetch_user_posts(db, user_id, page, archived=self.archived)
+        return Page.build(posts, page, _post_key)
+
+    async def search_posts(self, query: str, page: PageRequest) -> Page[SearchHit]:
+        offset = page_offset(page)
+        terms = search_terms(query)
+        if len(terms) == 0:
+            return Page(items=[])
+
+        async with self.pool.reader() as db:
+            ranked = await SqliteStorage._search(db, terms, page.limit + 1, offset)
+        return offset_page([a[1] for a in ranked], page, offset)
+
+    async def get_thread_user_ids(self, id: str) -> list[str]:
+        query = "SELECT DISTINCT user_id FROM post WHERE parent_id = ?"
+        if self.archived:
+            query += f" UNION SELECT user_id FROM {ARCHIVED_POST_TABLE} WHERE parent_id = ?"
+        async with self.pool.reader() as db:
+            cursor = await db.execute(query, [id, id] if self.archived else [id])
+            rows = await cursor.fetchall()
+        return [row[0] for row in rows]
+
+    async def notify(self, user_id: str, content: str, post_id: str, mentioned_user_id: str, timestamp: int) -> None:
+        # Older sqlites might not support native uuid()
+        id = str(uuid.uuid4())
+        async with self.pool.writer() as db:
+            await db.execute(
+                (
+                    "INSERT INTO notification (id, user_id, post_id, content, mentioned_user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)"
+                ),
+                [id, user_id, post_id, content, mentioned_user_id, timestamp],
+            )
+
+    async def notify_many(self, notifications: list[NotificationRequest], timestamp: int) -> list[Notification]:
+        rows = {}
+        for notification in notifications:
+            if notification.user_id in rows:
+                continue
+            # Older sqlites might not support native uuid()
+            rows[notification.user_id] = [
+                str(uuid.uuid4()),
+                notification.user_id,
+                notification.post_id,
+                notification.content,
+                notification.mentioned_user_id,
+                timestamp,
+            ]
+        if len(rows) == 0:
+            return []
+
+        mentioned_ids = list({row[4] for row in rows.values()})
+        async with self.pool.writer() as db:
+            await db.executemany(
+                (
+                    "INSERT INTO notification (id, user_id, post_id, content, mentioned_user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)"
+                ),
+                list(rows.values()),
+            )
+            cursor = await db.execute(
+                f"SELECT id, name FROM user WHERE id IN ({_placeholders(mentioned_ids)})",
+                mentioned_ids,
+            )
+            names = {row[0]: row[1] for row in await cursor.fetchall()}
+
+        return [
+            Notification(
+                id=row[0],
+                user_id=row[1],
+                content=row[3],
+                post_id=row[2],
+                timestamp=row[5],
+                mentioned_user=User(id=row[4], name=names.get(row[4], "<unknown>")),
+            )
+            for row in rows.values()
+        ]
+
+    async def get_user_notifications(self, user_id: str, page: PageRequest) -> Page[Notification]:
+        (condition, order, params) = SqliteStorage._keyset(["n.timestamp", "n.id"], page, descending=True)
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                SqliteStorage._base_notification_query() + "WHERE n.user_id = ? AND " + _PENDING + condition + order,
+                [user_id, *params],
+            )
+            rows = await cursor.fetchall()
+        notifications = [SqliteStorage._notification_from_row(row) for row in rows]
+        return Page.build(notifications, page, lambda a: (a.timestamp, a.id))
+
+    async def drain_user_notifications(self, user_id: str, limit: int, ack: Cursor | None = None) -> Page[Notification]:
+        acked = notification_ack_seq(ack)
+        async with self._drain_connection(acked) as db:
+            return await SqliteStorage._drain_notifications(db, user_id, limit, acked, keep_acked=self.keep_acked)
+
+    async def get_session(
+        self,
+        user_id: str,
+        feed: list[Post],
+        *,
+        expand: int,
+        notification_limit: int,
+        replies: int,
+        ack: Cursor | None = None,
+    ) -> Session:
+        acked = notification_ack_seq(ack)
+        async with self._drain_connection(acked) as db:
+            notifications = await SqliteStorage._drain_notifications(
+                db, user_id, notification_limit, acked, keep_acked=self.keep_acked
+            )
+            thread_ids = session_thread_ids(feed, notifications.items, expand)
+            threads = (
+                []
+                if len(thread_ids) == 0
+                else await SqliteStorage._fetch_threads(db, thread_ids, replies, archived=self.archived)
+            )
+        return Session(feed=feed, notifications=notifications, threads=threads)
+
+    async def purge_user_notifications(self, user_id: str) -> None:
+        tables = ["notification", "notification_ack"]
+        if self.archived:
+            tables.append(ARCHIVED_NOTIFICATION_TABLE)
+        async with self.pool.writer() as db:
+            for table in tables:
+                await db.execute(f"DELETE FROM {table} WHERE user_id = ?", [user_id])
+
+    def _drain_connection(self, acked: int | None) -> AsyncContextManager[aiosqlite.Connection]:
+        # Nothing to acknowledge, no need to wait for the writer
+        return self.pool.snapshot() if acked is None else self.pool.writer()
+
+    @staticmethod
+    async def _fetch_post(db: aiosqlite.Connection, id: str, table: str = "post") -> Post | None:
+        cursor = await db.execute(
+            SqliteStorage._base_post_query(table) + "WHERE p.id = ? ",
             [id],
         )
         row = await cursor.fetchone()
         if row is not None:
             return SqliteStorage._post_from_row(row)
 
-    async def get_thread(self, id: str) -> Thread | None:
-        assert self.db is not None
+    @staticmethod
+    async def _insert_posts(
+        db: aiosqlite.Connection,
+        ids: list[str],
+        posts: list[PostSubmitRequest],
+        timestamp: int,
+        *,
+        archived: bool = False,
+    ):
+        if archived:
+            # A reply brings its thread back to life
+            await restore_threads(db, [a.parent_id for a in posts if a.parent_id is not None])
+        await db.executemany(
+            ("INSERT INTO post (id, parent_id, user_id, content, timestamp) VALUES (?, ?, ?, ?, ?)"),
+            [[id, a.parent_id, a.user_id, a.content, timestamp] for id, a in zip(ids, posts)],
+        )
 
-        root = await self.get_post(id)
-        if root is None:
-            return None
+    @staticmethod
+    async def _fetch_posts(db: aiosqlite.Connection, ids: list[str], *, archived: bool = False) -> list[Post]:
+        posts = await SqliteStorage._select_posts(db, ids, "post")
+        missing = [a for a in ids if a not in posts]
+        if archived and len(missing) > 0:
+            posts |= await SqliteStorage._select_posts(db, missing, ARCHIVED_POST_TABLE)
+        return [posts[a] for a in dict.fromkeys(ids) if a in posts]
 
-        cursor = await self.db.execute(
-            SqliteStorage._base_post_query()
-            + "WHERE p.parent_id = ? "
-            + SqliteStorage._post_group_by()
-            + "ORDER BY p.timestamp ASC",
-            [id],
+    @staticmethod
+    async def _select_posts(db: aiosqlite.Connection, ids: list[str], table: str) -> dict[str, Post]:
+        cursor = await db.execute(
+            SqliteStorage._base_post_query(table) + f"WHERE p.id IN ({_placeholders(ids)})",
+            ids,
         )
-        rows = await cursor.fetchall()
-        replies = [SqliteStorage._post_from_row(row) for row in rows]
-        return Thread(id=id, root=root, replies=replies)
+        return {a.id: a for a in SqliteStorage._posts_from_rows(await cursor.fetchall())}
 
-    async def get_last_posts(self, count: int) -> list[Post]:
-        assert self.db is not None
-        cursor = await self.db.execute(
-            SqliteStorage._base_post_query()
-            + "WHERE p.parent_id is NULL "
-            + SqliteStorage._post_group_by()
-            + "ORDER BY p.timestamp DESC LIMIT ?",
-            [count],
+    @staticmethod
+    async def _fetch_threads(
+        db: aiosqlite.Connection, ids: list[str], limit: int, *, archived: bool = False
+    ) -> list[Thread]:
+        ids = list(dict.fromkeys(ids))
+        roots = await SqliteStorage._select_posts(db, ids, "post")
+        replies = await SqliteStorage._select_replies(db, list(roots), "post", limit)
+        missing = [a for a in ids if a not in roots]
+        if archived and len(missing) > 0:
+            # Threads are archived as a whole, the replies are where the root is
+            archived_roots = await SqliteStorage._select_posts(db, missing, ARCHIVED_POST_TABLE)
+            roots |= archived_roots
+            replies |= await SqliteStorage._select_replies(db, list(archived_roots), ARCHIVED_POST_TABLE, limit)
+        return [latest_replies(roots[a], replies.get(a, []), limit) for a in ids if a in roots]
+
+    @staticmethod
+    async def _select_replies(
+        db: aiosqlite.Connection, ids: list[str], table: str, limit: int
+    ) -> dict[str, list[Post]]:
+        """The latest `limit + 1` replies of each thread, oldest first (see `latest_replies`)"""
+        if len(ids) == 0:
+            return {}
+        # Numbered from the newest within each thread
+        latest = (
+            "(SELECT *, row_number() OVER (PARTITION BY parent_id ORDER BY timestamp DESC, id DESC) AS latest "
+            f"FROM {table} WHERE parent_id IN ({_placeholders(ids)}))"
         )
-        rows = await cursor.fetchall()
-        posts = [SqliteStorage._post_from_row(row) for row in rows]
-        return posts
-
-    async def get_user_posts(self, user_id: str) -> list[Post]:
-        assert self.db is not None
-        cursor = await self.db.execute(
-            SqliteStorage._base_post_query()
-            + "WHERE p.user_id = ? "
-            + SqliteStorage._post_group_by()
-            + "ORDER BY p.timestamp DESC",
-            [user_id],
+        cursor = await db.execute(
+            SqliteStorage._base_post_query(latest) + "WHERE p.latest <= ? ORDER BY p.timestamp, p.id",
+            [*ids, limit + 1],
         )
-        rows = await cursor.fetchall()
-        posts = [SqliteStorage._post_from_row(row) for row in rows]
-        return posts
+        replies: dict[str, list[Post]] = {}
+        for reply in SqliteStorage._posts_from_rows(await cursor.fetchall()):
+            assert reply.parent_id is not None
+            replies.setdefault(reply.parent_id, []).append(reply)
+        return replies
 
-    async def notify(self, user_id: str, content: str, post_id: str, mentioned_user_id: str, timestamp: int) -> None:
-        assert self.db is not None
-        # Older sqlites might not support native uuid()
-        id = str(uuid.uuid4())
-        await self.db.execute(
-            (
-                "INSERT INTO notification (id, user_id, post_id, content, mentioned_user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)"
-            ),
-            [id, user_id, post_id, content, mentioned_user_id, timestamp],
-        )
-        await self.db.commit()
+    @staticmethod
+    async def _fetch_user_posts(
+        db: aiosqlite.Connection, user_id: str, page: PageRequest | None, *, archived: bool = False
+    ) -> list[Post]:
+        """User posts in the query direction, up to `limit + 1` of them (see `Page.build`)"""
+        (condition, order, params) = SqliteStorage._keyset(["p.timestamp", "p.id"], page, descending=True)
+        query = "WHERE p.user_id = ? " + condition + order
+        cursor = await db.execute(SqliteStorage._base_post_query() + query, [user_id, *params])
+        posts = SqliteStorage._posts_from_rows(await cursor.fetchall())
+        if not archived:
+            return posts
+
+        # The same keyset applies to the archive, both are merged in the query direction again
+        cursor = await db.execute(SqliteStorage._base_post_query(ARCHIVED_POST_TABLE) + query, [user_id, *params])
+        archived_posts = SqliteStorage._posts_from_rows(await cursor.fetchall())
+        merged = heapq.merge(posts, archived_posts, key=_post_key, reverse=page is None or not page.backwards)
+        # A post can be in both after an interrupted move, the live copy comes first
+        unique = (next(a) for _, a in itertools.groupby(merged, key=lambda a: a.id))
+        return list(unique if page is None else itertools.islice(unique, page.limit + 1))
 
-    async def get_user_notifications(self, user_id: str, count: int) -> list[Notification]:
-        assert self.db is not None
-        cursor = await self.db.execute(
+    @staticmethod
+    async def _search(db: aiosqlite.Connection, terms: list[str], limit: int, offset: int) -> list[tuple[float, SearchHit]]:
+        """Search hits with their bm25 rank, best (lowest) first"""
+        cursor = await db.execute(
             (
-                "SELECT n.id, n.user_id, n.content, n.post_id, n.timestamp, u.id, u.name "
-                "FROM notification n "
-                "JOIN user u ON u.id = n.mentioned_user_id "
-                "WHERE user_id = ? "
-                "ORDER BY n.timestamp DESC LIMIT ?"
+                "SELECT p.id, p.parent_id, p.content, p.timestamp, u.id, u.name, p.reply_count, "
+                "snippet(post_search, 0, ?, ?, ?, ?), post_search.rank "
+                "FROM post_search "
+                "JOIN post p ON p.seq = post_search.rowid "
+                "JOIN user u ON u.id = p.user_id "
+                "WHERE post_search MATCH ? "
+                "ORDER BY post_search.rank LIMIT ? OFFSET ?"
             ),
-            [user_id, count],
+            [HIGHLIGHT_START, HIGHLIGHT_END, ELLIPSIS, SNIPPET_SIZE, fts_query(terms), limit, offset],
         )
-        rows = await cursor.fetchall()
+        users: dict[str, User] = {}
         return [
-            Notification(
-                id=row[0],
-                user_id=row[1],
-                content=row[2],
-                post_id=row[3],
-                timestamp=row[4],
-                mentioned_user=User(id=row[5], name=row[6]),
-            )
-            for row in rows
+            (row[8], SearchHit(post=SqliteStorage._post_from_row(row, users), snippet=row[7]))
+            for row in await cursor.fetchall()
         ]
 
-    async def purge_user_notifications(self, user_id: str) -> None:
-        assert self.db is not None
-        await self.db.execute(
-            ("DELETE FROM notification WHERE user_id = ?"),
-            [user_id],
+    @staticmethod
+    async def _drain_notifications(
+        db: aiosqlite.Connection, user_id: str, limit: int, acked: int | None, *, keep_acked: bool = False
+    ) -> Page[Notification]:
+        if acked is not None and keep_acked:
+            # Only the acknowledged ones are archived, the pending ones are always in the live table
+            await db.execute(
+                "INSERT INTO notification_ack (user_id, seq) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET seq = max(seq, excluded.seq)",
+                [user_id, acked],
+            )
+        elif acked is not None:
+            await db.execute("DELETE FROM notification WHERE user_id = ? AND seq <= ?", [user_id, acked])
+        cursor = await db.execute(
+            SqliteStorage._base_notification_query() + "WHERE n.user_id = ? AND " + _PENDING + "ORDER BY n.seq LIMIT ?",
+            [user_id, limit],
         )
-        await self.db.commit()
+        rows = await cursor.fetchall()
+        if len(rows) == 0:
+            return Page(items=[])
+        # The sequence of the last one acknowledges the whole batch
+        return Page(
+            items=[SqliteStorage._notification_from_row(row) for row in rows],
+            next_cursor=Cursor(key=[rows[-1][7]]).encode(),
+        )
+
+    @staticmethod
+    def _keyset(columns: list[str], page: PageRequest | None, *, descending: bool) -> tuple[str, str, list]:
+        """
+        Keyset pagination parts: condition (to be appended to a WHERE clause), ORDER BY / LIMIT
+        and their query params.
+        """
+        if page is not None and page.cursor is not None and len(page.cursor.key) != len(columns):
+            raise InvalidCursorError
+
+        # Walking backwards from a cursor flips the query order
+        query_descending = descending != (page is not None and page.backwards)
+        direction = "DESC" if query_descending else "ASC"
+        order = "ORDER BY " + ", ".join(f"{a} {direction}" for a in columns) + " "
+        if page is None:
+            return ("", order, [])
+
+        condition = ""
+        params: list = []
+        if page.cursor is not None:
+            placeholders = ", ".join("?" for _ in columns)
+            comparison = "<" if query_descending else ">"
+            condition = f"AND ({', '.join(columns)}) {comparison} ({placeholders}) "
+            params = list(page.cursor.key)
+
+        return (condition, order + "LIMIT ? ", params + [page.limit + 1])
 
     @staticmethod
-    def _base_post_query() -> str:
+    def _base_post_query(table: str = "post") -> str:
         return (
-            "SELECT p.id, p.parent_id, p.content, p.timestamp, u.id, u.name, count(r.id) "
-            "FROM post p "
-            "LEFT JOIN post r ON r.parent_id = p.id "
+            "SELECT p.id, p.parent_id, p.content, p.timestamp, u.id, u.name, p.reply_count "
+            f"FROM {table} p "
             "JOIN user u ON u.id = p.user_id "
         )
 
     @staticmethod
-    def _post_group_by() -> str:
-        return "GROUP BY p.id, p.parent_id, p.content, p.timestamp, u.id, u.name "
+    def _base_notification_query() -> str:
+        return (
+            "SELECT n.id, n.user_id, n.content, n.post_id, n.timestamp, n.mentioned_user_id, u.name, n.seq "
+            "FROM notification n "
+            # Left join, so the notification can be acknowledged even when the user is gone
+            "LEFT JOIN user u ON u.id = n.mentioned_user_id "
+        )
 
     @staticmethod
-    def _post_from_row(row) -> Post:
-        return Post(
+    def _notification_from_row(row) -> Notification:
+        return Notification(
             id=row[0],
-            parent_id=row[1],
+            user_id=row[1],
             content=row[2],
-            timestamp=row[3],
-            user=User(id=row[4], name=row[5]),
-            replies=row[6],
+            post_id=row[3],
+            timestamp=row[4],
+            mentioned_user=User(id=row[5], name=row[6] or "<unknown>"),
         )
+
+    @staticmethod
+    def _posts_from_rows(rows) -> list[Post]:
+        users: dict[str, User] = {}
+        return [SqliteStorage._post_from_row(row, users) for row in rows]
+
+    @staticmethod
+    def _post_from_row(row, users: dict[str, User] | None = None) -> Post:
+        # The authors repeat a lot, share their models within a query
+        user = None if users is None else users.get(row[4])
+        if user is None:
+            user = User(id=row[4], name=row[5])
+            if users is not None:
+                users[row[4]] = user
+        return Post.build(row[0], row[1], row[2], row[3], user, row[6])
+
+
+def _post_key(post: Post) -> tuple[int, str]:
+    return (post.timestamp, post.id)
+
+
+def _placeholders(values: list) -> str:
+    return ", ".join("?" for _ in values)
+
+
+def latest_replies(root: Post, replies: list[Post], limit: int) -> Thread:
+    """
+    Thread of the latest `limit` replies, from up to `limit + 1` of them fetched oldest first
+    (the extra one only signals that there is more, like in `Page.build`).
+    """
+    if len(replies) <= limit:
+        return Thread(id=root.id, root=root, replies=replies)
+    replies = replies[len(replies) - limit :]
+    prev_cursor = Cursor(key=list(_post_key(replies[0])), backwards=True).encode()
+    return Thread(id=root.id, root=root, replies=replies, prev_cursor=prev_cursor)
+
+
+def session_thread_ids(feed: list[Post], notifications: list[Notification], expand: int) -> list[str]:
+    """Threads expanded in an agent session: the notified ones first, then the top of the feed"""
+    ids = [a.post_id for a in notifications] + [a.id for a in feed[: max(expand, 0)]]
+    return list(dict.fromkeys(ids))
+
+
+def notification_ack_seq(ack: Cursor | None) -> int | None:
+    """Notification sequence number acknowledged by a drain cursor"""
+    if ack is None:
+        return None
+    if len(ack.key) != 1 or not isinstance(ack.key[0], int) or ack.backwards:
+        raise InvalidCursorError
+    return ack.key[0]
@@ -1,60 +1,133 @@
-from fastapi.responses import HTMLResponse
-from bleater.server.feed import get_feed
+from bleater.models.posts import HIGHLIGHT_END, HIGHLIGHT_START
+from bleater.server.cache import ResponseCache, get_response_cache
+from bleater.server.feed import FeedEngine, get_feed_engine
+from bleater.server.pagination import DEFAULT_PAGE_SIZE, page_request
+from bleater.server.search import MAX_QUERY_LENGTH
 from bleater.server.storage import BaseStorage, get_storage
 from dataclasses import dataclass
 import datetime
 from jinja2 import Environment, FileSystemLoader
+from markupsafe import Markup, escape
 import os
-from typing import Callable, Annotated
-from fastapi import APIRouter, Depends, Body, HTTPException
+import re
+from typing import AsyncIterator, Callable, Annotated
+from fastapi import APIRouter, Depends, Body, HTTPException, Query, Request, Response
 
 
 DIR = os.path.dirname(__file__)
 TEMPLATE_PATH = os.path.join(DIR, "templates")
-JINJA_ENV = Environment(loader=FileSystemLoader(TEMPLATE_PATH))
+# Async, so the templates can iterate the storage streams
+JINJA_ENV = Environment(loader=FileSystemLoader(TEMPLATE_PATH), enable_async=True)
+STREAM_BUFFER_SIZE = 4096
+HTML = "text/html"
+HIGHLIGHT_RE = re.compile(re.escape(HIGHLIGHT_START) + "(.*?)" + re.escape(HIGHLIGHT_END), re.DOTALL)
 
 router = APIRouter()
 
 
 @router.get("/")
 async def feed(
+    request: Request,
+    engine: Annotated[FeedEngine, Depends(get_feed_engine)],
     storage: Annotated[BaseStorage, Depends(get_storage)],
-) -> HTMLResponse:
-    feed = await get_feed(storage)
-    template = JINJA_ENV.get_template("feed.jinja")
-    return HTMLResponse(content=template.render(feed=feed), status_code=200)
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+) -> Response:
+    # The ranking also moves with the clock
+    now = int(datetime.datetime.now().timestamp())
+
+    async def render() -> AsyncIterator[str]:
+        return _render("feed.jinja", feed=engine.get_feed(now))
+
+    return await cache.respond(request, (storage.version, now), render, HTML)
 
 
 @router.get("/posts")
 async def thread(
+    request: Request,
     id: str,
     storage: Annotated[BaseStorage, Depends(get_storage)],
-) -> HTMLResponse:
-    thread = await storage.get_thread(id)
-    template = JINJA_ENV.get_template("thread.jinja")
-    return HTMLResponse(content=template.render(thread=thread), status_code=200)
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    cursor: str | None = None,
+) -> Response:
+    async def render() -> AsyncIterator[str]:
+        root = await storage.get_post(id)
+        if root is None:
+            raise HTTPException(404)
+        replies = storage.stream_thread_replies(id, page_request(DEFAULT_PAGE_SIZE, cursor))
+        await replies.prefetch()
+        return _render("thread.jinja", root=root, replies=replies)
+
+    return await cache.respond(request, storage.version, render, HTML)
 
 
 @router.get("/users")
 async def user_list(
+    request: Request,
     storage: Annotated[BaseStorage, Depends(get_storage)],
-) -> HTMLResponse:
-    users = await storage.get_users()
-    template = JINJA_ENV.get_template("user_list.jinja")
-    return HTMLResponse(content=template.render(users=users), status_code=200)
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    cursor: str | None = None,
+) -> Response:
+    async def render() -> AsyncIterator[str]:
+        users = storage.stream_users(page_request(DEFAULT_PAGE_SIZE, cursor))
+        await users.prefetch()
+        return _render("user_list.jinja", users=users)
+
+    return await cache.respond(request, storage.version, render, HTML)
 
 
 @router.get("/user")
 async def user_posts(
+    request: Request,
     id: str,
     storage: Annotated[BaseStorage, Depends(get_storage)],
-) -> HTMLResponse:
-    posts = await storage.get_user_posts(id)
-    template = JINJA_ENV.get_template("user.jinja")
-    username = "<unknown>"
-    if len(posts) > 0:
-        username = posts[0].user.name
-    return HTMLResponse(content=template.render(posts=posts, username=username), status_code=200)
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    cursor: str | None = None,
+) -> Response:
+    async def render() -> AsyncIterator[str]:
+        user = await storage.get_user(id)
+        posts = storage.stream_user_posts(id, page_request(DEFAULT_PAGE_SIZE, cursor))
+        await posts.prefetch()
+        username = "<unknown>" if user is None else user.name
+        return _render("user.jinja", user_id=id, posts=posts, username=username)
+
+    return await cache.respond(request, storage.version, render, HTML)
+
+
+@router.get("/search")
+async def search(
+    request: Request,
+    storage: Annotated[BaseStorage, Depends(get_storage)],
+    cache: Annotated[ResponseCache, Depends(get_response_cache)],
+    q: Annotated[str, Query(max_length=MAX_QUERY_LENGTH)] = "",
+    cursor: str | None = None,
+) -> Response:
+    async def render() -> AsyncIterator[str]:
+        hits = None
+        if len(q) > 0:
+            hits = await storage.search_posts(q, page_request(DEFAULT_PAGE_SIZE, cursor))
+        return _render("search.jinja", query=q, hits=hits)
+
+    return await cache.respond(request, storage.version, render, HTML)
+
+
+def _render(template_name: str, **context) -> AsyncIterator[str]:
+    template = JINJA_ENV.get_template(template_name)
+    return _buffered(template.generate_async(**context))
+
+
+async def _buffered(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    # Jinja yields every text fragment separately, send them in bigger pieces
+    buffer = []
+    size = 0
+    async for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if len(buffer) > 0:
+        yield "".join(buffer)
 
 
 def ts_format(value):
@@ -62,4 +135,13 @@ def ts_format(value):
     return dt.strftime("%d-%m-%y %H:%M")
 
 
+def highlight(value: str) -> Markup:
+    # Snippets wrap the matched terms in the highlight markers
+    parts = HIGHLIGHT_RE.split(value)
+    return Markup("").join(
+        Markup("<mark>{}</mark>").format(a) if i % 2 == 1 else escape(a) for i, a in enumerate(parts)
+    )
+
+
 JINJA_ENV.filters["ts_format"] = ts_format
+JINJA_ENV.filters["highlight"] = highlight
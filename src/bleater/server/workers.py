@@ -0,0 +1,124 @@
+import asyncio
+from bleater.server.hub import Event
+import json
+from logging import getLogger
+import os
+import tempfile
+from typing import Callable
+
+logger = getLogger(__name__)
+
+# Sent after any request that might have changed the storage
+WRITE_EVENT = "write"
+# Sent by the supervising process with the root ids of the threads moved to the archive
+ARCHIVED_EVENT = "archived"
+# Requests that don't change anything, no need to tell the other workers
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+# Longest relayed line, eg. a post event with its content
+LINE_LIMIT = 2**20
+
+
+class Broker:
+    """
+    Relays the events of every worker process to all the other ones, over a local unix socket.
+    Runs in the supervising process.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="bleater-")
+        self.path = os.path.join(self.directory, "workers.sock")
+        self._server: asyncio.Server | None = None
+        self._peers: set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._handle, self.path, limit=LINE_LIMIT)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for peer in self._peers:
+                peer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        # FIXME: blocking code
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rmdir(self.directory)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        try:
+            while line := await reader.readline():
+                # Local sockets, the peers are not waited for - a stuck worker can't hold the others
+                for peer in self._peers:
+                    if peer is not writer and not peer.is_closing():
+                        peer.write(line)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Dropping worker connection: {e}")
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+
+class PeerLink:
+    """Connection of a worker process to the broker"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    @staticmethod
+    async def connect(path: str) -> PeerLink:
+        (reader, writer) = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+        return PeerLink(reader, writer)
+
+    def send(self, event: Event):
+        if not self._writer.is_closing():
+            self._writer.write(event.json().encode() + b"\n")
+
+    async def listen(self, handler: Callable[[Event], None]):
+        """Pass the events of the other workers to `handler`, until the broker goes away"""
+        try:
+            while line := await self._reader.readline():
+                # A bad event is skipped, the listener has to keep running for the cache to be invalidated
+                try:
+                    message = json.loads(line)
+                    handler(Event(message["type"], json.dumps(message["data"])))
+                except Exception as e:
+                    logger.error(f"Can't handle worker event: {e}")
+        except (ConnectionError, ValueError) as e:
+            logger.error(f"Broker connection failed: {e}")
+            return
+        logger.error("Broker connection closed, the other workers' writes are no longer seen")
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class WriteRelayMiddleware:
+    """
+    Tells the other workers about successful writes, so they drop their cached responses.
+    Plain ASGI middleware, like `MetricsMiddleware` - the event streams are not re-wrapped.
+    """
+
+    def __init__(self, app, link: PeerLink):
+        self.app = app
+        self.link = link
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_write(message):
+            # Rejected requests didn't change anything
+            if message["type"] == "http.response.start" and 200 <= message["status"] < 300:
+                self.link.send(Event(WRITE_EVENT, "null"))
+            await send(message)
+
+        await self.app(scope, receive, send_write)
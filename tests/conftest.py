@@ -0,0 +1,22 @@
+import pytest
+
+from bleater.server.memory_storage import InMemoryStorageBuilder
+from bleater.server.sharded_storage import ShardedSqliteStorageBuilder
+from bleater.server.storage import SqlliteStorageBuilder, storage_session
+
+BUILDERS = {
+    "sqlite": lambda path: SqlliteStorageBuilder(path=str(path / "bleater.db")),
+    "sqlite-group-commit": lambda path: SqlliteStorageBuilder(path=str(path / "bleater.db"), group_commit=True),
+    "memory": lambda path: InMemoryStorageBuilder(),
+    "sharded": lambda path: ShardedSqliteStorageBuilder(shards=3, directory=str(path / "shards")),
+}
+
+
+@pytest.fixture(params=list(BUILDERS))
+async def storage(request, tmp_path):
+    """Every storage backend, all of them have to behave the same"""
+    builder = BUILDERS[request.param](tmp_path)
+    getter = await builder.build()
+    async with storage_session(getter) as storage:
+        yield storage
+    await builder.close()
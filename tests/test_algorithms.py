@@ -0,0 +1,42 @@
+import random
+
+import pytest
+
+from bleater.server import algorithms
+from bleater.server.algorithms import GravityAlgorithm, RecencyRepliesAlgorithm, ReplyVelocityAlgorithm
+
+pytest.importorskip("numpy")
+
+NOW = 1_700_000_000
+ALGORITHMS = [RecencyRepliesAlgorithm(), GravityAlgorithm(), ReplyVelocityAlgorithm()]
+
+
+def candidates(seed: int, size: int) -> tuple[list[int], list[int]]:
+    """Newest first, few distinct values so plenty of the scores tie"""
+    rnd = random.Random(seed)
+    timestamps = sorted((NOW - rnd.choice([0, 1, 60, 3600, 7200, 86400]) for _ in range(size)), reverse=True)
+    replies = [rnd.choice([0, 0, 1, 2, 5]) for _ in range(size)]
+    return (timestamps, replies)
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS, ids=lambda a: type(a).__name__)
+@pytest.mark.parametrize("count", [0, 1, 5, 30, 100])
+@pytest.mark.parametrize("seed", range(5))
+def test_fallback_matches_numpy(algorithm, count, seed, monkeypatch):
+    (timestamps, replies) = candidates(seed, 30)
+    vectorized = algorithm.rank(NOW, timestamps, replies, count)
+
+    monkeypatch.setattr(algorithms, "np", None)
+    assert algorithm.rank(NOW, timestamps, replies, count) == vectorized
+    assert len(vectorized) == min(count, len(timestamps))
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS, ids=lambda a: type(a).__name__)
+@pytest.mark.parametrize("numpy", [True, False])
+def test_ties_keep_candidate_order(algorithm, numpy, monkeypatch):
+    if not numpy:
+        monkeypatch.setattr(algorithms, "np", None)
+    # Everything scores the same
+    assert algorithm.rank(NOW, [NOW - 60] * 6, [1] * 6, 4) == [0, 1, 2, 3]
+    # The two best tie, then the rest ties
+    assert algorithm.rank(NOW, [NOW - 60] * 6, [0, 0, 3, 0, 3, 0], 3) == [2, 4, 0]
@@ -0,0 +1,110 @@
+import logging
+
+import pytest
+
+from bleater.farm import tools
+from bleater.farm.transport import AsgiClient
+from bleater.models.posts import PostSubmitRequest, Thread
+from bleater.server.app import BleaterServer
+from bleater.server.memory_storage import InMemoryStorage, InMemoryStorageBuilder
+from bleater.server.api import MAX_BATCH_THREADS, SESSION_REPLIES
+from bleater.server.pagination import MAX_PAGE_SIZE
+
+
+@pytest.fixture
+async def server():
+    server = BleaterServer(InMemoryStorageBuilder())
+    await server.create_app()
+    yield server
+    await server.storage.close()
+
+
+@pytest.fixture
+async def client(server):
+    async with AsgiClient(server.app, timeout=5) as client:
+        yield client
+
+
+async def thread(client: AsgiClient):
+    """Two users and a thread of the first one"""
+    (bob, alice) = [await tools.register_user(client, a) for a in ("bob", "alice")]
+    (root,) = await tools.submit_posts(client, [PostSubmitRequest(user_id=bob.id, content="root")])
+    return (bob, alice, root)
+
+
+async def test_replies_notify_the_thread(client):
+    (bob, alice, root) = await thread(client)
+    await tools.create_submit_reply_tool(client, alice.id)("first", root.id)
+    replies = [PostSubmitRequest(user_id=bob.id, content="second", parent_id=root.id)]
+    assert len(await tools.submit_posts(client, replies)) == 1
+
+    assert [a.content for a in (await tools.get_notifications(client, bob.id)).items] == [
+        "New reply in your thread."
+    ]
+    assert [a.content for a in (await tools.get_notifications(client, alice.id)).items] == [
+        "New reply in a thread you've also replied to."
+    ]
+
+
+@pytest.mark.parametrize("method", ["submit_post", "submit_posts"])
+async def test_failed_submit_leaves_no_notifications(client, monkeypatch, method):
+    (bob, alice, root) = await thread(client)
+
+    async def broken(*args):
+        raise RuntimeError("storage is gone")
+
+    monkeypatch.setattr(InMemoryStorage, method, broken)
+    logging.disable(logging.ERROR)
+    try:
+        if method == "submit_post":
+            await tools.create_submit_reply_tool(client, alice.id)("reply", root.id)
+        else:
+            replies = [PostSubmitRequest(user_id=alice.id, content="reply", parent_id=root.id)]
+            assert await tools.submit_posts(client, replies) == []
+    finally:
+        logging.disable(logging.NOTSET)
+
+    assert (await tools.get_notifications(client, bob.id)).items == []
+
+
+
+async def test_thread_replies_are_paged_by_default(client):
+    (_bob, alice, root) = await thread(client)
+    for batch in range(3):
+        replies = [PostSubmitRequest(user_id=alice.id, content=f"{batch}-{i}", parent_id=root.id) for i in range(70)]
+        await tools.submit_posts(client, replies)
+
+    async with client.get("/api/posts", params={"post_id": root.id}) as response:
+        first = Thread.model_validate(await response.json())
+    assert len(first.replies) == MAX_PAGE_SIZE and first.next_cursor is not None
+
+    params = {"post_id": root.id, "cursor": first.next_cursor}
+    async with client.get("/api/posts", params=params) as response:
+        rest = Thread.model_validate(await response.json())
+    assert len(rest.replies) == 210 - MAX_PAGE_SIZE and rest.next_cursor is None
+
+
+async def test_batch_threads_are_bounded(client):
+    (_bob, alice, root) = await thread(client)
+    replies = [PostSubmitRequest(user_id=alice.id, content=str(i), parent_id=root.id) for i in range(3)]
+    await tools.submit_posts(client, replies)
+
+    async with client.get("/api/posts", params={"post_id": root.id}) as response:
+        whole = Thread.model_validate(await response.json())
+    async with client.post("/api/posts/batch-get", params={"limit": 2}, json=[root.id]) as response:
+        (latest,) = [Thread.model_validate(a) for a in await response.json()]
+    assert latest.replies == whole.replies[-2:] and latest.prev_cursor is not None
+
+    async with client.post("/api/posts/batch-get", json=[root.id] * (MAX_BATCH_THREADS + 1)) as response:
+        assert response.status == 422
+
+
+async def test_session_threads_keep_the_latest_replies(client):
+    (bob, alice, root) = await thread(client)
+    replies = [PostSubmitRequest(user_id=alice.id, content=str(i), parent_id=root.id) for i in range(SESSION_REPLIES + 3)]
+    await tools.submit_posts(client, replies)
+
+    session = await tools.get_session(client, bob.id)
+    (expanded,) = session.threads
+    assert len(expanded.replies) == SESSION_REPLIES and expanded.prev_cursor is not None
+    assert "older replies not shown" in tools.format_thread(expanded)
@@ -0,0 +1,98 @@
+import pytest
+
+from bleater.farm.transport import AsgiClient
+from bleater.models import Cursor, PageRequest
+from bleater.models.posts import PostSubmitRequest
+from bleater.server.app import BleaterServer
+from bleater.server.archive import Archiver, ArchivePolicy
+from bleater.server.storage import SqlliteStorageBuilder, storage_session
+
+DAY = 24 * 3600
+
+
+@pytest.fixture
+async def builder(tmp_path):
+    builder = SqlliteStorageBuilder(path=str(tmp_path / "bleater.db"), archive=ArchivePolicy(thread_age=None))
+    yield builder
+    await builder.close()
+
+
+async def count(storage, table: str) -> int:
+    async with storage.pool.reader() as db:
+        cursor = await db.execute(f"SELECT count(*) FROM {table}")
+        return (await cursor.fetchone())[0]
+
+
+async def test_only_acknowledged_notifications_are_archived(builder):
+    getter = await builder.build()
+    # Runs on the test's clock instead of the background one
+    await builder.archiver.close()
+    archiver = Archiver(builder.pool, builder.archive)
+    async with storage_session(getter) as storage:
+        (bob, alice) = [await storage.register_user(a) for a in ("bob", "alice")]
+        post = await storage.submit_post(PostSubmitRequest(user_id=alice.id, content="hi bob"), 0)
+        for i in range(3):
+            await storage.notify(bob.id, f"n{i}", post.id, alice.id, i * DAY)
+
+        # Old enough, but still pending
+        assert await archiver.run(now=3 * DAY) == (0, 0)
+
+        drained = await storage.drain_user_notifications(bob.id, 2)
+        assert [a.content for a in drained.items] == ["n0", "n1"]
+        drained = await storage.drain_user_notifications(bob.id, 2, Cursor.decode(drained.next_cursor))
+        assert [a.content for a in drained.items] == ["n2"]
+        # Kept for the archiver, but no longer listed
+        assert await count(storage, "main.notification") == 3
+        page = await storage.get_user_notifications(bob.id, PageRequest(limit=10))
+        assert [a.content for a in page.items] == ["n2"]
+
+        assert await archiver.run(now=3 * DAY) == (0, 2)
+        assert (await count(storage, "main.notification"), await count(storage, "archive.notification")) == (1, 2)
+        # The pending one is still there, without looking into the archive
+        drained = await storage.drain_user_notifications(bob.id, 10)
+        assert [a.content for a in drained.items] == ["n2"]
+
+        await storage.purge_user_notifications(bob.id)
+        assert (await storage.drain_user_notifications(bob.id, 10)).items == []
+        for table in ("main.notification", "main.notification_ack", "archive.notification"):
+            assert await count(storage, table) == 0
+
+
+async def test_acknowledged_notifications_are_deleted_without_the_notification_age(tmp_path):
+    builder = SqlliteStorageBuilder(path=str(tmp_path / "bleater.db"), archive=ArchivePolicy(notification_age=None))
+    async with storage_session(await builder.build()) as storage:
+        (bob, alice) = [await storage.register_user(a) for a in ("bob", "alice")]
+        post = await storage.submit_post(PostSubmitRequest(user_id=alice.id, content="hi bob"), 0)
+        await storage.notify(bob.id, "n0", post.id, alice.id, 0)
+
+        drained = await storage.drain_user_notifications(bob.id, 10)
+        await storage.drain_user_notifications(bob.id, 10, Cursor.decode(drained.next_cursor))
+        assert await count(storage, "main.notification") == 0
+    await builder.close()
+
+
+async def test_archived_threads_leave_the_feed(tmp_path):
+    path = str(tmp_path / "bleater.db")
+    seed = SqlliteStorageBuilder(path=path)
+    async with storage_session(await seed.build()) as storage:
+        bob = await storage.register_user("bob")
+        old = await storage.submit_post(PostSubmitRequest(user_id=bob.id, content="old"), 0)
+        await storage.submit_post(PostSubmitRequest(user_id=bob.id, content="reply", parent_id=old.id), DAY)
+        new = await storage.submit_post(PostSubmitRequest(user_id=bob.id, content="new"), 5 * DAY)
+    await seed.close()
+
+    builder = SqlliteStorageBuilder(path=path, archive=ArchivePolicy(notification_age=None))
+    server = BleaterServer(builder)
+    await server.create_app()
+    assert {a.id for a in server.feed.get_feed(now=9 * DAY)} == {old.id, new.id}
+
+    # The background run is done with the empty window by now, this one is on the test's clock
+    assert await builder.archiver.run(now=9 * DAY) == (1, 0)
+    assert [a.id for a in server.feed.get_feed(now=9 * DAY)] == [new.id]
+    # Still readable
+    async with AsgiClient(server.app, timeout=5) as client:
+        async with client.get("/api/posts", params={"post_id": old.id}) as response:
+            assert response.status == 200 and len((await response.json())["replies"]) == 1
+
+    server.hub.close()
+    await builder.close()
@@ -0,0 +1,86 @@
+import pytest
+
+from bleater.farm.transport import AsgiClient
+from bleater.server.app import BleaterServer
+from bleater.server.memory_storage import InMemoryStorageBuilder
+
+
+@pytest.fixture
+async def server():
+    server = BleaterServer(InMemoryStorageBuilder(), cache_size=2)
+    await server.create_app()
+    yield server
+    await server.storage.close()
+
+
+@pytest.fixture
+async def client(server):
+    async with AsgiClient(server.app, timeout=5) as client:
+        yield client
+
+
+async def get(client: AsgiClient, url: str, etag: str | None = None):
+    headers = None if etag is None else {"If-None-Match": etag}
+    async with client.get(url, headers=headers) as response:
+        return (response.status, response.headers.get("etag"), await response.read())
+
+
+async def register(client: AsgiClient, name: str):
+    async with client.post("/api/users/register", json={"name": name}) as response:
+        assert response.status == 200
+
+
+async def test_not_modified(client):
+    await register(client, "bob")
+    (status, etag, body) = await get(client, "/api/users")
+    assert status == 200 and etag is not None and b"bob" in body
+
+    assert await get(client, "/api/users", etag) == (304, etag, b"")
+    assert (await get(client, "/api/users", f'"other", W/{etag}'))[0] == 304
+    assert (await get(client, "/api/users", '"other"'))[0] == 200
+    # The web UI pages too
+    (status, page_etag, _) = await get(client, "/users")
+    assert (await get(client, "/users", page_etag))[0] == 304
+
+
+async def test_write_changes_the_etag(client):
+    await register(client, "bob")
+    (_, etag, _) = await get(client, "/api/users")
+
+    await register(client, "alice")
+    (status, new_etag, body) = await get(client, "/api/users", etag)
+    assert status == 200 and new_etag != etag and b"alice" in body
+    assert (await get(client, "/api/users", new_etag))[0] == 304
+
+
+async def test_eviction(server, client):
+    await register(client, "bob")
+    urls = ["/api/users", "/api/users?limit=1", "/api/users?limit=2"]
+    for url in urls[:2]:
+        await get(client, url)
+    assert len(server.cache._entries) == 2
+    # Used last, kept over the other one
+    await get(client, urls[0])
+
+    await get(client, urls[2])
+    assert [a.split("?")[1] for a in server.cache._entries] == ["", "limit=2"]
+
+    # Cached bodies are served until a write
+    entry = server.cache._entries["/api/users?"]
+    entry.body = b"cached"
+    assert (await get(client, urls[0]))[2] == b"cached"
+    await register(client, "alice")
+    assert b"alice" in (await get(client, urls[0]))[2]
+
+
+async def test_etag_is_per_url(client):
+    await register(client, "bob")
+    (_, etag, _) = await get(client, "/api/users")
+
+    assert (await get(client, "/api/users?limit=1", etag))[0] == 200
+    assert (await get(client, "/api/users/posts?user_id=x", etag))[0] == 200
+    assert (await get(client, "/api/posts?post_id=missing", etag))[0] == 400
+
+
+async def test_wildcard_on_missing_thread(client):
+    assert (await get(client, "/api/posts?post_id=missing", "*"))[0] == 400
@@ -0,0 +1,122 @@
+import pytest
+
+from bleater.farm.context import (
+    REMOVED_OUTPUT,
+    SUMMARY_HEADER,
+    VIEW_THREAD_TOOL,
+    ContextManager,
+    DropToolOutputs,
+    SummarizeHistory,
+    TruncateHistory,
+    count_tokens,
+)
+from bleater.farm.model import ModelAdapter, ModelMessage, ModelToolCall, Role
+
+PREFIX = 2
+BUDGET = 1000
+TARGET = 0.75
+
+
+class SummaryModel(ModelAdapter):
+    def __init__(self, *, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+
+    async def ask_structured(self, messages, output, *, session=None):
+        self.calls.append(messages)
+        if self.fail:
+            raise ValueError("Invalid summary")
+        return output(summary="Posted a lot")
+
+
+def turn(i: int, tool: str = "search_posts_tool") -> list[ModelMessage]:
+    return [
+        ModelMessage(role=Role.User, content=f"Prompt {i}"),
+        ModelMessage(role=Role.Assistant, content="", tool_calls=[ModelToolCall(name=tool, arguments={"i": i})]),
+        ModelMessage(role=Role.Tool, content=f"output {i} " * 60, tool_name=tool),
+    ]
+
+
+def history() -> list[ModelMessage]:
+    """The session prefix, then 10 turns - the 6th one viewed a thread"""
+    messages = [
+        ModelMessage(role=Role.System, content="You are a llama"),
+        ModelMessage(role=Role.User, content="The feed " * 50),
+    ]
+    for i in range(10):
+        messages.extend(turn(i, VIEW_THREAD_TOOL if i == 5 else "search_posts_tool"))
+    return messages
+
+
+def tokens(messages: list[ModelMessage]) -> int:
+    return sum(count_tokens(a) for a in messages)
+
+
+def assert_kept(before: list[ModelMessage], after: list[ModelMessage]):
+    # The prefix, the current turn and the one with the latest thread
+    assert after[:PREFIX] == before[:PREFIX]
+    assert after[-3:] == before[-3:]
+    thread = before[PREFIX + 5 * 3 : PREFIX + 6 * 3]
+    assert all(any(a is b for b in after) for a in thread)
+
+
+async def test_under_budget_unchanged():
+    messages = history()
+    context = ContextManager(tokens(messages))
+    assert await context.fit(messages, PREFIX, SummaryModel()) is messages
+
+
+@pytest.mark.parametrize("strategy", [DropToolOutputs(), TruncateHistory()], ids=lambda a: type(a).__name__)
+async def test_strategy_reaches_the_goal(strategy):
+    messages = history()
+    assert tokens(messages) > BUDGET
+    context = ContextManager(BUDGET, target=TARGET, strategies=[strategy])
+    fitted = await context.fit(list(messages), PREFIX, SummaryModel())
+
+    assert tokens(fitted) <= BUDGET * TARGET
+    assert_kept(messages, fitted)
+
+
+async def test_drop_tool_outputs_oldest_first():
+    messages = history()
+    context = ContextManager(BUDGET, target=TARGET, strategies=[DropToolOutputs()])
+    fitted = await context.fit(list(messages), PREFIX, SummaryModel())
+
+    outputs = [a.content for a in fitted if a.role == Role.Tool]
+    dropped = [a == REMOVED_OUTPUT for a in outputs]
+    # Only as many as needed, from the oldest, skipping the thread
+    unpinned = [i for i in range(9) if i != 5][: sum(dropped)]
+    assert 0 < len(unpinned) < 9
+    assert dropped == [i in unpinned for i in range(10)]
+    # The calls stay
+    assert len(fitted) == len(messages)
+
+
+async def test_truncate_drops_whole_turns():
+    messages = history()
+    context = ContextManager(BUDGET, target=TARGET, strategies=[TruncateHistory()])
+    fitted = await context.fit(list(messages), PREFIX, SummaryModel())
+    prompts = [a.content for a in fitted[PREFIX:] if a.role == Role.User]
+    # From the oldest, around the thread, only as many as needed
+    assert prompts == ["Prompt 5", "Prompt 7", "Prompt 8", "Prompt 9"]
+    assert (len(fitted) - PREFIX) % 3 == 0
+
+
+async def test_summary():
+    messages = history()
+    model = SummaryModel()
+    context = ContextManager(BUDGET, target=TARGET, strategies=[SummarizeHistory()])
+    fitted = await context.fit(list(messages), PREFIX, model, session="llama")
+
+    assert len(model.calls) == 1
+    assert fitted[PREFIX].content == f"{SUMMARY_HEADER}\nPosted a lot"
+    assert fitted[PREFIX + 1 :] == messages[PREFIX + 5 * 3 : PREFIX + 6 * 3] + messages[-3:]
+    assert_kept(messages, fitted)
+
+
+async def test_failed_strategy_falls_through():
+    messages = history()
+    context = ContextManager(BUDGET, target=TARGET, strategies=[SummarizeHistory(), TruncateHistory()])
+    fitted = await context.fit(list(messages), PREFIX, SummaryModel(fail=True))
+    assert tokens(fitted) <= BUDGET * TARGET
+    assert_kept(messages, fitted)
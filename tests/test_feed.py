@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from bleater.models.posts import PostSubmitRequest
+from bleater.server.algorithms import GravityAlgorithm, RecencyRepliesAlgorithm, ReplyVelocityAlgorithm
+from bleater.server.feed import FeedEngine, get_feed
+
+NOW = 1_700_000_000
+ALGORITHMS = [RecencyRepliesAlgorithm, GravityAlgorithm, ReplyVelocityAlgorithm]
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+async def test_engine_matches_reference(storage, algorithm):
+    rnd = random.Random(1)
+    user = await storage.register_user("bob")
+    engine = FeedEngine(algorithm=algorithm())
+    # The oldest roots drop out of this one
+    small = FeedEngine(algorithm=algorithm(), window=8, size=5)
+    roots = []
+    # 5 posts per second, the timestamps tie a lot
+    for i in range(30):
+        parent = rnd.choice(roots) if len(roots) > 0 and rnd.random() < 0.3 else None
+        post = await storage.submit_post(
+            PostSubmitRequest(user_id=user.id, content=f"post {i}", parent_id=parent and parent.id), NOW + i // 5
+        )
+        engine.add_post(post)
+        small.add_post(post)
+        if parent is None:
+            roots.append(post)
+
+        now = NOW + 10
+        expected = await get_feed(storage, algorithm(), now)
+        assert [a.id for a in engine.get_feed(now)] == [a.id for a in expected]
+        assert engine.get_feed(now) == expected
+
+    for live in (engine, small):
+        loaded = FeedEngine(algorithm=algorithm(), window=live.window, size=live.size)
+        await loaded.load(storage)
+        assert loaded.get_feed(NOW + 60) == live.get_feed(NOW + 60)
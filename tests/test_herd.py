@@ -0,0 +1,101 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from bleater.farm import herd as herd_module
+from bleater.farm.herd import Herd
+from bleater.farm.llama import Llama
+from bleater.farm.model import ModelAdapter, ModelResponse
+from bleater.server.app import BleaterServer
+from bleater.server.memory_storage import InMemoryStorageBuilder
+
+
+class CountingModel(ModelAdapter):
+    """Answers without tool calls, counting the calls in flight"""
+
+    def __init__(self, concurrency: int, delay: float = 0.02):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sessions: list[str | None] = []
+
+    async def ask(self, messages, tools=None, *, session=None) -> ModelResponse:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.sessions.append(session)
+        try:
+            await asyncio.sleep(self.delay)
+            return ModelResponse(content="nothing to add", tool_calls=[])
+        finally:
+            self.in_flight -= 1
+
+
+@pytest.fixture
+async def server():
+    server = BleaterServer(InMemoryStorageBuilder())
+    await server.create_app()
+    yield server
+    await server.storage.close()
+
+
+def llamas(count: int) -> list[Llama]:
+    return [Llama(f"llama{i}", "test persona", actions_per_session=1) for i in range(count)]
+
+
+async def test_model_concurrency_cap(server):
+    model = CountingModel(concurrency=2)
+    herd = Herd(model, llamas=llamas(5), max_steps=3, server=server)
+    await herd.run()
+
+    assert model.max_in_flight == 2
+    assert len(model.sessions) == 5 * 3
+    assert all(a.sessions == 3 for a in herd.stats.values())
+
+
+async def test_llamas_take_turns(server):
+    model = CountingModel(concurrency=1)
+    herd = Herd(model, llamas=llamas(3), max_steps=2, server=server)
+    await herd.run()
+
+    # A llama done with its session queues up behind the waiting ones
+    assert model.sessions == ["llama0", "llama1", "llama2"] * 2
+    # The waits are counted: each llama waited for the sessions queued before it
+    stats = [herd.stats[a.name] for a in herd.llamas]
+    assert stats[0].last_queue_wait >= 2 * model.delay
+    assert stats[0].queue_wait < stats[1].queue_wait < stats[2].queue_wait
+
+
+async def test_per_llama_model(server):
+    shared = CountingModel(concurrency=1)
+    own = CountingModel(concurrency=1)
+    (first, second) = llamas(2)
+    second.model = own
+    herd = Herd(shared, llamas=[first, second], max_steps=1, server=server)
+    await herd.run()
+
+    assert (shared.sessions, own.sessions) == (["llama0"], ["llama1"])
+
+
+async def test_wait_for_server_backs_off(monkeypatch):
+    attempts = 0
+    delays = []
+
+    class RefusingClient:
+        def get(self, url):
+            nonlocal attempts
+            attempts += 1
+            if attempts < 5:
+                raise aiohttp.ClientConnectorError(None, OSError("refused"))
+            return asyncio.timeout(None)
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(herd_module.asyncio, "sleep", sleep)
+    monkeypatch.setattr(herd_module, "SERVER_POLL_MAX_INTERVAL", 0.5)
+    await Herd(CountingModel(1))._wait_for_server(RefusingClient())
+
+    assert attempts == 5
+    assert delays == [0.1, 0.2, 0.4, 0.5]
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+from bleater.farm import tools
+from bleater.farm.transport import AsgiClient
+from bleater.models import Post, User
+from bleater.models.posts import PostSubmitRequest
+from bleater.models.users import Notification
+from bleater.server.api import _stream_channels
+from bleater.server.app import BleaterServer
+from bleater.server.hub import FEED_CHANNEL, Event, Hub, user_channel
+from bleater.server.memory_storage import InMemoryStorageBuilder
+
+
+def post(id: str) -> Post:
+    return Post(id=id, parent_id=None, user=User(id="u", name="bob"), content=id, timestamp=0, replies=0)
+
+
+def notification(user_id: str) -> Notification:
+    return Notification(
+        id=f"n-{user_id}", user_id=user_id, content="reply", post_id="p", timestamp=0, mentioned_user=User(name="bob")
+    )
+
+
+async def events(subscription) -> list[Event | None]:
+    """Everything buffered, up to the end of a closed subscription"""
+    result = []
+    while (event := await asyncio.wait_for(subscription.get(), 1)) is not None:
+        result.append(event)
+    return result + [None]
+
+
+async def test_full_buffer_drops_the_oldest():
+    hub = Hub(buffer_size=2)
+    with hub.subscribe([FEED_CHANNEL]) as subscription:
+        for i in range(5):
+            hub.publish(FEED_CHANNEL, Event("post", str(i)))
+        # The dropped count comes first, so the client knows to refetch
+        dropped = await subscription.get()
+        assert (dropped.type, json.loads(dropped.data)) == ("dropped", {"count": 3})
+        assert [(await subscription.get()).data for _ in range(2)] == ["3", "4"]
+
+
+async def test_close_ends_the_subscriptions():
+    hub = Hub()
+    with hub.subscribe([FEED_CHANNEL]) as first, hub.subscribe(["other"]) as second:
+        hub.publish(FEED_CHANNEL, Event("post", "1"))
+        hub.close()
+        assert [None if a is None else a.data for a in await events(first)] == ["1", None]
+        assert await events(second) == [None]
+    # Unsubscribed on exit
+    assert hub._channels == {}
+
+
+async def test_channels_routing():
+    hub = Hub()
+    with (
+        hub.subscribe(_stream_channels("bob", False)) as bob,
+        hub.subscribe(_stream_channels(None, True)) as feed,
+        hub.subscribe(_stream_channels("alice", True)) as alice,
+    ):
+        hub.publish_post(post("p1"))
+        hub.publish_notifications([notification("bob"), notification("carol")])
+        hub.close()
+
+        assert [(a.type, json.loads(a.data)["user_id"]) for a in (await events(bob))[:-1]] == [("notification", "bob")]
+        assert [a.type for a in (await events(feed))[:-1]] == ["post"]
+        assert [a.type for a in (await events(alice))[:-1]] == ["post"]
+
+
+async def test_relay_gets_the_unsubscribed_events():
+    hub = Hub()
+    relayed = []
+    hub.relay = relayed.append
+    hub.publish_post(post("p1"))
+    hub.publish_notifications([notification("bob")])
+    assert [a.type for a in relayed] == ["post", "notification"]
+
+
+@pytest.fixture
+async def server():
+    server = BleaterServer(InMemoryStorageBuilder())
+    await server.create_app()
+    yield server
+    await server.storage.close()
+
+
+async def test_long_poll_wakes_up_on_a_notification(server):
+    async with AsgiClient(server.app, timeout=5) as client:
+        (bob, alice) = [await tools.register_user(client, a) for a in ("bob", "alice")]
+        (root,) = await tools.submit_posts(client, [PostSubmitRequest(user_id=bob.id, content="root")])
+
+        async def poll():
+            params = {"user_id": bob.id, "wait": 30}
+            async with client.get("/api/users/notifications", params=params) as response:
+                return await response.json()
+
+        waiting = asyncio.create_task(poll())
+        async with asyncio.timeout(2):
+            while user_channel(bob.id) not in server.hub._channels:
+                await asyncio.sleep(0.01)
+        assert not waiting.done()
+
+        await tools.create_submit_reply_tool(client, alice.id)("hi", root.id)
+        body = await asyncio.wait_for(waiting, 2)
+        assert [a["content"] for a in body["items"]] == ["New reply in your thread."]
+
+
+def sync_server() -> BleaterServer:
+    server = BleaterServer(InMemoryStorageBuilder())
+    asyncio.run(server.create_app())
+    return server
+
+
+def test_sse_stream():
+    server = sync_server()
+    with TestClient(server.app) as client, ThreadPoolExecutor(1) as executor:
+        bob = client.post("/api/users/register", json={"name": "bob"}).json()
+        # The stream only ends with the hub, read it in the background
+        stream = executor.submit(client.get, "/api/stream", params={"user_id": bob["id"]})
+        deadline = time.monotonic() + 2
+        while FEED_CHANNEL not in client.portal.call(lambda: set(server.hub._channels)):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        client.post("/api/posts", json={"user_id": bob["id"], "content": "hello"})
+        client.portal.call(server.hub.close)
+        response = stream.result(timeout=5)
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    (event,) = [a for a in response.text.split("\n\n") if len(a) > 0]
+    (type, data) = event.split("\n")
+    assert type == "event: post" and json.loads(data.removeprefix("data: "))["content"] == "hello"
+
+
+def test_websocket_stream():
+    server = sync_server()
+    with TestClient(server.app) as client:
+        (bob, alice) = [client.post("/api/users/register", json={"name": a}).json() for a in ("bob", "alice")]
+        root = client.post("/api/posts/batch", json=[{"user_id": bob["id"], "content": "root"}]).json()[0]
+
+        with client.websocket_connect(f"/api/ws?user_id={bob['id']}&feed=false") as websocket:
+            client.post("/api/posts", json={"user_id": alice["id"], "content": "hi", "parent_id": root["id"]})
+            message = websocket.receive_json()
+        assert message["type"] == "notification" and message["data"]["post_id"] == root["id"]
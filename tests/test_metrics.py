@@ -0,0 +1,168 @@
+import asyncio
+import re
+
+import pytest
+from fastapi import FastAPI
+
+from bleater.farm import tools
+from bleater.farm.transport import AsgiClient
+from bleater.models.posts import PostSubmitRequest
+from bleater.server.app import BleaterServer
+from bleater.server.metrics import (
+    PROMETHEUS_TEXT,
+    UNMATCHED_ROUTE,
+    Histogram,
+    InstrumentedStorage,
+    Metrics,
+    MetricsMiddleware,
+)
+from bleater.server.storage import SqlliteStorageBuilder
+
+SAMPLE = re.compile(r"^(\w+)(?:\{(.*)\})? (\S+)$")
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse(text: str) -> dict[tuple[str, frozenset], float]:
+    """Samples of the text exposition, by name and label set"""
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        match = SAMPLE.match(line)
+        assert match is not None, line
+        (name, labels, value) = match.groups()
+        key = (name, frozenset(LABEL.findall(labels or "")))
+        assert key not in samples, line
+        samples[key] = float(value)
+    return samples
+
+
+def sample(samples: dict, name: str, **labels) -> float:
+    return samples[(name, frozenset((key, str(value)) for key, value in labels.items()))]
+
+
+def label_sets(samples: dict, name: str) -> set[frozenset]:
+    return {labels for (sample_name, labels) in samples if sample_name == name}
+
+
+def test_histogram_buckets():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    samples = parse("\n".join(histogram.export("latency", 'route="/a"')))
+    # Cumulative, the bounds are inclusive
+    assert [sample(samples, "latency_bucket", route="/a", le=a) for a in ("0.1", "1.0", "+Inf")] == [2, 3, 4]
+    assert sample(samples, "latency_count", route="/a") == 4
+    assert sample(samples, "latency_sum", route="/a") == pytest.approx(2.65)
+
+
+def test_export_escapes_the_labels():
+    metrics = Metrics()
+    metrics.observe_request("GET", '/a"b\\c', 200, 0.01)
+    samples = parse(metrics.export())
+    assert sample(samples, "bleater_http_responses_total", method="GET", route='/a\\"b\\\\c', status=200) == 1
+
+
+@pytest.fixture
+async def server(tmp_path):
+    builder = SqlliteStorageBuilder(path=str(tmp_path / "bleater.db"))
+    server = BleaterServer(builder)
+    await server.create_app()
+    yield server
+    await server.storage.close()
+
+
+async def test_requests_are_counted_by_route(server):
+    async with AsgiClient(server.app, timeout=5) as client:
+        bob = await tools.register_user(client, "bob")
+        await tools.submit_posts(client, [PostSubmitRequest(user_id=bob.id, content="hello")])
+        for i in range(3):
+            async with client.get("/api/users/posts", params={"user_id": bob.id, "limit": i + 1}) as response:
+                assert response.status == 200
+        for path in ("/nope", f"/nope/{bob.id}"):
+            async with client.get(path) as response:
+                assert response.status == 404
+        async with client.get("/metrics") as response:
+            assert response.headers["content-type"] == PROMETHEUS_TEXT
+            samples = parse(await response.text())
+
+    responses = "bleater_http_responses_total"
+    # Labeled with the routes, not the raw paths - no query strings or unknown paths in the label set
+    assert {dict(a)["route"] for a in label_sets(samples, responses)} == {
+        "/api/users/register",
+        "/api/posts/batch",
+        "/api/users/posts",
+        UNMATCHED_ROUTE,
+    }
+    assert sample(samples, responses, method="GET", route="/api/users/posts", status=200) == 3
+    assert sample(samples, responses, method="GET", route=UNMATCHED_ROUTE, status=404) == 2
+    latency = "bleater_http_request_duration_seconds_count"
+    assert sample(samples, latency, method="GET", route="/api/users/posts") == 3
+    # The scrape itself is still running
+    assert sample(samples, "bleater_http_requests_in_flight") == 1
+
+    assert sample(samples, "bleater_storage_call_duration_seconds_count", method="get_user_posts") == 3
+    # One post in each of the pages
+    assert sample(samples, "bleater_storage_rows_total", method="get_user_posts") == 3
+    assert sample(samples, "bleater_storage_calls_in_flight", method="get_user_posts") == 0
+    assert label_sets(samples, "bleater_storage_errors_total") == set()
+    assert sample(samples, "bleater_sqlite_writes_total", database=0) >= 2
+    assert sample(samples, "bleater_sqlite_readers_in_use", database=0) == 0
+
+
+async def test_routes_are_labeled_with_the_template():
+    app = FastAPI()
+
+    @app.get("/items/{id}")
+    async def item(id: str):
+        return id
+
+    metrics = Metrics()
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+    async with AsgiClient(app, timeout=5) as client:
+        for id in ("a", "b"):
+            async with client.get(f"/items/{id}") as response:
+                assert response.status == 200
+    assert metrics.http_responses == {("GET", "/items/{id}", 200): 2}
+    assert metrics.http_in_flight == 0
+
+
+class BlockingStorage:
+    """Only the calls used by the tests, the wrapper doesn't check the rest"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def get_users(self, page):
+        await self.release.wait()
+        return ["bob", "alice"]
+
+    async def get_user(self, id: str):
+        raise RuntimeError("database is gone")
+
+
+async def test_storage_calls_in_flight_and_errors():
+    metrics = Metrics()
+    inner = BlockingStorage()
+    storage = InstrumentedStorage(inner, metrics)
+
+    calls = [asyncio.create_task(storage.get_users(None)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert sample(parse(metrics.export()), "bleater_storage_calls_in_flight", method="get_users") == 2
+    inner.release.set()
+    await asyncio.gather(*calls)
+
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            await storage.get_user("bob")
+
+    samples = parse(metrics.export())
+    assert sample(samples, "bleater_storage_calls_in_flight", method="get_users") == 0
+    assert sample(samples, "bleater_storage_calls_in_flight", method="get_user") == 0
+    assert sample(samples, "bleater_storage_rows_total", method="get_users") == 4
+    assert sample(samples, "bleater_storage_rows_total", method="get_user") == 0
+    # Failed calls are timed too
+    assert sample(samples, "bleater_storage_call_duration_seconds_count", method="get_user") == 3
+    assert label_sets(samples, "bleater_storage_errors_total") == {frozenset({("method", "get_user")})}
+    assert sample(samples, "bleater_storage_errors_total", method="get_user") == 3
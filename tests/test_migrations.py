@@ -0,0 +1,117 @@
+import aiosqlite
+
+from bleater.models import PageRequest
+from bleater.models.posts import PostSubmitRequest
+from bleater.server.migrations import load_migrations, migrate
+from bleater.server.storage import SqlliteStorageBuilder, storage_session
+
+# What the servers created before the migrations, `user_version` left at 0
+BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS post (
+    id TEXT PRIMARY KEY,
+    parent_id TEXT,
+    user_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp INT NOT NULL,
+    FOREIGN KEY (parent_id) REFERENCES message (id),
+    FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE TABLE IF NOT EXISTS notification (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    mentioned_user_id TEXT NOT NULL,
+    timestamp INT NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES user (id),
+    FOREIGN KEY (post_id) REFERENCES message (id),
+    FOREIGN KEY (mentioned_user_id) REFERENCES user (id)
+);
+"""
+
+
+async def search(storage, query: str) -> list[str]:
+    return [a.post.content for a in (await storage.search_posts(query, PageRequest(limit=10))).items]
+
+
+async def test_search_survives_vacuum(tmp_path):
+    builder = SqlliteStorageBuilder(path=str(tmp_path / "bleater.db"))
+    async with storage_session(await builder.build()) as storage:
+        user = await storage.register_user("bob")
+        for content in ("first cat", "second dog", "third cat"):
+            await storage.submit_post(PostSubmitRequest(user_id=user.id, content=content), 0)
+
+        async with storage.pool.exclusive() as db:
+            await db.execute("DELETE FROM post WHERE content = 'first cat'")
+        async with storage.pool.exclusive() as db:
+            await db.execute("VACUUM")
+
+        assert await search(storage, "cat") == ["third cat"]
+        assert await search(storage, "dog") == ["second dog"]
+    await builder.close()
+
+
+async def test_post_seq_migration_keeps_the_posts(tmp_path):
+    migrations = load_migrations()
+    async with aiosqlite.connect(tmp_path / "bleater.db", isolation_level=None) as db:
+        await migrate(db, [a for a in migrations if a.version < 5])
+        await db.execute("INSERT INTO user (id, name) VALUES ('u', 'bob')")
+        for id, parent_id, content in [("b", None, "root cat"), ("a", "b", "reply dog"), ("c", "b", "reply cat")]:
+            await db.execute(
+                "INSERT INTO post (id, parent_id, user_id, content, timestamp) VALUES (?, ?, 'u', ?, 0)",
+                [id, parent_id, content],
+            )
+
+        assert await migrate(db, migrations) == migrations[-1].version
+        cursor = await db.execute("SELECT seq, id, reply_count FROM post ORDER BY seq")
+        assert await cursor.fetchall() == [(1, "b", 2), (2, "a", 0), (3, "c", 0)]
+        cursor = await db.execute("SELECT rowid FROM post_search WHERE post_search MATCH 'cat' ORDER BY rowid")
+        assert await cursor.fetchall() == [(1,), (3,)]
+
+
+async def test_baseline_database_is_migrated(tmp_path):
+    path = tmp_path / "bleater.db"
+    async with aiosqlite.connect(path, isolation_level=None) as db:
+        await db.executescript(BASELINE_SCHEMA)
+        await db.executemany("INSERT INTO user (id, name) VALUES (?, ?)", [("u1", "bob"), ("u2", "alice")])
+        posts = [
+            ("r1", None, "u1", 1),
+            ("r2", None, "u1", 2),
+            ("a", "r1", "u2", 3),
+            ("b", "r1", "u2", 4),
+            ("c", "r2", "u2", 5),
+        ]
+        await db.executemany(
+            "INSERT INTO post (id, parent_id, user_id, content, timestamp) VALUES (?, ?, ?, 'old', ?)", posts
+        )
+        await db.execute(
+            "INSERT INTO notification (id, user_id, post_id, content, mentioned_user_id, timestamp)"
+            " VALUES ('n', 'u1', 'a', 'New reply in your thread.', 'u2', 3)"
+        )
+
+    builder = SqlliteStorageBuilder(path=str(path))
+    async with storage_session(await builder.build()) as storage:
+        # Backfilled
+        assert [a.replies for a in await storage.get_posts(["r1", "r2", "a"])] == [2, 1, 0]
+
+        # Kept up to date by the triggers
+        reply = PostSubmitRequest(user_id="u2", content="new", parent_id="r2")
+        await storage.submit_posts([reply, reply], 10)
+        await storage.submit_post(PostSubmitRequest(user_id="u1", content="new root"), 11)
+        assert [a.replies for a in await storage.get_posts(["r1", "r2"])] == [2, 3]
+        async with storage.pool.writer() as db:
+            await db.execute("DELETE FROM post WHERE id IN ('a', 'c')")
+        assert [a.replies for a in await storage.get_posts(["r1", "r2"])] == [1, 2]
+
+        assert [a.id for a in (await storage.get_user_notifications("u1", PageRequest(limit=10))).items] == ["n"]
+    await builder.close()
+
+    async with aiosqlite.connect(path) as db:
+        cursor = await db.execute("PRAGMA user_version")
+        assert await cursor.fetchone() == (load_migrations()[-1].version,)
@@ -0,0 +1,178 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from google import genai
+
+from bleater.farm import model as model_module
+from bleater.farm.model import GeminiAdapter, ModelMessage, ModelToolCall, ModelUsage, OllamaAdapter, Role
+
+
+def like_post(post_id: str) -> str:
+    """Like a post"""
+    return post_id
+
+
+MESSAGES = [
+    ModelMessage(role=Role.System, content="You are a llama."),
+    ModelMessage(role=Role.System, content="Be nice."),
+    ModelMessage(role=Role.User, content="What's new?"),
+    ModelMessage(role=Role.Assistant, content="", tool_calls=[ModelToolCall("like_post", {"post_id": "p"})]),
+    ModelMessage(role=Role.Tool, content="liked", tool_name="like_post"),
+]
+
+
+class FakeOllamaClient:
+    def __init__(self):
+        self.calls = []
+
+    async def chat(self, model, **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(
+            message=SimpleNamespace(content="hi", tool_calls=None), prompt_eval_count=12, eval_count=3
+        )
+
+
+async def test_ollama_keeps_the_model_loaded():
+    client = FakeOllamaClient()
+    adapter = OllamaAdapter(client=client, model="llama", keep_alive="1h")
+    response = await adapter.ask(MESSAGES, session="llama0")
+
+    (call,) = client.calls
+    assert call["keep_alive"] == "1h"
+    assert [a["role"] for a in call["messages"]] == ["system", "system", "user", "assistant", "tool"]
+    assert response.usage == ModelUsage(prompt_eval_tokens=12, output_tokens=3)
+
+
+async def test_ollama_sessions_stick_to_a_host():
+    adapter = OllamaAdapter(model="llama", hosts=[f"http://host{i}:11434" for i in range(3)])
+    adapter.clients = [FakeOllamaClient() for _ in adapter.clients]
+    adapter.client = adapter.clients[0]
+
+    sessions = [f"llama{i}" for i in range(30)]
+    for _ in range(2):
+        for session in sessions:
+            await adapter.ask(MESSAGES, session=session)
+    await adapter.ask(MESSAGES)
+
+    # Every host got some of the sessions, each session all of its calls on the same host
+    assert all(len(a.calls) > 0 for a in adapter.clients)
+    assert sum(len(a.calls) for a in adapter.clients) == 2 * len(sessions) + 1
+    assert all(adapter._client(a) is adapter._client(a) for a in sessions)
+    assert len(adapter.clients[0].calls) % 2 == 1
+
+
+def test_ollama_arguments():
+    with pytest.raises(ValueError):
+        OllamaAdapter(client=FakeOllamaClient(), model="llama", hosts=["http://host:11434"])
+    with pytest.raises(ValueError):
+        OllamaAdapter(model="llama", hosts=[])
+    with pytest.raises(ValueError):
+        OllamaAdapter(client=FakeOllamaClient(), model="llama", concurrency=0)
+
+
+class FakeGeminiClient:
+    """`genai.Client.aio`, only the calls used by the adapter"""
+
+    def __init__(self, create_error: Exception | None = None):
+        self.requests = []
+        self.created = []
+        self.deleted = []
+        self.create_attempts = 0
+        self.create_error = create_error
+        self.models = SimpleNamespace(generate_content=self.generate_content)
+        self.caches = SimpleNamespace(create=self.create, delete=self.delete)
+
+    async def generate_content(self, *, model, contents, config):
+        self.requests.append((contents, config))
+        return SimpleNamespace(
+            text="hi",
+            function_calls=None,
+            usage_metadata=genai.types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=100, cached_content_token_count=80, candidates_token_count=5
+            ),
+        )
+
+    async def create(self, *, model, config):
+        # Yields like the API call, so the concurrent asks overlap
+        await asyncio.sleep(0.01)
+        self.create_attempts += 1
+        if self.create_error is not None:
+            raise self.create_error
+        self.created.append(config)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+    async def delete(self, *, name):
+        self.deleted.append(name)
+
+
+async def test_gemini_prompt_split():
+    client = FakeGeminiClient()
+    adapter = GeminiAdapter(client=client, model="gemini", cache_ttl=None)
+    response = await adapter.ask(MESSAGES, [like_post])
+
+    ((contents, config),) = client.requests
+    assert config.system_instruction == "You are a llama.\nBe nice.\n"
+    assert config.tools == [like_post] and config.cached_content is None
+    assert [a.role for a in contents] == ["user", "model", "model"]
+    assert contents[1].parts[1].function_call.name == "like_post"
+    assert contents[2].parts[0].function_response.response == {"output": "liked"}
+    # The cached tokens are not counted as evaluated
+    assert response.usage == ModelUsage(prompt_eval_tokens=20, cached_tokens=80, output_tokens=5)
+
+
+async def test_gemini_caches_the_prefix_once():
+    client = FakeGeminiClient()
+    adapter = GeminiAdapter(client=client, model="gemini", cache_ttl=600)
+    await asyncio.gather(*[adapter.ask(MESSAGES, [like_post]) for _ in range(5)])
+
+    (created,) = client.created
+    assert created.system_instruction == "You are a llama.\nBe nice.\n" and created.ttl == "600s"
+    assert [a.function_declarations[0].name for a in created.tools] == ["like_post"]
+    # The prefix goes with the cache, not with the requests
+    assert all(
+        (a.cached_content, a.system_instruction, a.tools) == ("cachedContents/1", None, None)
+        for (_, a) in client.requests
+    )
+
+    # Other tools, other prefix
+    await adapter.ask(MESSAGES)
+    assert len(client.created) == 2 and client.created[1].tools is None
+
+
+async def test_gemini_deletes_the_superseded_cache(monkeypatch):
+    client = FakeGeminiClient()
+    adapter = GeminiAdapter(client=client, model="gemini", cache_ttl=100)
+    now = 1000.0
+    # Not the real `time.monotonic`, the event loop runs on it
+    monkeypatch.setattr(model_module, "time", SimpleNamespace(monotonic=lambda: now))
+
+    await adapter.ask(MESSAGES)
+    now += 89
+    await adapter.ask(MESSAGES)
+    assert (len(client.created), client.deleted) == (1, [])
+
+    # Renewed before it expires
+    now += 1
+    await asyncio.gather(*[adapter.ask(MESSAGES) for _ in range(3)])
+    assert (len(client.created), client.deleted) == (2, ["cachedContents/1"])
+    assert client.requests[-1][1].cached_content == "cachedContents/2"
+
+
+async def test_gemini_uncacheable_prefix():
+    client = FakeGeminiClient(create_error=genai.errors.APIError(400, {"error": {"message": "too small"}}))
+    adapter = GeminiAdapter(client=client, model="gemini", cache_ttl=600)
+    await asyncio.gather(*[adapter.ask(MESSAGES) for _ in range(3)])
+    await adapter.ask(MESSAGES)
+
+    # Tried once, then sent with the requests
+    assert client.create_attempts == 1
+    assert all(a.system_instruction == "You are a llama.\nBe nice.\n" for (_, a) in client.requests)
+
+
+def test_usage_adds_up():
+    usage = ModelUsage()
+    usage += ModelUsage(prompt_eval_tokens=10, cached_tokens=5, output_tokens=2)
+    usage += ModelUsage(prompt_eval_tokens=1, output_tokens=1)
+    assert usage == ModelUsage(prompt_eval_tokens=11, cached_tokens=5, output_tokens=3)
+    assert GeminiAdapter._usage(None) is None
@@ -0,0 +1,63 @@
+import re
+
+from bleater.farm.transport import AsgiClient
+from bleater.models import Cursor, Page, PageRequest
+from bleater.models.posts import PostSubmitRequest
+from bleater.server.app import BleaterServer
+from bleater.server.memory_storage import InMemoryStorageBuilder
+from bleater.server.pagination import DEFAULT_PAGE_SIZE
+from bleater.server.storage import STREAM_CHUNK_SIZE, PageStream
+
+
+def counting(fetch):
+    """The fetch with the limits it was called with kept in `limits`"""
+
+    async def wrapped(page: PageRequest) -> Page:
+        wrapped.limits.append(page.limit)
+        return await fetch(page)
+
+    wrapped.limits = []
+    return wrapped
+
+
+async def test_page_spans_several_chunks(storage):
+    user = await storage.register_user("bob")
+    for i in range(DEFAULT_PAGE_SIZE + 10):
+        await storage.submit_post(PostSubmitRequest(user_id=user.id, content=f"post {i}"), i)
+    expected = await storage.get_user_posts(user.id, PageRequest(limit=DEFAULT_PAGE_SIZE))
+
+    fetch = counting(lambda a: storage.get_user_posts(user.id, a))
+    stream = PageStream(fetch, PageRequest(limit=DEFAULT_PAGE_SIZE))
+    assert [a async for a in stream] == expected.items
+    assert len(fetch.limits) > 1 and all(a <= STREAM_CHUNK_SIZE for a in fetch.limits)
+    assert sum(fetch.limits) == DEFAULT_PAGE_SIZE
+    assert stream.next_cursor == expected.next_cursor
+    assert stream.prev_cursor is None
+
+    # The rest of the posts, the first chunk is short already
+    fetch = counting(lambda a: storage.get_user_posts(user.id, a))
+    stream = PageStream(fetch, PageRequest(limit=DEFAULT_PAGE_SIZE, cursor=Cursor.decode(expected.next_cursor)))
+    assert len([a async for a in stream]) == 10
+    assert stream.next_cursor is None and stream.prev_cursor is not None
+
+
+async def test_view_page_spans_several_chunks():
+    server = BleaterServer(InMemoryStorageBuilder(), cache_size=0)
+    async with AsgiClient(await server.create_app()) as client:
+        async with client.post("/api/users/register", json={"name": "bob"}) as response:
+            user = await response.json()
+        posts = [{"user_id": user["id"], "content": f"post {i}"} for i in range(DEFAULT_PAGE_SIZE + 10)]
+        async with client.post("/api/posts/batch", json=posts) as response:
+            assert response.status == 200
+
+        async with client.get("/user", params={"id": user["id"]}) as response:
+            assert response.status == 200
+            first = await response.text()
+        assert first.count("wrote:") == DEFAULT_PAGE_SIZE
+        (next_cursor,) = re.findall(r'cursor=([^"]+)">\[Next\]', first)
+
+        async with client.get("/user", params={"id": user["id"], "cursor": next_cursor}) as response:
+            second = await response.text()
+        assert second.count("wrote:") == 10
+        assert "[Previous]" in second and "[Next]" not in second
+    await server.storage.close()
@@ -0,0 +1,161 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from bleater.server.pool import SqlitePool
+
+
+@pytest.fixture
+async def pool(tmp_path):
+    pool = SqlitePool(str(tmp_path / "pool.db"), readers=1, group_commit=True)
+    await pool.open()
+    async with pool.exclusive() as db:
+        await db.execute("CREATE TABLE item (value INTEGER)")
+    yield pool
+    await pool.close()
+
+
+def fail_begin(pool: SqlitePool, error: Exception, times: int = 1):
+    """Makes the writer's next `times` BEGINs raise `error`"""
+    writer = pool._writer
+    execute = writer.execute
+    left = times
+
+    def patched(sql, *args, **kwargs):
+        nonlocal left
+        if sql == "BEGIN" and left > 0:
+            left -= 1
+
+            async def fail():
+                raise error
+
+            return fail()
+        return execute(sql, *args, **kwargs)
+
+    writer.execute = patched
+
+
+async def write(pool: SqlitePool, value: int):
+    async with pool.writer() as db:
+        await db.execute("INSERT INTO item (value) VALUES (?)", [value])
+
+
+async def values(pool: SqlitePool) -> list[int]:
+    async with pool.reader() as db:
+        cursor = await db.execute("SELECT value FROM item ORDER BY value")
+        return [row[0] for row in await cursor.fetchall()]
+
+
+async def test_group_commit_batches_writes(pool):
+    await asyncio.gather(*(write(pool, i) for i in range(10)))
+    assert await values(pool) == list(range(10))
+    assert pool.version == 11
+
+
+async def test_failed_write_discards_only_itself(pool):
+    async def failing():
+        async with pool.writer() as db:
+            await db.execute("INSERT INTO item (value) VALUES (?)", [100])
+            raise RuntimeError("boom")
+
+    results = await asyncio.gather(write(pool, 1), failing(), write(pool, 2), return_exceptions=True)
+    assert isinstance(results[1], RuntimeError)
+    assert await values(pool) == [1, 2]
+
+
+async def test_begin_failure_fails_the_write(pool):
+    fail_begin(pool, sqlite3.OperationalError("disk I/O error"))
+
+    with pytest.raises(sqlite3.OperationalError):
+        await asyncio.wait_for(write(pool, 1), 3)
+
+    # The commit loop keeps serving the writes
+    assert not pool._commit_task.done()
+    await asyncio.wait_for(write(pool, 2), 3)
+    assert await values(pool) == [2]
+
+
+async def test_unrecoverable_writer_fails_the_queued_writes(pool, monkeypatch):
+    fail_begin(pool, sqlite3.OperationalError("disk I/O error"))
+
+    async def unhealthy(db, *, read_only):
+        raise sqlite3.OperationalError("unable to open database file")
+
+    monkeypatch.setattr(pool, "_ensure_healthy", unhealthy)
+    results = await asyncio.wait_for(
+        asyncio.gather(*(write(pool, i) for i in range(3)), return_exceptions=True),
+        3,
+    )
+    assert all(isinstance(a, sqlite3.OperationalError) for a in results)
+    assert not pool._commit_task.done()
+
+    monkeypatch.undo()
+    await asyncio.wait_for(write(pool, 5), 3)
+    assert await values(pool) == [5]
+
+
+@pytest.fixture
+async def plain_pool(tmp_path):
+    pool = SqlitePool(str(tmp_path / "plain.db"), readers=2)
+    await pool.open()
+    async with pool.exclusive() as db:
+        await db.execute("CREATE TABLE item (value INTEGER)")
+    yield pool
+    await pool.close()
+
+
+async def test_readers_are_borrowed(plain_pool):
+    async with plain_pool.reader() as first, plain_pool.reader() as second:
+        assert first is not second and plain_pool.readers_in_use == 2
+        # Waits for one of them to come back
+        third = asyncio.create_task(values(plain_pool))
+        await asyncio.sleep(0.01)
+        assert not third.done()
+    assert await asyncio.wait_for(third, 1) == []
+    assert plain_pool.readers_in_use == 0
+
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        async with plain_pool.reader() as db:
+            await db.execute("INSERT INTO item (value) VALUES (1)")
+    # Still healthy, kept
+    async with plain_pool.reader() as db, plain_pool.reader() as other:
+        assert {db, other} == {first, second}
+
+
+async def test_snapshot_sees_a_single_state(plain_pool):
+    await write(plain_pool, 1)
+    async with plain_pool.snapshot() as db:
+        cursor = await db.execute("SELECT count(*) FROM item")
+        assert await cursor.fetchone() == (1,)
+
+        await write(plain_pool, 2)
+        cursor = await db.execute("SELECT count(*) FROM item")
+        assert await cursor.fetchone() == (1,)
+        # The other reader is in autocommit
+        assert await values(plain_pool) == [1, 2]
+    assert await values(plain_pool) == [1, 2]
+
+
+async def test_broken_reader_is_replaced(plain_pool):
+    with pytest.raises(sqlite3.OperationalError):
+        async with plain_pool.reader() as broken:
+            await broken.close()
+            raise sqlite3.OperationalError("disk I/O error")
+
+    async with plain_pool.reader() as db, plain_pool.reader() as other:
+        assert broken not in (db, other)
+    assert await values(plain_pool) == []
+    assert plain_pool.readers_in_use == 0
+
+
+async def test_broken_writer_is_replaced(plain_pool):
+    broken = plain_pool._writer
+    with pytest.raises(sqlite3.OperationalError):
+        async with plain_pool.exclusive() as db:
+            await db.close()
+            raise sqlite3.OperationalError("disk I/O error")
+
+    assert plain_pool._writer is not broken
+    await write(plain_pool, 1)
+    assert await values(plain_pool) == [1]
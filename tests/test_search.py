@@ -0,0 +1,31 @@
+from bleater.farm.tools import _format_hit
+from bleater.models import PageRequest
+from bleater.models.posts import HIGHLIGHT_END, HIGHLIGHT_START, PostSubmitRequest
+from bleater.server.views import highlight
+
+
+async def test_snippet_marks_the_matched_terms(storage):
+    user = await storage.register_user("bob")
+    content = "**Cats** are <b>great</b>, cats rule"
+    await storage.submit_post(PostSubmitRequest(user_id=user.id, content=content), 0)
+
+    (hit,) = (await storage.search_posts("cats", PageRequest(limit=10))).items
+    assert hit.snippet == (
+        f"**{HIGHLIGHT_START}Cats{HIGHLIGHT_END}** are <b>great</b>, {HIGHLIGHT_START}cats{HIGHLIGHT_END} rule"
+    )
+    assert hit.plain_snippet() == content
+    assert _format_hit(hit) == f"  - bob wrote: `{content}` [Original post id: {hit.post.id}]"
+    assert highlight(hit.snippet) == "**<mark>Cats</mark>** are &lt;b&gt;great&lt;/b&gt;, <mark>cats</mark> rule"
+
+
+async def test_content_markers_are_left_out(storage):
+    user = await storage.register_user("bob")
+    content = f"fake {HIGHLIGHT_START}cats{HIGHLIGHT_END} and {HIGHLIGHT_END}dogs"
+    post = await storage.submit_post(PostSubmitRequest(user_id=user.id, content=content), 0)
+    # Stored as it is
+    assert (await storage.get_post(post.id)).content == content
+
+    (hit,) = (await storage.search_posts("dogs", PageRequest(limit=10))).items
+    assert hit.snippet == f"fake cats and {HIGHLIGHT_START}dogs{HIGHLIGHT_END}"
+    assert highlight(hit.snippet) == "fake cats and <mark>dogs</mark>"
+    assert len((await storage.search_posts("cats", PageRequest(limit=10))).items) == 1
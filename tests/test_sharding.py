@@ -0,0 +1,53 @@
+import sqlite3
+
+import pytest
+
+from bleater.server.sharded_storage import ShardedSqliteStorage, ShardedSqliteStorageBuilder
+from bleater.server.storage import storage_session
+
+
+@pytest.fixture
+async def storage(tmp_path):
+    builder = ShardedSqliteStorageBuilder(shards=3, directory=str(tmp_path / "shards"))
+    getter = await builder.build()
+    async with storage_session(getter) as storage:
+        yield storage
+    await builder.close()
+
+
+def fail_copies(monkeypatch, storage: ShardedSqliteStorage, shard: int, times: int):
+    """The user copies to `shard` fail `times` times"""
+    insert_user = ShardedSqliteStorage._insert_user
+    failures = 0
+
+    async def failing_insert_user(target, id, name, *, copy=False):
+        nonlocal failures
+        if target is storage.shards[shard] and failures < times:
+            failures += 1
+            raise sqlite3.OperationalError("database is locked")
+        await insert_user(target, id, name, copy=copy)
+
+    monkeypatch.setattr(ShardedSqliteStorage, "_insert_user", staticmethod(failing_insert_user))
+
+
+async def user_names(storage: ShardedSqliteStorage) -> list[list[str]]:
+    return [[a.name for a in (await shard.get_users()).items] for shard in storage.shards]
+
+
+async def test_failed_user_copies_are_retried(storage, monkeypatch):
+    fail_copies(monkeypatch, storage, shard=2, times=1)
+    bob = await storage.register_user("bob")
+
+    assert bob is not None
+    assert [await a.get_user(bob.id) for a in storage.shards] == [bob] * 3
+
+
+async def test_failed_registration_is_rolled_back(storage, monkeypatch):
+    fail_copies(monkeypatch, storage, shard=2, times=2)
+    with pytest.raises(sqlite3.OperationalError):
+        await storage.register_user("bob")
+    assert await user_names(storage) == [[], [], []]
+
+    # The name is free again
+    bob = await storage.register_user("bob")
+    assert bob is not None and await user_names(storage) == [["bob"]] * 3
@@ -0,0 +1,284 @@
+import random
+
+import pytest
+
+from bleater.models import Cursor, InvalidCursorError, Page, PageRequest
+from bleater.models.posts import PostSubmitRequest
+from bleater.models.users import NotificationRequest
+from bleater.server.memory_storage import InMemoryStorageBuilder
+from bleater.server.storage import BaseStorage, SqlliteStorageBuilder, storage_session
+
+
+async def register(storage: BaseStorage, *names: str):
+    return [await storage.register_user(a) for a in names]
+
+
+async def submit(storage: BaseStorage, user_id: str, content: str, timestamp: int, parent_id: str | None = None):
+    post = PostSubmitRequest(user_id=user_id, content=content, parent_id=parent_id)
+    return await storage.submit_post(post, timestamp)
+
+
+def page_ids(pages: list[Page]) -> list[list[str]]:
+    return [[a.id for a in page.items] for page in pages]
+
+
+async def walk(fetch, limit: int) -> tuple[list[Page], list[Page]]:
+    """All the pages following `next_cursor`, then back from the last one following `prev_cursor`"""
+    forward = [await fetch(PageRequest(limit=limit))]
+    while forward[-1].next_cursor is not None:
+        forward.append(await fetch(PageRequest(limit=limit, cursor=Cursor.decode(forward[-1].next_cursor))))
+    backward = [forward[-1]]
+    while backward[-1].prev_cursor is not None:
+        backward.append(await fetch(PageRequest(limit=limit, cursor=Cursor.decode(backward[-1].prev_cursor))))
+    return (forward, backward)
+
+
+async def test_register_user(storage):
+    (bob, _alice) = await register(storage, "bob", "alice")
+    assert bob.name == "bob" and bob.id is not None
+    assert await storage.register_user("bob") is None
+
+    assert await storage.get_user(bob.id) == bob
+    assert await storage.get_user("missing") is None
+    assert [a.name for a in (await storage.get_users()).items] == ["alice", "bob"]
+
+
+async def test_submit_and_get_posts(storage):
+    (bob, alice) = await register(storage, "bob", "alice")
+    root = await submit(storage, bob.id, "hello", 10)
+    assert (root.content, root.parent_id, root.user.name, root.timestamp, root.replies) == ("hello", None, "bob", 10, 0)
+
+    first = await submit(storage, alice.id, "hi bob", 11, root.id)
+    posts = await storage.submit_posts(
+        [
+            PostSubmitRequest(user_id=bob.id, content="hi alice", parent_id=root.id),
+            PostSubmitRequest(user_id=alice.id, content="another thread"),
+        ],
+        12,
+    )
+    assert [a.content for a in posts] == ["hi alice", "another thread"]
+
+    assert (await storage.get_post(root.id)).replies == 2
+    assert (await storage.get_post(first.id)).parent_id == root.id
+    assert await storage.get_post("missing") is None
+    assert [a.id for a in await storage.get_posts([posts[1].id, "missing", root.id])] == [posts[1].id, root.id]
+
+    thread = await storage.get_thread(root.id)
+    assert thread.root.id == root.id and thread.root.replies == 2
+    assert [a.content for a in thread.replies] == ["hi bob", "hi alice"]
+    assert await storage.get_thread("missing") is None
+    assert sorted(await storage.get_thread_user_ids(root.id)) == sorted([alice.id, bob.id])
+
+    threads = await storage.get_threads([posts[1].id, "missing", root.id], 10)
+    assert [(a.id, len(a.replies)) for a in threads] == [(posts[1].id, 0), (root.id, 2)]
+
+    assert [a.content for a in await storage.get_last_posts(10)] == ["another thread", "hello"]
+    assert storage.version > 0
+
+
+async def test_user_posts_pages(storage):
+    (bob,) = await register(storage, "bob")
+    root = await submit(storage, bob.id, "post 0", 0)
+    # Same timestamps as well, the id breaks the ties
+    for i in range(1, 11):
+        await submit(storage, bob.id, f"post {i}", i // 2, None if i % 2 == 0 else root.id)
+    everything = (await storage.get_user_posts(bob.id)).items
+    assert len(everything) == 11
+    assert [(a.timestamp, a.id) for a in everything] == sorted(((a.timestamp, a.id) for a in everything), reverse=True)
+
+    (forward, backward) = await walk(lambda a: storage.get_user_posts(bob.id, a), 3)
+    assert [a.id for page in forward for a in page.items] == [a.id for a in everything]
+    assert [len(a.items) for a in forward] == [3, 3, 3, 2]
+    assert forward[0].prev_cursor is None
+    # The same pages, walked back
+    assert page_ids(backward) == page_ids(list(reversed(forward)))
+
+
+async def test_thread_replies_pages(storage):
+    (bob,) = await register(storage, "bob")
+    root = await submit(storage, bob.id, "root", 0)
+    replies = [await submit(storage, bob.id, f"reply {i}", i // 3, root.id) for i in range(8)]
+    expected = [a.id for a in sorted(replies, key=lambda a: (a.timestamp, a.id))]
+
+    async def fetch(page: PageRequest) -> Page:
+        thread = await storage.get_thread(root.id, page)
+        return Page(items=thread.replies, next_cursor=thread.next_cursor, prev_cursor=thread.prev_cursor)
+
+    (forward, backward) = await walk(fetch, 3)
+    assert [a.id for page in forward for a in page.items] == expected
+    assert page_ids(backward) == page_ids(list(reversed(forward)))
+
+
+async def test_threads_latest_replies(storage):
+    (bob,) = await register(storage, "bob")
+    (root, other) = [await submit(storage, bob.id, a, 0) for a in ("root", "other")]
+    replies = [await submit(storage, bob.id, f"reply {i}", i // 3, root.id) for i in range(8)]
+    await submit(storage, bob.id, "other reply", 0, other.id)
+    expected = [a.id for a in sorted(replies, key=lambda a: (a.timestamp, a.id))]
+
+    (thread, other_thread) = await storage.get_threads([root.id, other.id], 3)
+    assert [a.id for a in thread.replies] == expected[-3:]
+    assert [a.content for a in other_thread.replies] == ["other reply"] and other_thread.prev_cursor is None
+
+    # The older ones are paged back from the thread
+    older = []
+    cursor = thread.prev_cursor
+    while cursor is not None:
+        page = await storage.get_thread(root.id, PageRequest(limit=3, cursor=Cursor.decode(cursor)))
+        older = [a.id for a in page.replies] + older
+        cursor = page.prev_cursor
+    assert older == expected[:-3]
+
+
+async def test_invalid_cursor_key(storage):
+    (bob,) = await register(storage, "bob")
+    root = await submit(storage, bob.id, "root", 0)
+    await submit(storage, bob.id, "reply", 1, root.id)
+    await storage.notify(bob.id, "notification", root.id, bob.id, 1)
+
+    # With the length of their keys
+    fetches = [
+        (storage.get_users, 1),
+        (lambda a: storage.get_user_posts(bob.id, a), 2),
+        (lambda a: storage.get_thread(root.id, a), 2),
+        (lambda a: storage.get_user_notifications(bob.id, a), 2),
+    ]
+    for fetch, length in fetches:
+        for key in ([], ["a"], ["a", 1], ["a", 1, 2]):
+            if len(key) == length:
+                continue
+            for backwards in (False, True):
+                with pytest.raises(InvalidCursorError):
+                    await fetch(PageRequest(limit=10, cursor=Cursor(key=key, backwards=backwards)))
+
+
+async def test_notify_many_keeps_first_per_recipient(storage):
+    (bob, alice, carol) = await register(storage, "bob", "alice", "carol")
+    root = await submit(storage, bob.id, "root", 0)
+    created = await storage.notify_many(
+        [
+            NotificationRequest(user_id=bob.id, content="first", post_id=root.id, mentioned_user_id=alice.id),
+            NotificationRequest(user_id=bob.id, content="second", post_id=root.id, mentioned_user_id=carol.id),
+            NotificationRequest(user_id=carol.id, content="third", post_id=root.id, mentioned_user_id=alice.id),
+        ],
+        5,
+    )
+    assert sorted((a.user_id, a.content) for a in created) == sorted([(bob.id, "first"), (carol.id, "third")])
+
+    notifications = (await storage.get_user_notifications(bob.id, PageRequest(limit=10))).items
+    assert [(a.content, a.post_id, a.timestamp, a.mentioned_user.name) for a in notifications] == [
+        ("first", root.id, 5, "alice")
+    ]
+
+    await storage.purge_user_notifications(bob.id)
+    assert (await storage.get_user_notifications(bob.id, PageRequest(limit=10))).items == []
+    assert len((await storage.get_user_notifications(carol.id, PageRequest(limit=10))).items) == 1
+
+
+async def test_drain_and_ack(storage):
+    (bob, alice) = await register(storage, "bob", "alice")
+    root = await submit(storage, bob.id, "root", 0)
+    for i in range(5):
+        await storage.notify(bob.id, f"n{i}", root.id, alice.id, i)
+
+    first = await storage.drain_user_notifications(bob.id, 2)
+    assert [a.content for a in first.items] == ["n0", "n1"]
+    # Kept until acknowledged
+    assert (await storage.drain_user_notifications(bob.id, 2)).items == first.items
+
+    second = await storage.drain_user_notifications(bob.id, 2, Cursor.decode(first.next_cursor))
+    assert [a.content for a in second.items] == ["n2", "n3"]
+    third = await storage.drain_user_notifications(bob.id, 2, Cursor.decode(second.next_cursor))
+    assert [a.content for a in third.items] == ["n4"]
+    last = await storage.drain_user_notifications(bob.id, 2, Cursor.decode(third.next_cursor))
+    assert last.items == []
+    assert (await storage.get_user_notifications(bob.id, PageRequest(limit=10))).items == []
+
+
+async def test_session(storage):
+    (bob, alice) = await register(storage, "bob", "alice")
+    root = await submit(storage, alice.id, "root", 0)
+    await submit(storage, bob.id, "reply", 1, root.id)
+    await storage.notify(alice.id, "bob replied", root.id, bob.id, 1)
+
+    feed = await storage.get_last_posts(10)
+    session = await storage.get_session(alice.id, feed, expand=1, notification_limit=10, replies=10)
+    assert [a.content for a in session.notifications.items] == ["bob replied"]
+    assert [(a.id, [b.content for b in a.replies]) for a in session.threads] == [(root.id, ["reply"])]
+
+    acked = await storage.get_session(
+        alice.id,
+        feed,
+        expand=0,
+        notification_limit=10,
+        replies=10,
+        ack=Cursor.decode(session.notifications.next_cursor),
+    )
+    assert acked.notifications.items == [] and acked.threads == []
+
+
+async def scenario(storage: BaseStorage, seed: int = 1) -> list:
+    """Random activity, the results with the ids replaced by the post contents"""
+    rnd = random.Random(seed)
+    out = []
+    users = await register(storage, *(f"user{i}" for i in range(5)))
+    posts = []
+    for i in range(150):
+        roots = [a for a in posts if a.parent_id is None]
+        parent_id = rnd.choice(roots).id if len(roots) > 0 and rnd.random() < 0.6 else None
+        posts.append(await submit(storage, rnd.choice(users).id, f"content {i}", i, parent_id))
+    contents = {a.id: a.content for a in posts}
+    names = {a.id: a.name for a in users}
+
+    def post(a):
+        return (a.content, contents.get(a.parent_id), a.user.name, a.timestamp, a.replies)
+
+    out.append([post(a) for a in await storage.get_last_posts(20)])
+    for root in [a for a in posts if a.parent_id is None][:10]:
+        thread = await storage.get_thread(root.id)
+        out.append((post(thread.root), [post(a) for a in thread.replies]))
+        out.append(sorted(names[a] for a in await storage.get_thread_user_ids(root.id)))
+        await storage.notify_many(
+            [
+                NotificationRequest(user_id=a.id, content=root.content, post_id=root.id, mentioned_user_id=users[0].id)
+                for a in users
+            ],
+            1000 + len(out),
+        )
+    for user in users:
+        out.append([post(a) for a in (await storage.get_user_posts(user.id)).items])
+        notifications = await storage.drain_user_notifications(user.id, 5)
+        out.append([(a.content, contents[a.post_id], a.timestamp) for a in notifications.items])
+    return out
+
+
+async def test_backends_match_sqlite(storage, tmp_path):
+    builder = SqlliteStorageBuilder(path=str(tmp_path / "reference.db"))
+    async with storage_session(await builder.build()) as reference:
+        expected = await scenario(reference)
+    await builder.close()
+
+    assert await scenario(storage) == expected
+
+
+async def test_memory_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot.db")
+    memory = InMemoryStorageBuilder(snapshot_path=path)
+    async with storage_session(await memory.build()) as storage:
+        await scenario(storage)
+        users = (await storage.get_users()).items
+        threads = await storage.get_threads([a.id for a in await storage.get_last_posts(100)], 100)
+        notifications = [(await storage.get_user_notifications(a.id, PageRequest(limit=100))).items for a in users]
+    await memory.close()
+
+    sqlite = SqlliteStorageBuilder(path=path)
+    async with storage_session(await sqlite.build()) as storage:
+        assert (await storage.get_users()).items == users
+        assert await storage.get_threads([a.id for a in threads], 100) == threads
+        for user, expected in zip(users, notifications):
+            assert (await storage.get_user_notifications(user.id, PageRequest(limit=100))).items == expected
+        # Carries on where the memory storage stopped
+        (user,) = await register(storage, "newcomer")
+        assert user is not None
+        assert await storage.register_user("user0") is None
+    await sqlite.close()
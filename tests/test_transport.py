@@ -0,0 +1,101 @@
+import logging
+
+import pytest
+
+from bleater.farm import tools
+from bleater.farm.transport import AsgiClient
+from bleater.models.posts import PostSubmitRequest
+from bleater.server.app import BleaterServer
+from bleater.server.memory_storage import InMemoryStorageBuilder
+from bleater.server.storage import get_storage
+
+
+@pytest.fixture
+async def server():
+    server = BleaterServer(InMemoryStorageBuilder())
+    await server.create_app()
+    yield server
+    await server.storage.close()
+
+
+@pytest.fixture
+async def client(server):
+    async with AsgiClient(server.app, timeout=5) as client:
+        yield client
+
+
+async def test_tools(client):
+    bob = await tools.register_user(client, "bob")
+    assert bob.name == "bob"
+    assert await tools.register_user(client, "bob") is None
+    alice = await tools.register_user(client, "alice")
+
+    assert await tools.create_submit_post_tool(client, bob.id)("Hello **world**") == "Post created"
+    (root,) = await tools.get_feed(client)
+    assert (root.content, root.user.name) == ("Hello **world**", "bob")
+    assert await tools.create_submit_reply_tool(client, alice.id)("Hi bob", root.id) == "Reply posted"
+
+    view = tools.create_view_thread_tool(client)
+    thread = await view(root.id)
+    assert thread.startswith(f"[Original post id: {root.id}]\nbob wrote: `Hello **world**")
+    assert "alice replied: `Hi bob`" in thread
+    assert await view("missing") == "Thread not found!"
+
+    search = tools.create_search_posts_tool(client)
+    assert await search("world") == f"  - bob wrote: `Hello **world**` [Original post id: {root.id}]"
+    assert await search("nothing") == "Nothing found"
+
+    requests = [PostSubmitRequest(user_id=alice.id, content=f"post {i}") for i in range(3)]
+    posts = await tools.submit_posts(client, requests)
+    assert [a.content for a in posts] == ["post 0", "post 1", "post 2"]
+    threads = await tools.get_threads(client, [root.id, posts[0].id])
+    assert [len(a.replies) for a in threads] == [1, 0]
+
+    session = await tools.get_session(client, bob.id)
+    assert root.id in [a.id for a in session.feed]
+
+
+async def test_status_and_body(client):
+    async with client.post("/api/users/register", json={"name": "bob"}) as response:
+        assert response.status == 200
+        assert response.headers["content-type"] == "application/json"
+        user = await response.json()
+    assert user["name"] == "bob"
+
+    async with client.get("/api/posts", params={"post_id": "missing"}) as response:
+        assert response.status == 400
+        assert await response.json() == {"detail": "Bad Request"}
+
+    async with client.post("/api/users/register", json={}) as response:
+        assert response.status == 422
+
+    async with client.get("http://example.com/api/users/posts?limit=5", params={"user_id": user["id"]}) as response:
+        assert response.status == 200
+        assert (await response.json())["items"] == []
+
+
+async def test_server_error(server, client, caplog):
+    async def broken():
+        raise RuntimeError("storage is gone")
+
+    server.app.dependency_overrides[get_storage] = broken
+    with caplog.at_level(logging.ERROR, logger="bleater.farm.transport"):
+        async with client.get("/api/posts", params={"post_id": "any"}) as response:
+            assert response.status == 500
+            assert await response.text() == "Internal Server Error"
+        # The tools see the failed response, like over HTTP
+        assert await tools.register_user(client, "bob") is None
+        assert await tools.create_view_thread_tool(client)("any") == "Thread not found!"
+    assert "GET /api/posts failed" in caplog.text
+
+
+async def test_timeout_and_closed(server):
+    user = await tools.register_user(AsgiClient(server.app), "bob")
+    client = AsgiClient(server.app, timeout=0.1)
+    # Long-polled, nothing comes
+    with pytest.raises(TimeoutError):
+        await tools.get_notifications(client, user.id, wait=5)
+
+    await client.close()
+    with pytest.raises(RuntimeError):
+        await tools.get_feed(client)
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from bleater.farm import tools
+from bleater.farm.transport import AsgiClient
+from bleater.models.posts import PostSubmitRequest
+from bleater.server.app import BleaterServer
+from bleater.server.hub import FEED_CHANNEL, Event, user_channel
+from bleater.server.memory_storage import InMemoryStorageBuilder
+from bleater.server.storage import SqlliteStorageBuilder
+from bleater.server.workers import WRITE_EVENT, Broker, PeerLink, WriteRelayMiddleware
+
+
+async def eventually(check, timeout: float = 2):
+    async with asyncio.timeout(timeout):
+        while not check():
+            await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+async def broker():
+    broker = Broker()
+    await broker.start()
+    yield broker
+    await broker.close()
+
+
+@pytest.fixture
+async def workers(tmp_path, broker):
+    """Two workers of a sqlite server, connected through the broker like the worker processes"""
+    builder = SqlliteStorageBuilder(path=str(tmp_path / "bleater.db"))
+    server = BleaterServer(builder, workers=2)
+    # Migrated by the supervising process
+    await builder.build()
+
+    joined = []
+    for _ in range(2):
+        worker = server._worker()
+        (_, link, listener) = await worker._join_workers(broker.path)
+        joined.append((worker, link, listener))
+    await eventually(lambda: len(broker._peers) == 2)
+
+    yield [a[0] for a in joined]
+    for worker, link, listener in joined:
+        listener.cancel()
+        await link.close()
+        worker.hub.close()
+        await worker.storage.close()
+    await builder.close()
+
+
+async def test_posts_are_relayed_to_the_other_worker(workers):
+    (first, second) = workers
+    async with AsgiClient(first.app, timeout=5) as writer, AsgiClient(second.app, timeout=5) as reader:
+        (bob, alice) = [await tools.register_user(writer, a) for a in ("bob", "alice")]
+        async with reader.get("/api/users") as response:
+            etag = response.headers["etag"]
+
+        with second.hub.subscribe([FEED_CHANNEL, user_channel(bob.id)]) as subscription:
+            (root,) = await tools.submit_posts(writer, [PostSubmitRequest(user_id=bob.id, content="hello")])
+            event = await asyncio.wait_for(subscription.get(), 2)
+            assert (event.type, json.loads(event.data)["id"]) == ("post", root.id)
+            assert [a.id for a in second.feed.get_feed()] == [root.id]
+
+            await tools.create_submit_reply_tool(writer, alice.id)("hi", root.id)
+            events = [await asyncio.wait_for(subscription.get(), 2) for _ in range(2)]
+            assert sorted(a.type for a in events) == ["notification", "post"]
+
+        # The cached response of the other worker is gone with the write
+        await tools.register_user(writer, "carol")
+        await eventually(lambda: second.cache._generation > 0)
+        async with reader.get("/api/users", headers={"If-None-Match": etag}) as response:
+            assert response.status == 200 and b"carol" in await response.read()
+
+
+class RecordingLink:
+    def __init__(self):
+        self.events: list[Event] = []
+
+    def send(self, event: Event):
+        self.events.append(event)
+
+
+async def test_only_successful_writes_are_relayed():
+    server = BleaterServer(InMemoryStorageBuilder())
+    app = await server.create_app()
+    link = RecordingLink()
+    app.add_middleware(WriteRelayMiddleware, link=link)
+
+    async with AsgiClient(app, timeout=5) as client:
+        bob = await tools.register_user(client, "bob")
+        assert [a.type for a in link.events] == [WRITE_EVENT]
+
+        async with client.get("/api/users") as response:
+            assert response.status == 200
+        reply = {"user_id": bob.id, "content": "hi", "parent_id": "missing"}
+        async with client.post("/api/posts", json=reply) as response:
+            assert response.status == 400
+        async with client.post("/api/posts", json={"content": "no user"}) as response:
+            assert response.status == 422
+        assert len(link.events) == 1
+    await server.storage.close()
+
+
+async def test_bad_events_are_skipped(caplog):
+    broker = Broker()
+    await broker.start()
+    (sender, receiver) = [await PeerLink.connect(broker.path) for _ in range(2)]
+    await eventually(lambda: len(broker._peers) == 2)
+    received = []
+
+    def handler(event: Event):
+        if event.type == "broken":
+            raise ValueError("can't handle it")
+        received.append(event)
+
+    listener = asyncio.create_task(receiver.listen(handler))
+    sender._writer.write(b"not json\n")
+    sender.send(Event("broken", "null"))
+    sender.send(Event(WRITE_EVENT, "null"))
+    await eventually(lambda: len(received) == 1)
+    assert received == [Event(WRITE_EVENT, "null")]
+    assert caplog.text.count("Can't handle worker event") == 2
+
+    # Logged when the broker goes away
+    with caplog.at_level(logging.ERROR):
+        await broker.close()
+        await asyncio.wait_for(listener, 2)
+    assert "Broker connection closed" in caplog.text
+    await sender.close()
+    await receiver.close()